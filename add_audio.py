@@ -3,39 +3,206 @@ Standalone Audio Generator for Bedtime Stories
 Uses third-party TTS libraries (gTTS or pyttsx3) as OpenAI v0.28.0 doesn't support TTS
 
 This is separate from main_iterative.py to keep the assignment code clean.
+
+Long stories are split at paragraph/sentence boundaries and the chunks are
+synthesized concurrently: on a thread pool for the remote gTTS engine, or on a
+process pool for the offline engines (pyttsx3, espeak) so no network is needed.
+The chunk files are joined in order without re-encoding.
+
+With an AudioCache (audio_cache.py) the story is narrated sentence by sentence and
+each sentence's audio is cached, so a revised story only re-synthesizes the
+sentences that changed; the rest is spliced in from the cache.
 """
 
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
 from pathlib import Path
+import io
 import os
+import re
+import subprocess
+import tempfile
+import wave
+
+from audio_cache import AudioCache, get_audio_cache, make_audio_key
+
+
+def split_into_chunks(text: str, max_chars: int = 400) -> list:
+    """
+    Split text into chunks of at most max_chars, breaking at paragraph and then
+    sentence boundaries so every chunk is read with natural intonation.
+    
+    max_chars=0 gives one sentence per chunk (the unit of the audio cache).
+    """
+    chunks = []
+    for paragraph in re.split(r"\n\s*\n", text.strip()):
+        paragraph = " ".join(paragraph.split())
+        if not paragraph:
+            continue
+        current = ""
+        for sentence in re.split(r"(?<=[.!?])\s+", paragraph):
+            if current and len(current) + len(sentence) + 1 > max_chars:
+                chunks.append(current)
+                current = sentence
+            else:
+                current = f"{current} {sentence}".strip()
+        if current:
+            chunks.append(current)
+    return chunks
+
+
+def synthesize_gtts(text: str, speed: float) -> bytes:
+    """Remote engine: Google Text-to-Speech, returns MP3 bytes."""
+    from gtts import gTTS
+    
+    buffer = io.BytesIO()
+    gTTS(text=text, lang='en', slow=(speed < 0.8)).write_to_fp(buffer)
+    return buffer.getvalue()
+
+
+def synthesize_pyttsx3(text: str, speed: float) -> bytes:
+    """Offline engine: pyttsx3 (SAPI5/NSSpeechSynthesizer/espeak), returns WAV bytes."""
+    import pyttsx3
+    
+    with tempfile.TemporaryDirectory() as tmp:
+        path = os.path.join(tmp, "chunk.wav")
+        engine = pyttsx3.init()
+        engine.setProperty("rate", int(175 * speed))
+        engine.save_to_file(text, path)
+        engine.runAndWait()
+        with open(path, "rb") as f:
+            return f.read()
+
+
+class EspeakNotInstalledError(RuntimeError):
+    """The espeak command line tool is not on PATH."""
+
+
+def synthesize_espeak(text: str, speed: float) -> bytes:
+    """Offline engine: the espeak / espeak-ng command line tool, returns WAV bytes."""
+    with tempfile.TemporaryDirectory() as tmp:
+        path = os.path.join(tmp, "chunk.wav")
+        try:
+            subprocess.run(["espeak", "-s", str(int(160 * speed)), "-w", path, text], check=True,
+                           stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+        except FileNotFoundError as e:
+            raise EspeakNotInstalledError(str(e)) from e
+        with open(path, "rb") as f:
+            return f.read()
+
+
+# name -> (synthesize function, output format, pool type)
+TTS_ENGINES = {
+    "gtts": (synthesize_gtts, "mp3", ThreadPoolExecutor),
+    "pyttsx3": (synthesize_pyttsx3, "wav", ProcessPoolExecutor),
+    "espeak": (synthesize_espeak, "wav", ProcessPoolExecutor),
+}
+
+# Voice each engine speaks with (part of the audio cache key)
+ENGINE_VOICES = {"gtts": "en", "pyttsx3": "system-default", "espeak": "en"}
 
-def generate_audio_from_text(story_text: str, output_filename: str = "bedtime_story.mp3", speed: float = 0.9):
+
+def _strip_id3(segment: bytes) -> bytes:
+    """Drop a leading ID3v2 tag so only the first segment carries metadata."""
+    if segment[:3] != b"ID3" or len(segment) < 10:
+        return segment
+    size = (segment[6] << 21) | (segment[7] << 14) | (segment[8] << 7) | segment[9]
+    return segment[10 + size:]
+
+
+def concatenate_audio(segments: list, audio_format: str) -> bytes:
     """
-    Convert story text to speech using Google Text-to-Speech (gTTS).
+    Join audio segments in order without re-encoding.
+    
+    MP3 is a sequence of independent frames, so segments are appended byte-wise.
+    WAV segments are merged by copying their PCM frames under a single header.
+    """
+    if audio_format == "mp3":
+        return b"".join(segments[:1] + [_strip_id3(segment) for segment in segments[1:]])
+    
+    output = io.BytesIO()
+    writer = None
+    for segment in segments:
+        with wave.open(io.BytesIO(segment), "rb") as reader:
+            if writer is None:
+                writer = wave.open(output, "wb")
+                writer.setparams(reader.getparams())
+            writer.writeframes(reader.readframes(reader.getnframes()))
+    if writer is not None:
+        writer.close()
+    return output.getvalue()
+
+
+def stream_audio_chunks(story_text: str, speed: float = 0.9, engine: str = "gtts", max_workers: int = 4,
+                        max_chars: int = 400, cache: AudioCache = None):
+    """
+    Synthesize all chunks concurrently and yield (index, audio_bytes) in story order.
+    
+    The first chunk is yielded as soon as it is ready, so playback can start while
+    later chunks are still being rendered. With a cache, chunks are single sentences:
+    cached sentences are yielded straight from disk and only new or changed ones
+    are synthesized (and then cached).
+    """
+    synthesize, audio_format, pool_type = TTS_ENGINES[engine]
+    chunks = split_into_chunks(story_text, 0 if cache is not None else max_chars)
+    if not chunks:
+        return
+    
+    keys = [make_audio_key(chunk, engine, ENGINE_VOICES[engine], speed) for chunk in chunks] if cache is not None else []
+    cached = [cache.get(key, audio_format) for key in keys] if cache is not None else [None] * len(chunks)
+    missing = [index for index, segment in enumerate(cached) if segment is None]
+    if not missing:
+        yield from enumerate(cached)
+        return
+    
+    with pool_type(max_workers=min(max_workers, len(missing))) as pool:
+        futures = {index: pool.submit(synthesize, chunks[index], speed) for index in missing}
+        for index, segment in enumerate(cached):
+            if segment is None:
+                segment = futures[index].result()
+                if cache is not None:
+                    cache.put(keys[index], audio_format, segment)
+            yield index, segment
+
+
+def generate_audio_from_text(story_text: str, output_filename: str = "bedtime_story.mp3", speed: float = 0.9,
+                             engine: str = "gtts", max_workers: int = 4, cache: AudioCache = None):
+    """
+    Convert story text to speech, synthesizing chunks in parallel.
     
     Args:
         story_text: The story text to convert
-        output_filename: Output MP3 filename
+        output_filename: Output filename (the extension follows the engine's format)
         speed: Speaking speed (0.5 = very slow, 1.0 = normal, 1.5 = fast)
                For bedtime: 0.9 recommended (slightly slower, calming)
+        engine: "gtts" (online, MP3), "pyttsx3" or "espeak" (offline, WAV)
+        max_workers: Chunks synthesized at the same time
+        cache: Optional sentence-level AudioCache; unchanged sentences are reused
     
     Returns:
         Path to generated audio file
     """
     try:
-        from gtts import gTTS
+        _, audio_format, _ = TTS_ENGINES[engine]
         
         print("\n" + "="*70)
         print("GENERATING AUDIO VERSION")
         print("="*70)
-        print(f"Speed: {speed}x (slower = more calming)")
+        print(f"Engine: {engine}  Speed: {speed}x (slower = more calming)")
         print("Converting story to speech...")
         
-        # Create TTS object
-        tts = gTTS(text=story_text, lang='en', slow=(speed < 0.8))
+        # Synthesize chunks concurrently, then join them in order
+        hits_before = cache.hits if cache is not None else 0
+        segments = [segment for _, segment in stream_audio_chunks(story_text, speed, engine, max_workers, cache=cache)]
+        if cache is not None:
+            reused = cache.hits - hits_before
+            print(f"♻️  Reused {reused}/{len(segments)} sentence(s) from the audio cache, "
+                  f"synthesized {len(segments) - reused}")
+        else:
+            print(f"Rendered {len(segments)} chunk(s) with up to {max_workers} worker(s)")
         
         # Save audio file
-        audio_path = Path(output_filename)
-        tts.save(str(audio_path))
+        audio_path = Path(output_filename).with_suffix(f".{audio_format}")
+        audio_path.write_bytes(concatenate_audio(segments, audio_format))
         
         # Calculate estimated duration
         word_count = len(story_text.split())
@@ -48,12 +215,17 @@ def generate_audio_from_text(story_text: str, output_filename: str = "bedtime_st
         
         return str(audio_path.absolute())
         
-    except ImportError:
-        print("\n❌ gTTS library not installed!")
+    except ImportError as e:
+        package = "pyttsx3" if engine == "pyttsx3" else "gTTS"
+        print(f"\n❌ {package} library not installed! ({e})")
         print("\nTo enable audio generation, run:")
-        print("  pip install gTTS")
+        print(f"  pip install {package}")
         print("\nThen run this script again.")
         return None
+    except EspeakNotInstalledError:
+        print("\n❌ espeak is not installed!")
+        print("\nInstall it with your package manager (e.g. apt install espeak-ng), or choose another engine.")
+        return None
     except Exception as e:
         print(f"\n❌ Error generating audio: {e}")
         return None
@@ -102,12 +274,20 @@ def main():
     choice = input("\nEnter your choice (1-3) [default: 2]: ").strip() or '2'
     speed = speed_map.get(choice, 0.85)
     
+    # Engine selection
+    print("\n🔈 Choose voice engine:")
+    print("  1. Google TTS (online, MP3)")
+    print("  2. pyttsx3 (offline, WAV)")
+    print("  3. espeak (offline, WAV)")
+    engine_map = {'1': 'gtts', '2': 'pyttsx3', '3': 'espeak'}
+    engine = engine_map.get(input("\nEnter your choice (1-3) [default: 1]: ").strip() or '1', 'gtts')
+    
     # Filename
     default_filename = "bedtime_story.mp3"
     filename = input(f"\nOutput filename [default: {default_filename}]: ").strip() or default_filename
     
     # Generate audio
-    audio_path = generate_audio_from_text(story_text, filename, speed)
+    audio_path = generate_audio_from_text(story_text, filename, speed, engine=engine, cache=get_audio_cache())
     
     if audio_path:
         print(f"\n🔊 Success! Play the audio file to hear your bedtime story.")
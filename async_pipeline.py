@@ -0,0 +1,475 @@
+"""
+Async Story Pipeline
+Asyncio version of the iterative quality control loop from main_iterative.py.
+
+The prompts and parsing are shared with main_iterative.py; only the model calls
+differ (acall_model instead of call_model), so many pipelines can be awaited
+concurrently. Instead of printing step banners, progress is reported through an
+optional on_event(name, data) callback. Stages are traced with the same span names
+as the sync pipeline (see tracing.py), minus the console banners.
+"""
+
+import asyncio
+import time
+
+from batch_judge import JudgeBatcher, ajudge_batch, rank_by_scores
+from category_classifier import get_classifier, log_category_label, shadow_rate, should_shadow
+from content_safety import is_safety_feedback, prefilter_story
+from evaluation_parser import add_format_reminder, compact_evaluation, parse_score
+from iteration_policy import AdaptivePolicy, log_trajectory
+from main_iterative import (
+    LISTWISE_TIE_MARGIN,
+    LOCAL_CATEGORY_THRESHOLD,
+    SCORE_PATTERN,
+    acall_model,
+    astream_model,
+    build_adaptation_prompt,
+    build_detection_prompt,
+    build_feedback_prompt,
+    build_improvement_prompt,
+    build_judge_prompt,
+    build_storyteller_prompt,
+    extract_score_from_evaluation,
+    parse_category,
+)
+from run_log import RequestLog
+from story_library import StoryLibrary
+from targeted_revision import (
+    build_paragraph_revision_prompt,
+    parse_revised_paragraphs,
+    patch_paragraphs,
+    plan_revision,
+    revision_max_tokens,
+)
+from tracing import tracer
+
+
+def _emit(on_event, name: str, **data):
+    """Forward a pipeline event to the callback, if one was given."""
+    if on_event is not None:
+        on_event(name, data)
+
+
+async def adetect_story_category(user_input: str, confidence_threshold: float = LOCAL_CATEGORY_THRESHOLD) -> str:
+    """Async version of detect_story_category (local classifier first, LLM when unsure or shadow-sampled)."""
+    with tracer.span("detect") as span:
+        local_category, confidence = get_classifier().predict(user_input)
+        shadow = confidence >= confidence_threshold and should_shadow()
+        if confidence >= confidence_threshold and not shadow:
+            span.set(source="local", category=local_category, confidence=round(confidence, 3))
+            return local_category
+
+        start = time.perf_counter()
+        detection_prompt = build_detection_prompt(user_input)
+        category = parse_category(await acall_model(detection_prompt, max_tokens=10, temperature=0.1, stage="detect"))
+        log_category_label(user_input, category, time.perf_counter() - start, local_category, confidence,
+                           shadow_rate() if shadow else None)
+        span.set(source="shadow" if shadow else "llm", category=category, local_category=local_category,
+                 confidence=round(confidence, 3))
+        return category
+
+
+async def acollect_stream(chunks, on_token=None) -> str:
+    """Join an async stream into the full reply, passing each piece to on_token."""
+    parts = []
+    async for chunk in chunks:
+        parts.append(chunk)
+        if on_token is not None:
+            on_token(chunk)
+    return "".join(parts)
+
+
+async def agenerate_initial_story(user_input: str, category: str = None, on_token=None) -> tuple:
+    """Async version of generate_initial_story. Returns (story, category)."""
+    if category is None:
+        category = await adetect_story_category(user_input)
+
+    with tracer.span("draft", category=category):
+        storyteller_prompt = build_storyteller_prompt(user_input, category)
+        if on_token is not None:
+            story = await acollect_stream(
+                astream_model(storyteller_prompt, max_tokens=500, temperature=0.7, stage="draft"), on_token
+            )
+        else:
+            story = await acall_model(storyteller_prompt, max_tokens=500, temperature=0.7, stage="draft")
+    return story, category
+
+
+async def aadapt_library_story(seed: dict, user_input: str, on_token=None) -> tuple:
+    """Async version of adapt_library_story. Returns (story, category)."""
+    category = seed["category"]
+    with tracer.span("draft", category=category, seeded=True):
+        prompt = build_adaptation_prompt(seed["story"], user_input, category)
+        if on_token is not None:
+            story = await acollect_stream(
+                astream_model(prompt, max_tokens=600, temperature=0.7, stage="feedback"), on_token
+            )
+        else:
+            story = await acall_model(prompt, max_tokens=600, temperature=0.7, stage="feedback")
+    return story, category
+
+
+async def agenerate_initial_drafts(user_input: str, category: str, num_drafts: int = 3) -> list:
+    """Generate num_drafts story drafts concurrently."""
+    with tracer.span("draft", category=category, num_drafts=num_drafts):
+        storyteller_prompt = build_storyteller_prompt(user_input, category)
+        return list(await asyncio.gather(*(
+            acall_model(storyteller_prompt, max_tokens=500, temperature=0.7, stage="draft") for _ in range(num_drafts)
+        )))
+
+
+async def acall_judge(judge_prompt: str, early_exit_score: float = None) -> str:
+    """Async version of call_judge: optionally cancel the reply once a passing score arrives."""
+    evaluation = await _aread_judge(judge_prompt, early_exit_score)
+    if SCORE_PATTERN.search(evaluation) is None:
+        evaluation = await _aread_judge(add_format_reminder(judge_prompt), early_exit_score)
+        parse_score(evaluation)  # Raises EvaluationParseError rather than guessing a score
+    return evaluation
+
+
+async def _aread_judge(judge_prompt: str, early_exit_score: float = None) -> str:
+    if early_exit_score is None:
+        return await acall_model(judge_prompt, max_tokens=500, temperature=0.1, stage="judge")
+
+    chunks = astream_model(judge_prompt, max_tokens=500, temperature=0.1, stage="judge")
+    evaluation = ""
+    score_seen = False
+    try:
+        async for chunk in chunks:
+            evaluation += chunk
+            if score_seen:
+                continue
+            match = SCORE_PATTERN.search(evaluation)
+            if match:
+                score_seen = True
+                if float(match.group(1)) >= early_exit_score:
+                    return evaluation[:match.end()]
+    finally:
+        await chunks.aclose()
+    return evaluation
+
+
+async def ajudge_story(story: str, iteration: int, previous_evaluation: str = None,
+                       early_exit_score: float = None) -> str:
+    """Async version of judge_story."""
+    judge_prompt = build_judge_prompt(story, iteration, previous_evaluation)
+    with tracer.span("judge", iteration=iteration) as span:
+        evaluation = await acall_judge(judge_prompt, early_exit_score)
+        span.set(score=extract_score_from_evaluation(evaluation))
+    return evaluation
+
+
+async def ajudge_drafts_listwise(drafts: list, category: str = None) -> tuple:
+    """Async version of judge_drafts(listwise=True). Returns (evaluations, scores, ranking)."""
+    with tracer.span("judge", iteration=1, num_drafts=len(drafts), listwise=True) as span:
+        evaluations = [prefilter_story(draft, category) if category is not None else None for draft in drafts]
+        pending = [index for index, evaluation in enumerate(evaluations) if evaluation is None]
+        ranking = []
+        if pending:
+            batch_evaluations, _, batch_ranking = await ajudge_batch([drafts[index] for index in pending])
+            for index, evaluation in zip(pending, batch_evaluations):
+                evaluations[index] = evaluation
+            ranking = [pending[position] for position in batch_ranking]
+        scores = [extract_score_from_evaluation(evaluation) for evaluation in evaluations]
+        ranking += [index for index in rank_by_scores(scores) if index not in ranking]
+        span.set(score=max(scores), draft_scores=scores, ranking=ranking)
+    return evaluations, scores, ranking
+
+
+async def arank_versions(story_versions: list, scores: list, margin: float = LISTWISE_TIE_MARGIN) -> int:
+    """Async version of rank_versions."""
+    best = max(scores)
+    close = [index for index, score in enumerate(scores) if best - score <= margin]
+    if len(close) < 2:
+        return scores.index(best)
+    with tracer.span("judge", listwise=True, candidates=[index + 1 for index in close]) as span:
+        _, _, ranking = await ajudge_batch([story_versions[index] for index in close])
+        span.set(ranking=[close[position] + 1 for position in ranking])
+    return close[ranking[0]]
+
+
+async def arevise_paragraphs(plan: tuple, feedback: str, feedback_intro: str, on_token=None,
+                             stage: str = "improve"):
+    """Async version of revise_paragraphs. Returns the patched story, or None on an incomplete reply."""
+    paragraphs, indices = plan
+    prompt = build_paragraph_revision_prompt(paragraphs, indices, feedback, feedback_intro)
+    max_tokens = revision_max_tokens(paragraphs, indices)
+    if on_token is not None:
+        reply = await acollect_stream(
+            astream_model(prompt, max_tokens=max_tokens, temperature=0.7, stage=stage), on_token
+        )
+    else:
+        reply = await acall_model(prompt, max_tokens=max_tokens, temperature=0.7, stage=stage)
+    revised = parse_revised_paragraphs(reply, indices)
+    return patch_paragraphs(paragraphs, revised) if revised is not None else None
+
+
+async def aimprove_story(original_story: str, evaluation: str, iteration: int, on_token=None,
+                         targeted: bool = False) -> str:
+    """Async version of improve_story."""
+    improvement_prompt = build_improvement_prompt(original_story, evaluation)
+    with tracer.span("improve", iteration=iteration) as span:
+        plan = plan_revision(original_story, evaluation) if targeted else None
+        if plan is not None:
+            feedback = compact_evaluation(evaluation, ("weaknesses", "suggestions", "strengths"))
+            improved_story = await arevise_paragraphs(
+                plan, feedback, "A children's literature expert provided this feedback:", on_token
+            )
+            if improved_story is not None:
+                span.set(mode="targeted", paragraphs=[index + 1 for index in plan[1]])
+                return improved_story
+        span.set(mode="full")
+        if on_token is not None:
+            return await acollect_stream(
+                astream_model(improvement_prompt, max_tokens=500, temperature=0.7, stage="improve"), on_token
+            )
+        return await acall_model(improvement_prompt, max_tokens=500, temperature=0.7, stage="improve")
+
+
+async def agenerate_story_with_quality_control(user_input: str, target_score=8, max_iterations=3,
+                                               category: str = None, on_event=None, num_drafts=1,
+                                               stream_tokens=False, early_exit_judge=False,
+                                               safety_prefilter=True, request_id: str = None,
+                                               targeted_revision=False, listwise_judge=False,
+                                               judge_batcher: JudgeBatcher = None,
+                                               policy: AdaptivePolicy = None,
+                                               library: StoryLibrary = None,
+                                               run_log: RequestLog = None) -> dict:
+    """
+    Async version of generate_story_with_quality_control.
+
+    Args:
+        user_input: The story request from the user
+        target_score: Minimum acceptable quality score (1-10)
+        max_iterations: Maximum number of improvement iterations
+        category: Optional category override (skips detection)
+        on_event: Optional callback(name, data) for progress events
+                  (resumed, library, category, draft, score, improved, final)
+        num_drafts: Drafts to write and judge concurrently; the best enters the loop
+        stream_tokens: Emit "token" events while draft/improved stories are generated
+        early_exit_judge: Cancel judge replies once they show a passing score
+        safety_prefilter: Skip the judge for versions with hard content-safety violations
+        request_id: Optional id recorded on every tracing span of this story
+        targeted_revision: Rewrite only the paragraphs the feedback refers to
+        listwise_judge: Judge drafts together in one call and settle close calls
+                        between versions by ranking them side by side
+        judge_batcher: Optional shared JudgeBatcher; judgements from concurrent
+                       requests are packed into shared calls (early_exit_judge is
+                       ignored for batched judgements)
+        policy: Optional stopping policy that ends the loop early when another
+                round isn't worth its cost or would exceed the story's budget
+        library: Optional StoryLibrary: serve or adapt a stored story for similar
+                 requests, and store the final story
+        run_log: Optional RequestLog: every completed stage is appended to it, and a
+                 request whose log already has stages resumes after the last one
+                 (a finished request returns its logged result without any calls)
+
+    Returns:
+        dict with story, category, evaluations, scores, story_versions,
+        judge_calls_avoided, stop_reason and library ("served", "seeded" or None)
+    """
+    if max_iterations < 1:
+        raise ValueError(f"max_iterations must be at least 1, got {max_iterations}")
+    with tracer.span("story", request=user_input[:80], request_id=request_id) as story_span:
+        story_start = time.perf_counter()
+
+        def usage() -> tuple:
+            tokens = story_span.attrs.get("prompt_tokens", 0) + story_span.attrs.get("completion_tokens", 0)
+            return tokens, time.perf_counter() - story_start
+
+        async def record(stage: str, **data):
+            if run_log is not None:
+                await run_log.arecord(stage, **data)
+
+        resumed = run_log.state() if run_log is not None else {
+            "category": None, "draft": None, "judged": {}, "improved": {}, "final": None,
+        }
+        if resumed["final"] is not None:
+            story_span.set(resumed="final")
+            _emit(on_event, "final", story=resumed["final"]["story"], scores=resumed["final"]["scores"])
+            return resumed["final"]
+        if resumed["draft"] is not None:
+            story_span.set(resumed=f"iteration {max([0, *resumed['judged'], *resumed['improved']])}")
+            _emit(on_event, "resumed", judged=sorted(resumed["judged"]), improved=sorted(resumed["improved"]))
+
+        library_mode, seed = None, None
+        if library is not None and resumed["draft"] is None:
+            library_mode, seed = library.lookup(user_input, target_score, category)
+        if library_mode == "served":
+            story_span.set(category=seed["category"], library="served", scores=seed["scores"])
+            _emit(on_event, "library", mode="served", similarity=seed["similarity"])
+            _emit(on_event, "final", story=seed["story"], scores=seed["scores"])
+            result = {
+                "story": seed["story"],
+                "category": seed["category"],
+                "evaluations": seed["evaluations"],
+                "scores": seed["scores"],
+                "story_versions": [seed["story"]],
+                "judge_calls_avoided": 0,
+                "stop_reason": None,
+                "library": "served",
+            }
+            await record("final", result=result)
+            return result
+        if library_mode == "seeded":
+            category = seed["category"]
+            story_span.set(library="seeded", seed_id=seed["id"])
+            _emit(on_event, "library", mode="seeded", similarity=seed["similarity"])
+
+        category = category or resumed["category"]
+        if category is None:
+            category = await adetect_story_category(user_input)
+        if resumed["category"] is None:
+            await record("category", category=category)
+        story_span.set(category=category)  # Later stage spans inherit the category
+        _emit(on_event, "category", category=category)
+
+        early_exit_score = target_score if early_exit_judge else None
+
+        def token_sink(stage: str):
+            if not stream_tokens:
+                return None
+            return lambda text: _emit(on_event, "token", stage=stage, text=text)
+
+        judge_calls_avoided = 0
+
+        async def judge(story: str, iteration: int, previous_evaluation: str = None) -> str:
+            nonlocal judge_calls_avoided
+            if safety_prefilter:
+                with tracer.span("safety_prefilter", iteration=iteration) as span:
+                    safety_feedback = prefilter_story(story, category)
+                    span.set(passed=safety_feedback is None)
+                if safety_feedback is not None:
+                    judge_calls_avoided += 1
+                    _emit(on_event, "safety", iteration=iteration)
+                    return safety_feedback
+            if judge_batcher is not None:
+                with tracer.span("judge", iteration=iteration, batched=True) as span:
+                    evaluation = await judge_batcher.judge(story, previous_evaluation)
+                    span.set(score=extract_score_from_evaluation(evaluation))
+                return evaluation
+            return await ajudge_story(story, iteration, previous_evaluation, early_exit_score)
+
+        first_evaluation = None
+        if resumed["draft"] is not None:
+            draft = resumed["draft"]
+            story, first_evaluation = draft["story"], draft["evaluation"]
+            judge_calls_avoided, library_mode = draft["judge_calls_avoided"], draft["library"]
+        elif library_mode == "seeded":
+            story, category = await aadapt_library_story(seed, user_input, on_token=token_sink("draft"))
+            _emit(on_event, "draft", story=story)
+        elif num_drafts > 1:
+            drafts = await agenerate_initial_drafts(user_input, category, num_drafts)
+            if listwise_judge:
+                draft_evaluations, draft_scores, draft_ranking = await ajudge_drafts_listwise(
+                    drafts, category if safety_prefilter else None
+                )
+                judge_calls_avoided += sum(is_safety_feedback(evaluation) for evaluation in draft_evaluations)
+                best_idx = draft_ranking[0]
+            else:
+                draft_evaluations = await asyncio.gather(*(judge(draft, 1) for draft in drafts))
+                draft_scores = [extract_score_from_evaluation(evaluation) for evaluation in draft_evaluations]
+                best_idx = draft_scores.index(max(draft_scores))
+            story, first_evaluation = drafts[best_idx], draft_evaluations[best_idx]
+            _emit(on_event, "draft", story=story, draft_scores=draft_scores)
+        else:
+            story, category = await agenerate_initial_story(user_input, category, on_token=token_sink("draft"))
+            _emit(on_event, "draft", story=story)
+        if resumed["draft"] is None:
+            await record("draft", story=story, evaluation=first_evaluation, judge_calls_avoided=judge_calls_avoided,
+                   library=library_mode)
+
+        evaluations = []
+        scores = []
+        story_versions = [story]
+        checkpoints = []
+        previous_evaluation = None
+        stop_reason = None
+
+        for iteration in range(1, max_iterations + 1):
+            if iteration == 1 and first_evaluation is not None:
+                evaluation = first_evaluation
+            elif iteration in resumed["judged"]:
+                evaluation, avoided = resumed["judged"][iteration]
+                judge_calls_avoided += avoided
+            else:
+                avoided_before = judge_calls_avoided
+                evaluation = await judge(story, iteration, previous_evaluation)
+                await record("judge", iteration=iteration, evaluation=evaluation,
+                       avoided=judge_calls_avoided - avoided_before)
+            score = extract_score_from_evaluation(evaluation)
+            evaluations.append(evaluation)
+            scores.append(score)
+            checkpoints.append(usage())
+            _emit(on_event, "score", iteration=iteration, score=score)
+
+            if score >= target_score:
+                break
+
+            if policy is not None and iteration < max_iterations:
+                stop_reason = policy.should_stop(category, scores, *checkpoints[-1])
+
+            if iteration == max_iterations or stop_reason:
+                # Fall back to the best-scoring version
+                if listwise_judge:
+                    best_score_idx = await arank_versions(story_versions, scores)
+                else:
+                    best_score_idx = scores.index(max(scores))
+                story = story_versions[best_score_idx]
+                break
+
+            previous_evaluation = evaluation
+            if iteration in resumed["improved"]:
+                story = resumed["improved"][iteration]
+            else:
+                story = await aimprove_story(story, evaluation, iteration, on_token=token_sink("improve"),
+                                             targeted=targeted_revision)
+                await record("improve", iteration=iteration, story=story)
+            story_versions.append(story)
+            _emit(on_event, "improved", iteration=iteration, story=story)
+
+        result = {
+            "story": story,
+            "category": category,
+            "evaluations": evaluations,
+            "scores": scores,
+            "story_versions": story_versions,
+            "judge_calls_avoided": judge_calls_avoided,
+            "stop_reason": stop_reason,
+            "library": library_mode,
+        }
+        story_span.set(scores=scores, judge_calls_avoided=judge_calls_avoided, stop_reason=stop_reason)
+        log_trajectory(
+            category, scores,
+            round_tokens=[after[0] - before[0] for before, after in zip(checkpoints, checkpoints[1:])],
+            round_seconds=[after[1] - before[1] for before, after in zip(checkpoints, checkpoints[1:])],
+            target_score=target_score,
+            initial_tokens=checkpoints[0][0] if checkpoints else 0,
+            initial_seconds=checkpoints[0][1] if checkpoints else 0.0,
+        )
+        if library is not None:
+            library.add(user_input, category, story, scores, evaluations,
+                        score=max(score for version, score in zip(story_versions, scores) if version == story))
+        await record("final", result=result)
+        _emit(on_event, "final", story=story, scores=scores)
+        return result
+
+
+async def aapply_user_feedback(story: str, feedback: str, category: str, on_token=None,
+                               targeted: bool = False) -> str:
+    """Async version of apply_user_feedback (without the console output)."""
+    with tracer.span("feedback", category=category) as span:
+        plan = plan_revision(story, feedback) if targeted else None
+        if plan is not None:
+            feedback_intro = f"The reader has requested the following change (keep the {category} story style):"
+            revised_story = await arevise_paragraphs(plan, feedback, feedback_intro, on_token, stage="feedback")
+            if revised_story is not None:
+                span.set(mode="targeted", paragraphs=[index + 1 for index in plan[1]])
+                return revised_story
+        span.set(mode="full")
+        feedback_prompt = build_feedback_prompt(story, feedback, category)
+        if on_token is not None:
+            return await acollect_stream(
+                astream_model(feedback_prompt, max_tokens=600, temperature=0.7, stage="feedback"), on_token
+            )
+        return await acall_model(feedback_prompt, max_tokens=600, temperature=0.7, stage="feedback")
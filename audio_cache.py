@@ -0,0 +1,140 @@
+"""
+Incremental Audio Cache
+Content-addressed, sentence-level cache of synthesized speech, so re-narrating a
+revised story (after improve_story or apply_user_feedback) only synthesizes the
+sentences that actually changed.
+
+Each sentence is keyed by a hash of its normalized text plus engine, voice and
+speed, and stored as one file on disk. The cache is bounded by total size; the
+least recently used segments are evicted first.
+
+get_audio_cache() returns the process-wide cache in $AUDIO_CACHE_DIR (default
+audio_cache), shared by every narration path so revised stories reuse sentences.
+"""
+
+import hashlib
+import json
+import os
+import threading
+import unicodedata
+from pathlib import Path
+
+
+def normalize_sentence(text: str) -> str:
+    """Canonical form of a sentence: NFKC, straight quotes, single spaces."""
+    text = unicodedata.normalize("NFKC", text)
+    text = text.replace("‘", "'").replace("’", "'").replace("“", '"').replace("”", '"')
+    return " ".join(text.split())
+
+
+def make_audio_key(text: str, engine: str, voice: str, speed: float) -> str:
+    """Stable hash of everything that determines a sentence's audio."""
+    payload = json.dumps([normalize_sentence(text), engine, voice, round(float(speed), 3)], ensure_ascii=False)
+    return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+
+class AudioCache:
+    """Size-bounded LRU store of audio segments, one file per sentence."""
+
+    def __init__(self, directory: str = "audio_cache", max_bytes: int = 200 * 1024 * 1024):
+        """
+        Args:
+            directory: Folder holding the cached segments (created if missing)
+            max_bytes: Total size kept before least-recently-used segments are evicted
+        """
+        self.directory = Path(directory)
+        self.directory.mkdir(parents=True, exist_ok=True)
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+        self._bytes = self._scan()[1]  # Running total; the directory is only rescanned to evict
+
+    def _path(self, key: str, audio_format: str) -> Path:
+        return self.directory / f"{key}.{audio_format}"
+
+    def get(self, key: str, audio_format: str):
+        """Return the cached segment bytes, or None on a miss."""
+        path = self._path(key, audio_format)
+        with self._lock:
+            try:
+                data = path.read_bytes()
+            except FileNotFoundError:
+                self.misses += 1
+                return None
+            os.utime(path)  # Mark as recently used
+            self.hits += 1
+            return data
+
+    def put(self, key: str, audio_format: str, data: bytes):
+        """Store a segment atomically and evict old segments over max_bytes."""
+        path = self._path(key, audio_format)
+        temp_path = path.with_suffix(path.suffix + ".tmp")
+        with self._lock:
+            try:
+                replaced = path.stat().st_size
+            except FileNotFoundError:
+                replaced = 0
+            temp_path.write_bytes(data)
+            os.replace(temp_path, path)
+            self._bytes += len(data) - replaced
+            if self._bytes > self.max_bytes:
+                self._evict()
+
+    def _scan(self) -> tuple:
+        """([(mtime, size, path), ...], total bytes) for the segments on disk."""
+        entries = []
+        total = 0
+        for path in self.directory.iterdir():
+            if path.suffix == ".tmp" or not path.is_file():
+                continue
+            stat = path.stat()
+            entries.append((stat.st_mtime, stat.st_size, path))
+            total += stat.st_size
+        return entries, total
+
+    def _evict(self):
+        entries, total = self._scan()
+        for _, size, path in sorted(entries, key=lambda entry: entry[0]):
+            if total <= self.max_bytes:
+                break
+            path.unlink(missing_ok=True)
+            total -= size
+        self._bytes = total
+
+    def stats(self) -> dict:
+        """Hit/miss counters and current size."""
+        with self._lock:
+            sizes = [path.stat().st_size for path in self.directory.iterdir() if path.is_file()]
+        total = self.hits + self.misses
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": round(self.hits / total, 3) if total else 0.0,
+            "entries": len(sizes),
+            "bytes": sum(sizes),
+        }
+
+    def clear(self):
+        """Remove every cached segment and reset the counters."""
+        with self._lock:
+            for path in self.directory.iterdir():
+                if path.is_file():
+                    path.unlink()
+            self._bytes = 0
+        self.hits = 0
+        self.misses = 0
+
+
+_default_cache = None
+_default_cache_lock = threading.Lock()
+
+
+def get_audio_cache() -> AudioCache:
+    """Return the process-wide audio cache ($AUDIO_CACHE_DIR, default audio_cache), creating it on first use."""
+    global _default_cache
+    if _default_cache is None:
+        with _default_cache_lock:
+            if _default_cache is None:
+                _default_cache = AudioCache(os.getenv("AUDIO_CACHE_DIR", "audio_cache"))
+    return _default_cache
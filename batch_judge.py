@@ -0,0 +1,231 @@
+"""
+Listwise Batch Judge
+Scores K candidate stories in a single judge call and ranks them against each
+other, instead of one judge_story call per story.
+
+- Drafts of one request (best-of-N) are judged together, and the ranking picks
+  the winner rather than comparing independently produced scores
+- Close calls between versions from the improve loop can be settled by ranking them
+  side by side
+- JudgeBatcher packs judgements from different concurrent requests into shared
+  calls, so a batch run makes fewer requests under the RPM cap
+
+Each story still gets its own 'Score: X/10 / Strengths / Weaknesses / Suggestions'
+block, so the rest of the pipeline (improve prompts, score tracking) is unchanged.
+"""
+
+import asyncio
+import re
+
+from evaluation_parser import EvaluationParseError, compact_evaluation, parse_score
+from model_router import get_router
+
+# Output tokens budgeted per story in a batch reply
+TOKENS_PER_STORY = 200
+
+BATCH_FORMAT_REMINDER = ("Remember: start every story's block with 'Story N:' followed by 'Score: X/10' "
+                         "on its own line, and finish with the Ranking line.")
+
+STORY_HEADER = re.compile(r"^[\s#*=]*Story\s+(\d+)\b[^\n]*$", re.MULTILINE | re.IGNORECASE)
+RANKING_LINE = re.compile(r"^[\s#*]*Ranking\W*:?(.*)$", re.MULTILINE | re.IGNORECASE)
+
+# Filled in with str.format(): count, stories
+BATCH_JUDGE_PROMPT = """You are a children's literature expert and editor specializing in bedtime stories for ages 5-10.
+
+Evaluate EACH of the following {count} stories independently on these criteria:
+1. Age-appropriateness (vocabulary, themes, content suitable for 5-10 year olds)
+2. Story structure (clear beginning, middle, end with proper story arc)
+3. Engagement (interesting, holds attention, imaginative)
+4. Bedtime suitability (calming tone, not scary or overstimulating)
+5. Length and pacing (appropriate for bedtime reading)
+6. Content safety (NO scary/violent/sad themes inappropriate for bedtime)
+
+⚠️ CRITICAL SCORING RULES - DEDUCT POINTS HEAVILY:
+Any story containing the following should receive a LOW score:
+- Scary, frightening, or nightmare-inducing content (monsters, ghosts, darkness, being lost/alone, shadows, creepy atmosphere)
+- Violence, fighting, weapons, or aggressive behavior (battles, attacks, hitting, kicking)
+- Sad or depressing themes (death, loss, abandonment, loneliness, crying without resolution)
+- Overly stimulating action (explosions, chases, danger, intense conflict, emergencies)
+- Negative emotions as primary theme (fear, anger, jealousy, meanness)
+- Inappropriate moral lessons (lying, stealing, disobedience rewarded)
+
+A bedtime story MUST be calming, positive, and leave the child feeling safe and happy. Deduct at least 5 points for any violation of content safety.
+Where previous feedback is shown, acknowledge whether it was addressed and raise the score if it was.
+
+Stories to evaluate:
+
+{stories}
+
+=== End of stories ===
+
+Provide your evaluation of every story in this format:
+Story N:
+Score: X/10
+Strengths: [list 2-3 specific strengths]
+Weaknesses: [list 2-3 specific areas for improvement]
+Suggestions: [provide concrete, actionable suggestions to improve the story]
+
+Then rank all stories from best to worst on a final line:
+Ranking: [story numbers, best first, e.g. 2, 1, 3]
+
+Evaluations:"""
+
+
+def build_batch_judge_prompt(stories: list, previous_evaluations: list = None) -> str:
+    """
+    Build one judge prompt covering several stories.
+
+    Args:
+        stories: Candidate stories (drafts, versions, or stories from different requests)
+        previous_evaluations: Optional per-story previous feedback (None entries for
+                              stories judged for the first time)
+    """
+    previous_evaluations = previous_evaluations or [None] * len(stories)
+    blocks = []
+    for number, (story, previous) in enumerate(zip(stories, previous_evaluations), start=1):
+        block = f"=== Story {number} ===\n"
+        if previous:
+            block += f"Previous feedback on an earlier version of this story:\n{compact_evaluation(previous)}\n\n"
+        blocks.append(block + story.strip())
+    stories_text = "\n\n".join(blocks)
+
+    return BATCH_JUDGE_PROMPT.format(count=len(stories), stories=stories_text)
+
+
+def batch_max_tokens(count: int) -> int:
+    """Output budget for a batch reply of count stories."""
+    return 40 + TOKENS_PER_STORY * count
+
+
+def rank_by_scores(scores: list) -> list:
+    """0-based indices ordered best first (earlier index wins ties)."""
+    return sorted(range(len(scores)), key=lambda index: -scores[index])
+
+
+def parse_batch_evaluation(reply: str, count: int) -> tuple:
+    """
+    Split a batch reply into per-story evaluations.
+
+    Returns:
+        (evaluations, scores, ranking) - ranking is 0-based story indices, best first;
+        it falls back to score order when the Ranking line is missing or invalid
+
+    Raises:
+        EvaluationParseError: a story block or its score is missing
+    """
+    ranking_match = RANKING_LINE.search(reply)
+    body = reply[:ranking_match.start()] if ranking_match else reply
+
+    headers = list(STORY_HEADER.finditer(body))
+    blocks = {}
+    for header, following in zip(headers, headers[1:] + [None]):
+        end = following.start() if following else len(body)
+        blocks[int(header.group(1))] = body[header.end():end].strip()
+
+    evaluations, scores = [], []
+    for number in range(1, count + 1):
+        if number not in blocks:
+            raise EvaluationParseError(f"batch reply has no block for Story {number}")
+        evaluations.append(blocks[number])
+        scores.append(parse_score(blocks[number]))
+
+    ranking = rank_by_scores(scores)
+    if ranking_match:
+        ranked = [int(number) - 1 for number in re.findall(r"\d+", ranking_match.group(1))]
+        if sorted(ranked) == list(range(count)):
+            ranking = ranked
+    return evaluations, scores, ranking
+
+
+def add_batch_format_reminder(prompt: str) -> str:
+    head, separator, tail = prompt.rpartition("Evaluations:")
+    return f"{head}{BATCH_FORMAT_REMINDER}\n\n{separator}{tail}"
+
+
+def judge_batch(stories: list, previous_evaluations: list = None) -> tuple:
+    """
+    Judge several stories in one call (re-asked once if the reply is malformed).
+
+    Returns:
+        (evaluations, scores, ranking) as from parse_batch_evaluation
+    """
+    prompt = build_batch_judge_prompt(stories, previous_evaluations)
+    max_tokens = batch_max_tokens(len(stories))
+    reply = get_router().complete("judge", prompt, max_tokens=max_tokens, temperature=0.1)
+    try:
+        return parse_batch_evaluation(reply, len(stories))
+    except EvaluationParseError:
+        reply = get_router().complete("judge", add_batch_format_reminder(prompt), max_tokens=max_tokens,
+                                      temperature=0.1)
+        return parse_batch_evaluation(reply, len(stories))
+
+
+async def ajudge_batch(stories: list, previous_evaluations: list = None) -> tuple:
+    """Async version of judge_batch."""
+    prompt = build_batch_judge_prompt(stories, previous_evaluations)
+    max_tokens = batch_max_tokens(len(stories))
+    reply = await get_router().acomplete("judge", prompt, max_tokens=max_tokens, temperature=0.1)
+    try:
+        return parse_batch_evaluation(reply, len(stories))
+    except EvaluationParseError:
+        reply = await get_router().acomplete("judge", add_batch_format_reminder(prompt), max_tokens=max_tokens,
+                                             temperature=0.1)
+        return parse_batch_evaluation(reply, len(stories))
+
+
+class JudgeBatcher:
+    """
+    Collects judge requests from concurrent pipelines and sends them as batch calls.
+
+    A batch is sent when max_batch requests are waiting or max_wait seconds after the
+    first one arrived, whichever comes first. Use one batcher per event loop.
+    """
+
+    def __init__(self, max_batch: int = 4, max_wait: float = 0.05):
+        """
+        Args:
+            max_batch: Stories per judge call
+            max_wait: Longest a request waits for others to share its call
+        """
+        self.max_batch = max_batch
+        self.max_wait = max_wait
+        self.stats = {"calls": 0, "judgements": 0}
+        self._pending = []
+        self._timer = None
+        self._tasks = set()  # The event loop only holds tasks weakly; keep running batches alive
+
+    async def judge(self, story: str, previous_evaluation: str = None) -> str:
+        """Queue one story and return its evaluation once its batch is judged."""
+        loop = asyncio.get_running_loop()
+        future = loop.create_future()
+        self._pending.append((story, previous_evaluation, future))
+        if len(self._pending) >= self.max_batch:
+            self._flush()
+        elif self._timer is None:
+            self._timer = loop.call_later(self.max_wait, self._flush)
+        return await future
+
+    def _flush(self):
+        if self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
+        while self._pending:
+            batch, self._pending = self._pending[:self.max_batch], self._pending[self.max_batch:]
+            task = asyncio.ensure_future(self._run(batch))
+            self._tasks.add(task)
+            task.add_done_callback(self._tasks.discard)
+
+    async def _run(self, batch: list):
+        self.stats["calls"] += 1
+        self.stats["judgements"] += len(batch)
+        try:
+            evaluations, _, _ = await ajudge_batch([story for story, _, _ in batch],
+                                                   [previous for _, previous, _ in batch])
+        except Exception as e:
+            for _, _, future in batch:
+                if not future.done():
+                    future.set_exception(e)
+            return
+        for (_, _, future), evaluation in zip(batch, evaluations):
+            if not future.done():
+                future.set_result(evaluation)
@@ -0,0 +1,269 @@
+"""
+Batch Story Generator
+Runs many story requests concurrently through the async pipeline and streams
+each result to an output JSONL file as soon as it finishes.
+
+Input is a JSONL file with one request per line. Each line needs a story
+request under "request" (or "body"/"prompt"); "request_id", "category" and
+"personalization" (a change applied to this request's copy of the story) are optional.
+
+Requests that are the same after normalization share one pipeline run while it is
+in flight (see single_flight.py); pass --no-dedupe to run every line separately.
+
+Each request's completed stages are logged under --run-dir (see run_log.py).
+Re-running the same command after a crash or kill skips requests already in the
+output file and resumes the others from their last completed stage.
+
+Usage:
+    python batch_stories.py requests.jsonl stories.jsonl --concurrency 16
+"""
+
+import argparse
+import asyncio
+import json
+import time
+
+from async_pipeline import aapply_user_feedback, agenerate_story_with_quality_control
+from batch_judge import JudgeBatcher
+from iteration_policy import AdaptivePolicy
+from model_client import get_client
+from model_router import get_router
+from response_cache import ResponseCache
+from run_log import RunLog
+from single_flight import SingleFlight, agenerate_story_single_flight
+from story_library import open_library
+from tracing import ChromeTraceSink, JsonlSink, tracer
+
+
+def load_requests(input_path: str) -> list:
+    """Read story requests from a JSONL file, assigning ids where missing."""
+    requests = []
+    with open(input_path, encoding="utf-8") as f:
+        for line_number, line in enumerate(f, start=1):
+            line = line.strip()
+            if not line:
+                continue
+            record = json.loads(line)
+            text = record.get("request") or record.get("body") or record.get("prompt")
+            if not text:
+                print(f"⚠ Skipping line {line_number}: no request text")
+                continue
+            requests.append({
+                "request_id": str(record.get("request_id", line_number)),
+                "request": text,
+                "category": record.get("category"),
+                "personalization": record.get("personalization"),
+            })
+    return requests
+
+
+def finished_request_ids(output_path: str) -> set:
+    """Ids of requests already written to output_path without an error."""
+    finished = set()
+    try:
+        with open(output_path, encoding="utf-8") as f:
+            for line in f:
+                try:
+                    record = json.loads(line)
+                except json.JSONDecodeError:
+                    continue  # Torn last line of an interrupted run
+                if "error" not in record:
+                    finished.add(record["request_id"])
+    except FileNotFoundError:
+        pass
+    return finished
+
+
+async def run_batch(input_path: str, output_path: str, concurrency: int = 8,
+                    target_score=8, max_iterations=3, num_drafts=1, early_exit_judge=False,
+                    targeted_revision=False, listwise_judge=False, judge_batch_size=1,
+                    policy=None, dedupe=True, library=None, run_dir=None, resume=True) -> dict:
+    """
+    Generate stories for every request in input_path, at most `concurrency` at once.
+
+    Results are appended to output_path in completion order, one JSON object per line.
+    A failed request is written with an "error" field instead of aborting the batch.
+    With judge_batch_size > 1, judgements from concurrent requests share judge calls.
+    With dedupe, identical requests in flight at the same time share one pipeline run.
+    With a StoryLibrary, similar requests are served from or seeded by stored stories.
+    With a run_dir, every completed stage is logged per request; with resume, requests
+    already in output_path are skipped and the rest continue from their logs.
+
+    Returns:
+        dict summary with counts and wall-clock time
+    """
+    requests = load_requests(input_path)
+    skipped = 0
+    if resume:
+        finished = finished_request_ids(output_path)
+        pending = [item for item in requests if item["request_id"] not in finished]
+        skipped = len(requests) - len(pending)
+        requests = pending
+        if skipped:
+            print(f"⏭ Skipping {skipped} finished request(s)")
+    run_log = RunLog(run_dir) if run_dir else None
+    semaphore = asyncio.Semaphore(concurrency)
+    judge_batcher = JudgeBatcher(max_batch=judge_batch_size) if judge_batch_size > 1 else None
+    write_lock = asyncio.Lock()
+    registry = SingleFlight() if dedupe else None
+    summary = {"total": len(requests) + skipped, "skipped": skipped, "succeeded": 0, "failed": 0, "judge_calls_avoided": 0, "shared": 0,
+               "served_from_library": 0, "seeded_from_library": 0}
+    start = time.perf_counter()
+
+    with open(output_path, "a", encoding="utf-8") as out:
+
+        async def process(item: dict):
+            item_start = time.perf_counter()
+            record = {"request_id": item["request_id"], "request": item["request"]}
+            options = dict(
+                target_score=target_score,
+                max_iterations=max_iterations,
+                category=item["category"],
+                num_drafts=num_drafts,
+                early_exit_judge=early_exit_judge,
+                targeted_revision=targeted_revision,
+                listwise_judge=listwise_judge,
+                judge_batcher=judge_batcher,
+                policy=policy,
+                library=library,
+                request_id=item["request_id"],
+            )
+            if run_log is not None:
+                options["run_log"] = await asyncio.to_thread(run_log.request_log, item["request_id"], item["request"])
+            try:
+                if registry is not None:
+                    result = await agenerate_story_single_flight(
+                        item["request"], item["personalization"], registry, semaphore, **options
+                    )
+                else:
+                    async with semaphore:
+                        result = await agenerate_story_with_quality_control(item["request"], **options)
+                        if item["personalization"]:
+                            # Same per-caller step the single-flight path applies to its copy
+                            result["story"] = await aapply_user_feedback(result["story"], item["personalization"],
+                                                                         result["category"], targeted=True)
+                            result["personalization"] = item["personalization"]
+                record.update(result)
+                summary["succeeded"] += 1
+                if result.get("shared"):
+                    summary["shared"] += 1
+                else:
+                    summary["judge_calls_avoided"] += result["judge_calls_avoided"]
+                    if result["library"]:
+                        summary[f"{result['library']}_from_library"] += 1
+            except Exception as e:
+                record["error"] = f"{type(e).__name__}: {e}"
+                summary["failed"] += 1
+            record["elapsed_seconds"] = round(time.perf_counter() - item_start, 3)
+
+            async with write_lock:
+                out.write(json.dumps(record, ensure_ascii=False) + "\n")
+                out.flush()
+            status = "✓" if "error" not in record else "❌"
+            print(f"{status} [{item['request_id']}] done in {record['elapsed_seconds']}s")
+
+        try:
+            await asyncio.gather(*(process(item) for item in requests))
+        finally:
+            await get_client().aclose()
+
+    summary["elapsed_seconds"] = round(time.perf_counter() - start, 3)
+    if judge_batcher is not None:
+        summary["batched_judge_calls"] = judge_batcher.stats["calls"]
+        summary["batched_judgements"] = judge_batcher.stats["judgements"]
+    return summary
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Generate bedtime stories for a JSONL file of requests.")
+    parser.add_argument("input", help="Input JSONL file of story requests")
+    parser.add_argument("output", help="Output JSONL file (results are appended)")
+    parser.add_argument("--concurrency", type=int, default=8, help="Pipelines to run at once (default: 8)")
+    parser.add_argument("--target-score", type=float, default=8, help="Quality threshold (default: 8)")
+    parser.add_argument("--max-iterations", type=int, default=3, help="Judge/improve rounds (default: 3)")
+    parser.add_argument("--drafts", type=int, default=1, help="Drafts per request judged in parallel, best-of-N (default: 1)")
+    parser.add_argument("--early-exit-judge", action="store_true",
+                        help="Stop judge replies after a passing score instead of paying for the critique")
+    parser.add_argument("--targeted-revision", action="store_true",
+                        help="Rewrite only the paragraphs the judge's feedback refers to")
+    parser.add_argument("--listwise-judge", action="store_true",
+                        help="Judge drafts in one listwise call and rank close versions side by side")
+    parser.add_argument("--judge-batch", type=int, default=1,
+                        help="Pack up to this many judgements from different requests into one call (default: 1)")
+    parser.add_argument("--no-dedupe", action="store_true",
+                        help="Run every request separately, even identical ones in flight at the same time")
+    parser.add_argument("--adaptive", action="store_true",
+                        help="Stop improving when another round isn't worth it (learned from $STORY_TRAJECTORY_LOG)")
+    parser.add_argument("--min-gain-per-1k-tokens", type=float, default=0.3,
+                        help="Adaptive stopping threshold: expected score gain per 1k tokens (default: 0.3)")
+    parser.add_argument("--token-budget", type=int, help="Hard per-story token budget (adaptive mode)")
+    parser.add_argument("--latency-budget", type=float, help="Hard per-story latency budget in seconds (adaptive mode)")
+    parser.add_argument("--trace-jsonl", help="Write per-stage/per-call tracing spans to this JSONL file")
+    parser.add_argument("--trace-chrome", help="Write a Chrome trace-event file (open in chrome://tracing or Perfetto)")
+    parser.add_argument("--library", help="Story library to serve similar requests from and store results in "
+                                          "(default: $STORY_LIBRARY_PATH)")
+    parser.add_argument("--cache", help="SQLite response cache for detection/judge calls (e.g. response_cache.sqlite3)")
+    parser.add_argument("--run-dir", help="Folder for per-request stage logs (default: <output>.runs)")
+    parser.add_argument("--no-resume", action="store_true",
+                        help="Run every request again, ignoring the output file and stage logs")
+    args = parser.parse_args()
+    if args.max_iterations < 1:
+        parser.error("--max-iterations must be at least 1")
+
+    if args.cache:
+        get_client().cache = ResponseCache(args.cache)
+    if args.trace_jsonl:
+        tracer.add_sink(JsonlSink(args.trace_jsonl))
+    if args.trace_chrome:
+        tracer.add_sink(ChromeTraceSink(args.trace_chrome))
+
+    policy = None
+    if args.adaptive:
+        policy = AdaptivePolicy.from_log(
+            min_gain_per_1k_tokens=args.min_gain_per_1k_tokens,
+            token_budget=args.token_budget,
+            latency_budget=args.latency_budget,
+        )
+
+    summary = asyncio.run(run_batch(
+        args.input,
+        args.output,
+        concurrency=args.concurrency,
+        target_score=args.target_score,
+        max_iterations=args.max_iterations,
+        num_drafts=args.drafts,
+        early_exit_judge=args.early_exit_judge,
+        targeted_revision=args.targeted_revision,
+        listwise_judge=args.listwise_judge,
+        judge_batch_size=args.judge_batch,
+        policy=policy,
+        dedupe=not args.no_dedupe,
+        library=open_library(args.library),
+        run_dir=None if args.no_resume else (args.run_dir or args.output + ".runs"),
+        resume=not args.no_resume,
+    ))
+
+    print("\n" + "="*70)
+    print("BATCH SUMMARY")
+    print("="*70)
+    print(f"Requests: {summary['total']}  Succeeded: {summary['succeeded']}  Failed: {summary['failed']}"
+          + (f"  Skipped (already done): {summary['skipped']}" if summary["skipped"] else ""))
+    print(f"Wall-clock time: {summary['elapsed_seconds']}s")
+    print(f"Judge calls avoided by content safety prefilter: {summary['judge_calls_avoided']}")
+    if summary["served_from_library"] or summary["seeded_from_library"]:
+        print(f"Story library: {summary['served_from_library']} served, "
+              f"{summary['seeded_from_library']} adapted from stored stories")
+    if summary["shared"]:
+        print(f"Requests served by an identical in-flight pipeline: {summary['shared']}")
+    if "batched_judge_calls" in summary:
+        print(f"Batched judging: {summary['batched_judgements']} judgements in {summary['batched_judge_calls']} call(s)")
+    decisions = get_router().summary()["decisions"]
+    if decisions:
+        print("Routing: " + ", ".join(f"{key} x{count}" for key, count in decisions.items()))
+    if get_client().cache is not None:
+        cache_stats = get_client().cache.stats()
+        print(f"Cache: {cache_stats['hits']} hits, {cache_stats['misses']} misses ({cache_stats['hit_rate']:.0%} hit rate)")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,206 @@
+"""
+End-to-End Pipeline Benchmark
+Drives generate_story_with_quality_control (threaded) and the async batch pipeline
+against the local mock OpenAI server, and reports latency percentiles, calls and
+tokens per story, and throughput at several concurrency levels.
+
+No API key or network access is needed; nothing is billed.
+
+Usage:
+    python benchmark_pipeline.py --stories 40 --concurrency 1,4,16 --latency-ms 300
+    python benchmark_pipeline.py --mode async --drafts 3 --trajectory 7,8.5 --score-jitter 1
+"""
+
+import argparse
+import asyncio
+import contextlib
+import json
+import os
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import openai
+
+from mock_openai_server import MockConfig, start_mock_server
+from model_client import ModelClient, get_client, set_client
+
+SAMPLE_REQUESTS = [
+    "A peaceful story about a cloud floating gently through the sky",
+    "A child discovers they can speak to fairies in the garden",
+    "A sleepy dragon who can't find his pillow",
+    "Two friends who learn to share their favourite toy",
+    "How the moon helps the ocean make waves",
+    "A brave little turtle on a journey to the sea",
+]
+
+
+def percentile(values: list, pct: float) -> float:
+    """Nearest-rank percentile of a list of numbers."""
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    rank = max(1, int(round(pct / 100 * len(ordered) + 0.5)))
+    return ordered[min(rank, len(ordered)) - 1]
+
+
+def run_threaded(requests: list, concurrency: int, pipeline_kwargs: dict) -> list:
+    """Run the sync pipeline on a thread pool; returns per-story latencies in seconds."""
+    from main_iterative import generate_story_with_quality_control
+
+    def one(request: str) -> float:
+        start = time.perf_counter()
+        generate_story_with_quality_control(request, **pipeline_kwargs)
+        return time.perf_counter() - start
+
+    with open(os.devnull, "w") as devnull, contextlib.redirect_stdout(devnull):
+        with ThreadPoolExecutor(max_workers=concurrency) as pool:
+            return list(pool.map(one, requests))
+
+
+def run_async(requests: list, concurrency: int, pipeline_kwargs: dict, judge_batch_size: int = 1) -> list:
+    """Run the async pipeline under a semaphore; returns per-story latencies in seconds."""
+    from async_pipeline import agenerate_story_with_quality_control
+    from batch_judge import JudgeBatcher
+
+    async def run_all() -> list:
+        semaphore = asyncio.Semaphore(concurrency)
+        if judge_batch_size > 1:
+            pipeline_kwargs["judge_batcher"] = JudgeBatcher(max_batch=judge_batch_size)
+
+        async def one(request: str) -> float:
+            async with semaphore:
+                start = time.perf_counter()
+                await agenerate_story_with_quality_control(request, **pipeline_kwargs)
+                return time.perf_counter() - start
+
+        try:
+            return list(await asyncio.gather(*(one(request) for request in requests)))
+        finally:
+            await get_client().aclose()
+
+    return asyncio.run(run_all())
+
+
+def benchmark(mode: str, num_stories: int, concurrency: int, pipeline_kwargs: dict, client_kwargs: dict,
+              judge_batch_size: int = 1) -> dict:
+    """
+    Run one benchmark configuration with a fresh client and return its metrics.
+
+    judge_batch_size > 1 packs judgements from concurrent stories into shared calls
+    (async mode only).
+    """
+    client = ModelClient(api_key="mock-key", **client_kwargs)
+    set_client(client)
+    requests = [SAMPLE_REQUESTS[i % len(SAMPLE_REQUESTS)] + f" (#{i})" for i in range(num_stories)]
+
+    start = time.perf_counter()
+    if mode == "threaded":
+        latencies = run_threaded(requests, concurrency, pipeline_kwargs)
+    else:
+        latencies = run_async(requests, concurrency, dict(pipeline_kwargs), judge_batch_size)
+    wall = time.perf_counter() - start
+
+    stats = client.stats
+    return {
+        "mode": mode,
+        "concurrency": concurrency,
+        "stories": num_stories,
+        "p50_s": round(percentile(latencies, 50), 3),
+        "p95_s": round(percentile(latencies, 95), 3),
+        "p99_s": round(percentile(latencies, 99), 3),
+        "calls_per_story": round(stats["calls"] / num_stories, 2),
+        "tokens_per_story": round((stats["prompt_tokens"] + stats["completion_tokens"]) / num_stories, 1),
+        "retries": stats["retries"],
+        "stories_per_minute": round(num_stories / wall * 60, 1),
+        "wall_s": round(wall, 2),
+    }
+
+
+def print_table(results: list):
+    columns = ["mode", "concurrency", "p50_s", "p95_s", "p99_s", "calls_per_story",
+               "tokens_per_story", "retries", "stories_per_minute"]
+    print("\n" + "="*100)
+    print("PIPELINE BENCHMARK (mock OpenAI server)")
+    print("="*100)
+    print("  ".join(f"{column:>18}" for column in columns))
+    for row in results:
+        print("  ".join(f"{row[column]!s:>18}" for column in columns))
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the story pipeline against a local mock API.")
+    parser.add_argument("--mode", choices=["threaded", "async", "both"], default="both")
+    parser.add_argument("--stories", type=int, default=24, help="Stories per configuration")
+    parser.add_argument("--concurrency", default="1,4,16", help="Comma-separated concurrency levels")
+    parser.add_argument("--target-score", type=float, default=8)
+    parser.add_argument("--max-iterations", type=int, default=3)
+    parser.add_argument("--drafts", type=int, default=1)
+    parser.add_argument("--early-exit-judge", action="store_true")
+    parser.add_argument("--targeted-revision", action="store_true")
+    parser.add_argument("--listwise-judge", action="store_true")
+    parser.add_argument("--judge-batch", type=int, default=1, help="Judgements per shared call (async mode)")
+    parser.add_argument("--rpm", type=float, default=3500, help="Client requests-per-minute limit")
+    parser.add_argument("--tpm", type=float, default=90000, help="Client tokens-per-minute limit")
+    # Mock server behaviour
+    parser.add_argument("--latency-ms", type=float, default=300.0)
+    parser.add_argument("--latency-sigma", type=float, default=0.5)
+    parser.add_argument("--tokens-per-second", type=float, default=400.0)
+    parser.add_argument("--error-rate", type=float, default=0.0)
+    parser.add_argument("--rate-limit-rate", type=float, default=0.0)
+    parser.add_argument("--trajectory", default="6.5,7.5,8.5")
+    parser.add_argument("--score-jitter", type=float, default=0.0)
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--json", help="Also write results to this JSONL file")
+    args = parser.parse_args()
+
+    config = MockConfig(
+        latency_ms=args.latency_ms,
+        latency_sigma=args.latency_sigma,
+        tokens_per_second=args.tokens_per_second,
+        error_rate=args.error_rate,
+        rate_limit_rate=args.rate_limit_rate,
+        trajectory=[float(score) for score in args.trajectory.split(",")],
+        score_jitter=args.score_jitter,
+        seed=args.seed,
+    )
+    server, api_base = start_mock_server(config)
+    openai.api_base = api_base
+
+    pipeline_kwargs = {
+        "target_score": args.target_score,
+        "max_iterations": args.max_iterations,
+        "num_drafts": args.drafts,
+        "early_exit_judge": args.early_exit_judge,
+        "targeted_revision": args.targeted_revision,
+        "listwise_judge": args.listwise_judge,
+    }
+    client_kwargs = {
+        "requests_per_minute": args.rpm,
+        "tokens_per_minute": args.tpm,
+        "base_delay": 0.05,
+        "max_delay": 1.0,
+    }
+    modes = ["threaded", "async"] if args.mode == "both" else [args.mode]
+
+    results = []
+    try:
+        for mode in modes:
+            for concurrency in [int(level) for level in args.concurrency.split(",")]:
+                results.append(benchmark(mode, args.stories, concurrency, pipeline_kwargs, client_kwargs,
+                                         judge_batch_size=args.judge_batch))
+                print(f"✓ {mode} @ concurrency {concurrency}: {results[-1]['stories_per_minute']} stories/min")
+    finally:
+        server.shutdown()
+
+    print_table(results)
+    print(f"\nMock server: {config.counters['requests']} requests, "
+          f"{config.counters['rate_limited']} rate-limited, {config.counters['errors']} errors injected")
+
+    if args.json:
+        with open(args.json, "a", encoding="utf-8") as f:
+            for row in results:
+                f.write(json.dumps(row) + "\n")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,136 @@
+"""
+Startup Benchmark
+Measures cold-start cost: how long a fresh interpreter takes to import each
+entry-point module, and to answer "story_cli.py --help".
+
+- Every measurement runs in a new subprocess (no warm module cache), repeated
+  --repeats times; the median is reported
+- Flags heavy optional modules (openai, gtts, pyttsx3) that an import pulled in:
+  they should only load on the first model call / narration
+- --history appends one JSON line per run, so cold start can be tracked over time
+
+Usage:
+    python benchmark_startup.py
+    python benchmark_startup.py --repeats 10 --history startup_history.jsonl
+"""
+
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+import time
+
+# Modules a user or script starts from
+ENTRY_MODULES = ["main_iterative", "async_pipeline", "batch_stories", "staged_batch", "story_server", "story_cli"]
+
+# Modules that should stay unloaded until they are actually used
+HEAVY_MODULES = ["openai", "gtts", "pyttsx3"]
+
+# Run in the child: time the import, then report which heavy modules came with it
+IMPORT_PROBE = """
+import json, sys, time
+start = time.perf_counter()
+import {module}
+elapsed = time.perf_counter() - start
+print(json.dumps({{"seconds": elapsed, "loaded": [name for name in {heavy!r} if name in sys.modules]}}))
+"""
+
+
+def measure_import(module: str) -> dict:
+    """Import module in a fresh interpreter; returns {"seconds", "loaded"}."""
+    completed = subprocess.run([sys.executable, "-c", IMPORT_PROBE.format(module=module, heavy=HEAVY_MODULES)],
+                               capture_output=True, text=True)
+    if completed.returncode != 0:
+        error = completed.stderr.strip().splitlines()
+        raise RuntimeError(f"importing {module} failed: {error[-1] if error else completed.returncode}")
+    return json.loads(completed.stdout.strip().splitlines()[-1])
+
+
+def measure_command(command: list) -> float:
+    """Wall time of a whole process (interpreter start included)."""
+    start = time.perf_counter()
+    subprocess.run(command, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL, check=True)
+    return time.perf_counter() - start
+
+
+def run_benchmark(modules: list = None, repeats: int = 5) -> dict:
+    """
+    Measure every entry module plus the bare interpreter and the CLI's --help.
+
+    Returns:
+        {"imports": {module: {"median_ms", "min_ms", "loaded"}}, "commands": {label: {"median_ms", "min_ms"}}}
+    """
+    results = {"imports": {}, "commands": {}}
+    for module in modules or ENTRY_MODULES:
+        runs = [measure_import(module) for _ in range(repeats)]
+        seconds = [run["seconds"] for run in runs]
+        results["imports"][module] = {
+            "median_ms": round(statistics.median(seconds) * 1000, 1),
+            "min_ms": round(min(seconds) * 1000, 1),
+            "loaded": sorted({name for run in runs for name in run["loaded"]}),
+        }
+
+    commands = {
+        "python -c pass": [sys.executable, "-c", "pass"],
+        "story_cli.py --help": [sys.executable, "story_cli.py", "--help"],
+    }
+    for label, command in commands.items():
+        seconds = [measure_command(command) for _ in range(repeats)]
+        results["commands"][label] = {
+            "median_ms": round(statistics.median(seconds) * 1000, 1),
+            "min_ms": round(min(seconds) * 1000, 1),
+        }
+    return results
+
+
+def print_report(results: dict, repeats: int):
+    print("\n" + "="*70)
+    print(f"⏱  STARTUP BENCHMARK (median of {repeats} fresh interpreters)")
+    print("="*70)
+    print(f"{'Import':<24}{'median':>10}{'min':>10}   heavy modules loaded")
+    for module, stats in results["imports"].items():
+        loaded = ", ".join(stats["loaded"]) or "-"
+        print(f"{module:<24}{stats['median_ms']:>8.1f}ms{stats['min_ms']:>8.1f}ms   {loaded}")
+    print("-"*70)
+    print(f"{'Process':<24}{'median':>10}{'min':>10}")
+    for label, stats in results["commands"].items():
+        print(f"{label:<24}{stats['median_ms']:>8.1f}ms{stats['min_ms']:>8.1f}ms")
+    print("="*70)
+
+    eager = [module for module, stats in results["imports"].items() if stats["loaded"]]
+    if eager:
+        print(f"⚠ Heavy modules imported at startup by: {', '.join(eager)}")
+    else:
+        print(f"✓ No entry module imports {', '.join(HEAVY_MODULES)} at startup")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Measure cold import/startup time of the story entry points.")
+    parser.add_argument("--repeats", type=int, default=5, help="Fresh interpreters per measurement (default: 5)")
+    parser.add_argument("--modules", nargs="+", help=f"Modules to import (default: {' '.join(ENTRY_MODULES)})")
+    parser.add_argument("--history", help="Append this run's results as a JSON line to this file")
+    parser.add_argument("--json", action="store_true", help="Print the results as JSON instead of a table")
+    args = parser.parse_args()
+
+    history = os.path.abspath(args.history) if args.history else None
+    # Children import from this folder, whatever the caller's working directory
+    os.chdir(os.path.dirname(os.path.abspath(__file__)))
+    results = run_benchmark(args.modules, max(1, args.repeats))
+
+    if args.json:
+        print(json.dumps(results, indent=2))
+    else:
+        print_report(results, max(1, args.repeats))
+
+    if history:
+        entry = {"timestamp": time.strftime("%Y-%m-%dT%H:%M:%S"), "python": sys.version.split()[0],
+                 "repeats": args.repeats, **results}
+        with open(history, "a", encoding="utf-8") as f:
+            f.write(json.dumps(entry) + "\n")
+        print(f"📝 Appended to {args.history}")
+
+
+if __name__ == "__main__":
+    main()
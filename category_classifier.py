@@ -0,0 +1,313 @@
+"""
+Local Story Category Classifier
+Predicts the story category (adventure, educational, calming, fantasy, friendship)
+locally in microseconds, so detect_story_category only needs the LLM round-trip
+when the classifier isn't confident.
+
+The model is a multinomial naive Bayes over request words, seeded with a keyword
+lexicon and optionally trained on logged (request, category) pairs. Set
+CATEGORY_LOG_PATH to record the LLM's labels as training data.
+
+Requests the classifier is confident about never reach the LLM, so their labels
+would be missing from the log. CATEGORY_SHADOW_RATE sends that fraction of them
+to the LLM as well and logs both labels, so evaluate() also measures agreement
+on the requests actually served locally. CATEGORY_CONFIDENCE_THRESHOLD sets the
+confidence needed to answer locally (default 0.7).
+
+Usage:
+    python category_classifier.py train category_labels.jsonl --out category_model.json
+    python category_classifier.py evaluate category_labels.jsonl --model category_model.json
+"""
+
+import argparse
+import json
+import math
+import os
+import random
+import re
+import time
+
+CATEGORIES = ['adventure', 'educational', 'calming', 'fantasy', 'friendship']
+
+# Confidence needed to skip the LLM call, unless $CATEGORY_CONFIDENCE_THRESHOLD says otherwise
+DEFAULT_CONFIDENCE_THRESHOLD = 0.7
+
+CATEGORY_LEXICON = {
+    'adventure': [
+        'adventure', 'quest', 'journey', 'explore', 'explorer', 'treasure', 'map', 'pirate',
+        'voyage', 'expedition', 'brave', 'hero', 'mountain', 'jungle', 'rocket', 'space',
+        'island', 'discover', 'search', 'climb', 'race', 'ship', 'sail', 'mission',
+    ],
+    'educational': [
+        'learn', 'learning', 'teach', 'lesson', 'school', 'science', 'math', 'number',
+        'count', 'counting', 'letter', 'alphabet', 'planet', 'solar', 'weather', 'animal',
+        'fact', 'history', 'how', 'why', 'work', 'grow', 'color', 'shape', 'recycle',
+    ],
+    'calming': [
+        'calm', 'calming', 'peaceful', 'gentle', 'quiet', 'sleepy', 'sleep', 'soothing',
+        'relax', 'relaxing', 'soft', 'cloud', 'float', 'floating', 'breeze', 'lullaby',
+        'rain', 'ocean', 'moon', 'star', 'night', 'dream', 'cozy', 'slow', 'drift',
+    ],
+    'fantasy': [
+        'magic', 'magical', 'fairy', 'fairies', 'dragon', 'unicorn', 'wizard', 'witch',
+        'spell', 'enchanted', 'castle', 'princess', 'prince', 'kingdom', 'mermaid', 'elf',
+        'giant', 'potion', 'wand', 'talking', 'mythical', 'fantasy', 'pixie', 'troll',
+    ],
+    'friendship': [
+        'friend', 'friendship', 'together', 'share', 'sharing', 'kind', 'kindness',
+        'help', 'helping', 'team', 'teamwork', 'buddy', 'sibling', 'sister', 'brother',
+        'neighbor', 'lonely', 'welcome', 'new', 'play', 'care', 'caring', 'forgive',
+    ],
+}
+
+STOP_WORDS = {
+    'a', 'an', 'the', 'about', 'of', 'and', 'or', 'to', 'in', 'on', 'at', 'for', 'with',
+    'who', 'that', 'is', 'are', 'was', 'be', 'story', 'tale', 'me', 'my', 'i', 'want',
+    'please', 'tell', 'write', 'some', 'their', 'his', 'her', 'they', 'it', 'its', 'can',
+}
+
+TOKEN_PATTERN = re.compile(r"[a-z]+")
+
+
+def tokenize(text: str) -> list:
+    """Lowercase word tokens with stop words removed and plural 's' stripped."""
+    tokens = []
+    for word in TOKEN_PATTERN.findall(text.lower()):
+        if word in STOP_WORDS:
+            continue
+        if len(word) > 3 and word.endswith('s') and not word.endswith('ss'):
+            word = word[:-1]
+        tokens.append(word)
+    return tokens
+
+
+class CategoryClassifier:
+    """Multinomial naive Bayes classifier seeded with CATEGORY_LEXICON."""
+
+    def __init__(self, alpha: float = 1.0, lexicon_weight: float = 8.0):
+        """
+        Args:
+            alpha: Laplace smoothing constant
+            lexicon_weight: Pseudo-count given to each lexicon keyword for its category
+        """
+        self.alpha = alpha
+        self.lexicon_weight = lexicon_weight
+        self.word_counts = {category: {} for category in CATEGORIES}
+        self.doc_counts = {category: 0 for category in CATEGORIES}
+        for category, words in CATEGORY_LEXICON.items():
+            for word in words:
+                for token in tokenize(word):
+                    self._add(category, token, lexicon_weight)
+        self._refresh()
+
+    def _add(self, category: str, token: str, weight: float):
+        counts = self.word_counts[category]
+        counts[token] = counts.get(token, 0) + weight
+
+    def _refresh(self):
+        """Precompute log-probabilities so predict() is a handful of dict lookups."""
+        vocab = set()
+        for counts in self.word_counts.values():
+            vocab.update(counts)
+        self.vocab_size = max(len(vocab), 1)
+        total_docs = sum(self.doc_counts.values())
+        self.log_priors = {}
+        self.log_likelihoods = {}
+        self.log_unseen = {}
+        for category in CATEGORIES:
+            # Uniform prior until there are logged examples to learn from
+            docs = self.doc_counts[category]
+            self.log_priors[category] = math.log((docs + 1) / (total_docs + len(CATEGORIES)))
+            counts = self.word_counts[category]
+            denominator = sum(counts.values()) + self.alpha * self.vocab_size
+            self.log_likelihoods[category] = {
+                word: math.log((count + self.alpha) / denominator) for word, count in counts.items()
+            }
+            self.log_unseen[category] = math.log(self.alpha / denominator)
+        self.vocab = vocab
+
+    def train(self, examples: list):
+        """Add (request_text, category) examples, e.g. from a CATEGORY_LOG_PATH log."""
+        for text, category in examples:
+            if category not in self.word_counts:
+                continue
+            self.doc_counts[category] += 1
+            for token in tokenize(text):
+                self._add(category, token, 1.0)
+        self._refresh()
+
+    def predict(self, text: str) -> tuple:
+        """Return (category, confidence), where confidence is the posterior of the top category."""
+        tokens = [token for token in tokenize(text) if token in self.vocab]
+        scores = {}
+        for category in CATEGORIES:
+            likelihoods = self.log_likelihoods[category]
+            unseen = self.log_unseen[category]
+            scores[category] = self.log_priors[category] + sum(likelihoods.get(t, unseen) for t in tokens)
+        best = max(scores, key=scores.get)
+        top = scores[best]
+        normalizer = sum(math.exp(score - top) for score in scores.values())
+        return best, 1.0 / normalizer
+
+    def to_dict(self) -> dict:
+        return {
+            "alpha": self.alpha,
+            "lexicon_weight": self.lexicon_weight,
+            "word_counts": self.word_counts,
+            "doc_counts": self.doc_counts,
+        }
+
+    @classmethod
+    def from_dict(cls, data: dict) -> "CategoryClassifier":
+        classifier = cls(alpha=data["alpha"], lexicon_weight=data["lexicon_weight"])
+        classifier.word_counts = {c: dict(data["word_counts"].get(c, {})) for c in CATEGORIES}
+        classifier.doc_counts = {c: data["doc_counts"].get(c, 0) for c in CATEGORIES}
+        classifier._refresh()
+        return classifier
+
+    def save(self, path: str):
+        with open(path, "w", encoding="utf-8") as f:
+            json.dump(self.to_dict(), f)
+
+    @classmethod
+    def load(cls, path: str) -> "CategoryClassifier":
+        with open(path, encoding="utf-8") as f:
+            return cls.from_dict(json.load(f))
+
+
+_default_classifier = None
+
+
+def get_classifier() -> CategoryClassifier:
+    """Return the shared classifier, loading $CATEGORY_MODEL_PATH if it exists."""
+    global _default_classifier
+    if _default_classifier is None:
+        model_path = os.getenv("CATEGORY_MODEL_PATH", "category_model.json")
+        if os.path.exists(model_path):
+            _default_classifier = CategoryClassifier.load(model_path)
+        else:
+            _default_classifier = CategoryClassifier()
+    return _default_classifier
+
+
+def confidence_threshold() -> float:
+    """Local confidence needed to skip the LLM ($CATEGORY_CONFIDENCE_THRESHOLD, above 1.0 = always ask)."""
+    return float(os.getenv("CATEGORY_CONFIDENCE_THRESHOLD", DEFAULT_CONFIDENCE_THRESHOLD))
+
+
+def shadow_rate() -> float:
+    """Fraction of confident predictions also labelled by the LLM ($CATEGORY_SHADOW_RATE, default 0)."""
+    return float(os.getenv("CATEGORY_SHADOW_RATE", 0.0))
+
+
+def should_shadow(rate: float = None) -> bool:
+    """Whether this confident prediction is sampled for an LLM label."""
+    rate = shadow_rate() if rate is None else rate
+    return rate > 0 and random.random() < rate
+
+
+def log_category_label(user_input: str, category: str, latency_seconds: float, local_category: str = None,
+                       confidence: float = None, shadow_sample_rate: float = None):
+    """
+    Append an LLM-labelled example to $CATEGORY_LOG_PATH (no-op when unset).
+
+    local_category/confidence record the classifier's answer next to the LLM's;
+    shadow_sample_rate marks a sampled confident prediction (evaluate() weights it by 1/rate).
+    """
+    log_path = os.getenv("CATEGORY_LOG_PATH")
+    if not log_path:
+        return
+    record = {"request": user_input, "category": category, "latency_seconds": round(latency_seconds, 4)}
+    if local_category is not None:
+        record.update(local_category=local_category, confidence=round(confidence, 4))
+    if shadow_sample_rate is not None:
+        record["shadow_rate"] = shadow_sample_rate
+    with open(log_path, "a", encoding="utf-8") as f:
+        f.write(json.dumps(record, ensure_ascii=False) + "\n")
+
+
+def load_labels(path: str) -> list:
+    """Read {"request", "category"[, "latency_seconds"]} records from a JSONL file."""
+    with open(path, encoding="utf-8") as f:
+        return [json.loads(line) for line in f if line.strip()]
+
+
+def evaluate(classifier: CategoryClassifier, labels: list, threshold: float = DEFAULT_CONFIDENCE_THRESHOLD) -> dict:
+    """
+    Compare the classifier against LLM labels.
+
+    Shadow-sampled records stand for 1/shadow_rate confident requests each, so
+    agreement and coverage reflect the live traffic mix.
+
+    Returns:
+        dict with overall agreement, agreement and coverage above the confidence
+        threshold, mean local latency, the LLM latency saved per request and the
+        number of shadow-sampled examples
+    """
+    total = agree = confident = confident_agree = 0.0
+    local_seconds = 0.0
+    saved_seconds = 0.0
+    shadow = 0
+    for record in labels:
+        start = time.perf_counter()
+        category, confidence = classifier.predict(record["request"])
+        local_seconds += time.perf_counter() - start
+        weight = 1.0 / record["shadow_rate"] if record.get("shadow_rate") else 1.0
+        shadow += "shadow_rate" in record
+        total += weight
+        agree += weight * (category == record["category"])
+        if confidence >= threshold:
+            confident += weight
+            confident_agree += weight * (category == record["category"])
+            saved_seconds += weight * record.get("latency_seconds", 0.0)
+
+    total = total or 1.0
+    return {
+        "examples": len(labels),
+        "shadow_examples": shadow,
+        "agreement": agree / total,
+        "coverage": confident / total,
+        "confident_agreement": confident_agree / confident if confident else 0.0,
+        "local_latency_us": local_seconds / max(len(labels), 1) * 1e6,
+        "llm_seconds_saved_per_request": saved_seconds / total,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Train or evaluate the local story category classifier.")
+    sub = parser.add_subparsers(dest="command", required=True)
+
+    train_parser = sub.add_parser("train", help="Train from a JSONL file of LLM-labelled requests")
+    train_parser.add_argument("labels")
+    train_parser.add_argument("--out", default="category_model.json")
+
+    eval_parser = sub.add_parser("evaluate", help="Report agreement with LLM labels and latency saved")
+    eval_parser.add_argument("labels")
+    eval_parser.add_argument("--model", help="Trained model JSON (default: lexicon only)")
+    eval_parser.add_argument("--threshold", type=float, default=confidence_threshold())
+    args = parser.parse_args()
+
+    labels = load_labels(args.labels)
+
+    if args.command == "train":
+        classifier = CategoryClassifier()
+        classifier.train([(r["request"], r["category"]) for r in labels])
+        classifier.save(args.out)
+        print(f"✅ Trained on {len(labels)} examples, saved to {args.out}")
+        return
+
+    classifier = CategoryClassifier.load(args.model) if args.model else CategoryClassifier()
+    report = evaluate(classifier, labels, args.threshold)
+    print("\n" + "="*70)
+    print("CATEGORY CLASSIFIER EVALUATION")
+    print("="*70)
+    print(f"Examples: {report['examples']} ({report['shadow_examples']} shadow-sampled confident predictions)")
+    print(f"Agreement with LLM (all requests): {report['agreement']:.1%}")
+    print(f"Served locally at confidence >= {args.threshold}: {report['coverage']:.1%}")
+    print(f"Agreement on locally served requests: {report['confident_agreement']:.1%}")
+    print(f"Local latency: {report['local_latency_us']:.1f} µs per request")
+    print(f"LLM latency saved: {report['llm_seconds_saved_per_request'] * 1000:.0f} ms per request")
+
+
+if __name__ == "__main__":
+    main()
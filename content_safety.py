@@ -0,0 +1,191 @@
+"""
+Offline Content-Safety Prefilter
+Scans drafts for the themes the judge prompt bans (monsters, ghosts, weapons,
+battles, death, explosions, ...) before any judge call is made.
+
+Matching uses an Aho-Corasick automaton, so a scan is a single pass over the
+story regardless of how many terms are in the lexicon. Hard violations skip the
+judge entirely: the pipeline sends structured feedback straight to improve_story.
+Soft matches are reported but still go to the judge, which can weigh context.
+"""
+
+from collections import deque
+
+HARD = "hard"
+SOFT = "soft"
+
+# Mirrors the CRITICAL SCORING RULES in the judge prompt
+BASE_LEXICON = {
+    # Scary / nightmare-inducing
+    "monster": HARD, "ghost": HARD, "zombie": HARD, "skeleton": HARD, "demon": HARD,
+    "nightmare": HARD, "haunted": HARD, "creepy": HARD, "terrifying": HARD, "horror": HARD,
+    "scary": SOFT, "shadow": SOFT, "darkness": SOFT, "lost": SOFT, "alone": SOFT,
+    # Violence / weapons
+    "weapon": HARD, "gun": HARD, "sword": HARD, "knife": HARD, "blood": HARD, "bloody": HARD,
+    "kill": HARD, "killed": HARD, "battle": HARD, "war": HARD, "attack": HARD, "attacked": HARD,
+    "fight": SOFT, "fighting": SOFT, "hit": SOFT, "hitting": SOFT, "kick": SOFT, "kicking": SOFT,
+    "punch": HARD,
+    # Sad / depressing
+    "death": HARD, "dead": HARD, "die": HARD, "died": HARD, "dying": HARD, "funeral": HARD,
+    "abandoned": SOFT, "lonely": SOFT, "loneliness": SOFT, "crying": SOFT, "sobbing": SOFT,
+    # Overstimulating
+    "explosion": HARD, "explode": HARD, "exploded": HARD, "emergency": SOFT,
+    "chase": SOFT, "chased": SOFT, "chasing": SOFT, "danger": SOFT, "dangerous": SOFT,
+    # Negative emotions / bad lessons
+    "fear": SOFT, "terrified": HARD, "angry": SOFT, "jealous": SOFT, "mean": SOFT,
+    "lying": SOFT, "stealing": SOFT, "stole": SOFT,
+}
+
+# Per-category adjustments: "allow" drops terms, anything else overrides severity
+CATEGORY_LEXICONS = {
+    "adventure": {"allow": ["lost", "danger", "chase", "chased", "chasing"]},
+    "educational": {"allow": ["die", "died", "dead"]},  # e.g. life cycles of plants and leaves
+    "calming": {"chase": HARD, "chased": HARD, "chasing": HARD, "danger": HARD, "dangerous": HARD,
+                "scary": HARD, "emergency": HARD},
+    "fantasy": {"allow": ["shadow"]},
+    "friendship": {"allow": ["lonely", "loneliness", "alone"]},  # making a new friend often starts here
+}
+
+PLURAL_SUFFIXES = ("s", "es")
+
+SAFETY_FEEDBACK_SOURCE = "Source: Content Safety Prefilter (automatic check, no judge call)"
+
+
+def build_lexicon(category: str = None) -> dict:
+    """Return the term -> severity lexicon for a category."""
+    lexicon = dict(BASE_LEXICON)
+    overrides = CATEGORY_LEXICONS.get(category, {})
+    for term in overrides.get("allow", []):
+        lexicon.pop(term, None)
+    for term, severity in overrides.items():
+        if term != "allow":
+            lexicon[term] = severity
+    return lexicon
+
+
+class AhoCorasick:
+    """Multi-pattern matcher over lowercase text; reports whole-word matches only."""
+
+    def __init__(self, terms: dict):
+        """
+        Args:
+            terms: Mapping of pattern -> payload returned with each match
+        """
+        self.goto = [{}]
+        self.fail = [0]
+        self.output = [[]]
+        for term, payload in terms.items():
+            self._insert(term.lower(), payload)
+        self._build_failure_links()
+
+    def _insert(self, term: str, payload):
+        node = 0
+        for char in term:
+            if char not in self.goto[node]:
+                self.goto.append({})
+                self.fail.append(0)
+                self.output.append([])
+                self.goto[node][char] = len(self.goto) - 1
+            node = self.goto[node][char]
+        self.output[node].append((term, payload))
+
+    def _build_failure_links(self):
+        queue = deque(self.goto[0].values())
+        while queue:
+            node = queue.popleft()
+            for char, child in self.goto[node].items():
+                queue.append(child)
+                fallback = self.fail[node]
+                while fallback and char not in self.goto[fallback]:
+                    fallback = self.fail[fallback]
+                self.fail[child] = self.goto[fallback].get(char, 0)
+                if self.fail[child] == child:
+                    self.fail[child] = 0
+                self.output[child] = self.output[child] + self.output[self.fail[child]]
+
+    def find_all(self, text: str) -> list:
+        """Return (start, term, payload) for every whole-word occurrence in text."""
+        text = text.lower()
+        matches = []
+        node = 0
+        for index, char in enumerate(text):
+            while node and char not in self.goto[node]:
+                node = self.fail[node]
+            node = self.goto[node].get(char, 0)
+            for term, payload in self.output[node]:
+                start = index - len(term) + 1
+                before = text[start - 1] if start > 0 else " "
+                after = text[index + 1] if index + 1 < len(text) else " "
+                if not before.isalpha() and not after.isalpha():
+                    matches.append((start, term, payload))
+        return matches
+
+
+_scanners = {}
+
+
+def get_scanner(category: str = None) -> AhoCorasick:
+    """Return the compiled automaton for a category (built once and reused)."""
+    if category not in _scanners:
+        terms = {}
+        for term, severity in build_lexicon(category).items():
+            terms[term] = (term, severity)
+            for suffix in PLURAL_SUFFIXES:
+                terms.setdefault(term + suffix, (term, severity))
+        _scanners[category] = AhoCorasick(terms)
+    return _scanners[category]
+
+
+def scan_story(story: str, category: str = None) -> dict:
+    """
+    Scan a story for banned themes.
+
+    Returns:
+        dict with "hard" and "soft" lists of distinct matched terms (in order of first
+        appearance) and "matches", a list of (position, term, severity) tuples
+    """
+    report = {HARD: [], SOFT: [], "matches": []}
+    for start, _, (term, severity) in get_scanner(category).find_all(story):
+        report["matches"].append((start, term, severity))
+        if term not in report[severity]:
+            report[severity].append(term)
+    return report
+
+
+def build_safety_feedback(report: dict, score: float = 3.0) -> str:
+    """
+    Turn a scan report into judge-style feedback for improve_story.
+
+    Uses the judge's 'Score: X/10' format so score tracking and the improvement
+    prompt work unchanged; the low score reflects the judge's rule of deducting
+    at least 5 points for any content-safety violation.
+    """
+    hard_terms = ", ".join(f'"{term}"' for term in report[HARD])
+    lines = [
+        f"Score: {score:g}/10",
+        SAFETY_FEEDBACK_SOURCE,
+        "Strengths: [not evaluated - the story failed the content safety check]",
+        f"Weaknesses: The story contains content that is not suitable for bedtime: {hard_terms}.",
+    ]
+    if report[SOFT]:
+        soft_terms = ", ".join(f'"{term}"' for term in report[SOFT])
+        lines.append(f"Also review these potentially unsettling words: {soft_terms}.")
+    lines.append(
+        "Suggestions: Remove or replace every flagged element with gentle, comforting alternatives "
+        "(e.g. a friendly creature instead of a monster, a soft glow instead of darkness), keep the "
+        "plot and characters that work, and make sure the ending feels safe and peaceful."
+    )
+    return "\n".join(lines)
+
+
+def is_safety_feedback(evaluation: str) -> bool:
+    """True if an evaluation came from the prefilter rather than the judge."""
+    return SAFETY_FEEDBACK_SOURCE in evaluation
+
+
+def prefilter_story(story: str, category: str = None):
+    """Return safety feedback if the story has hard violations, otherwise None (send it to the judge)."""
+    report = scan_story(story, category)
+    if report[HARD]:
+        return build_safety_feedback(report)
+    return None
@@ -0,0 +1,152 @@
+"""
+Structured Evaluation Parsing
+Turns the judge's free-text evaluation into a compact record (score, per-criterion
+notes, strengths, weaknesses, suggestions, improvements made) and renders the
+fields the next prompt actually needs under a token budget.
+
+Parsing is strict about the one thing the control loop depends on: a missing or
+out-of-range score raises EvaluationParseError instead of silently becoming 5/10.
+Compact renderings always keep the 'Score: X/10' line, since the comparative judge
+prompt (and the mock server) read the previous score from it.
+"""
+
+import re
+
+from model_client import estimate_tokens
+
+# Default size of the feedback block in comparative-judge and improvement prompts
+FEEDBACK_TOKEN_BUDGET = 150
+
+# Accepts 'Score: 7/10', '**Score:** 8.5/10', 'Score: 9 / 10' and 'Score: 7 out of 10'
+SCORE_PATTERN = re.compile(r'Score\W{0,4}:\W{0,4}(\d+(?:\.\d+)?)\s*(?:/|out of)\s*10', re.IGNORECASE)
+
+CRITERIA = [
+    "age-appropriateness", "story structure", "engagement",
+    "bedtime suitability", "length and pacing", "content safety",
+]
+
+SECTION_FIELDS = {
+    "strengths": "strengths",
+    "weaknesses": "weaknesses",
+    "suggestions": "suggestions",
+    "improvements made": "improvements",
+    "improvements": "improvements",
+}
+
+SECTION_HEADER = re.compile(r"^[\s\-*#]*([A-Za-z][A-Za-z\- ]{2,40}?)\s*\**\s*:\**\s*(.*)$")
+ITEM_BULLET = re.compile(r"^\s*(?:[-*•]|\d+[.)])\s+")
+
+STRICT_FORMAT_REMINDER = "Remember: the first line of your reply must be exactly 'Score: X/10'."
+
+
+class EvaluationParseError(ValueError):
+    """The judge's reply has no usable score."""
+
+
+def parse_score(evaluation: str) -> float:
+    """Return the evaluation's score, or raise EvaluationParseError if it is missing or out of range."""
+    match = SCORE_PATTERN.search(evaluation)
+    if match is None:
+        raise EvaluationParseError(f"no 'Score: X/10' line in evaluation: {evaluation[:120]!r}")
+    score = float(match.group(1))
+    if not 0 <= score <= 10:
+        raise EvaluationParseError(f"score {score:g} is outside 0-10")
+    return score
+
+
+def split_items(text: str) -> list:
+    """Split a section body into items: bullet lines, or semicolon/sentence-separated phrases."""
+    lines = [line for line in text.splitlines() if line.strip()]
+    if len(lines) > 1 or (lines and ITEM_BULLET.match(lines[0])):
+        items = [ITEM_BULLET.sub("", line).strip() for line in lines]
+    else:
+        items = re.split(r";\s+|(?<=[a-z]{3}[.!?])\s+(?=[A-Z])", text.strip())
+    return [item.strip().strip("[]") for item in items if item.strip().strip("[]")]
+
+
+def parse_evaluation(evaluation: str, strict: bool = True) -> dict:
+    """
+    Parse a judge evaluation into a structured record.
+
+    Args:
+        evaluation: The judge's reply (or content-safety feedback in the same format)
+        strict: Raise EvaluationParseError when the score is missing; otherwise score is None
+
+    Returns:
+        dict with score, strengths, weaknesses, suggestions, improvements (lists of
+        items) and criteria (criterion -> note)
+    """
+    text = evaluation.replace("**", "")
+    try:
+        score = parse_score(text)
+    except EvaluationParseError:
+        if strict:
+            raise
+        score = None
+
+    record = {"score": score, "strengths": [], "weaknesses": [], "suggestions": [],
+              "improvements": [], "criteria": {}}
+    sections = []  # (label, lines)
+    for line in text.splitlines():
+        header = SECTION_HEADER.match(line)
+        if header:
+            sections.append((header.group(1).strip().lower(), [header.group(2)]))
+        elif sections:
+            sections[-1][1].append(line)
+
+    for label, lines in sections:
+        body = "\n".join(lines).strip()
+        label = re.sub(r"^\d+\.\s*", "", label)
+        if label in SECTION_FIELDS:
+            record[SECTION_FIELDS[label]].extend(split_items(body))
+        elif label in CRITERIA and body:
+            record["criteria"][label] = " ".join(body.split())
+    return record
+
+
+def format_feedback(record: dict, fields: tuple = ("weaknesses", "suggestions"),
+                    token_budget: int = FEEDBACK_TOKEN_BUDGET) -> str:
+    """
+    Render the score and the given fields, adding items round-robin (so every field
+    gets its most important items first) until token_budget is reached.
+    """
+    lines = [f"Score: {record['score']:g}/10"] if record.get("score") is not None else []
+    chosen = {field: [] for field in fields}
+    used = sum(estimate_tokens(line) for line in lines) + 4 * len(fields)
+    depth = max((len(record.get(field, [])) for field in fields), default=0)
+    for position in range(depth):
+        for field in fields:
+            items = record.get(field, [])
+            if position >= len(items):
+                continue
+            cost = estimate_tokens(items[position]) + 1
+            if used + cost > token_budget:
+                continue
+            chosen[field].append(items[position])
+            used += cost
+    for field in fields:
+        if chosen[field]:
+            lines.append(f"{field.capitalize()}: " + "; ".join(item.rstrip(".;") for item in chosen[field]) + ".")
+    return "\n".join(lines)
+
+
+def compact_evaluation(evaluation: str, fields: tuple = ("weaknesses", "suggestions"),
+                       token_budget: int = FEEDBACK_TOKEN_BUDGET) -> str:
+    """
+    Compact an evaluation for a follow-up prompt.
+
+    Falls back to the original text when it has no recognizable sections (e.g.
+    free-form feedback), so nothing actionable is dropped.
+    """
+    record = parse_evaluation(evaluation, strict=False)
+    if not any(record[field] for field in fields):
+        return evaluation
+    return format_feedback(record, fields, token_budget)
+
+
+def add_format_reminder(judge_prompt: str) -> str:
+    """Re-ask variant of a judge prompt that stresses the score line (and misses the response cache)."""
+    head, separator, tail = judge_prompt.rpartition("Evaluation:")
+    if not separator:
+        return f"{judge_prompt}\n\n{STRICT_FORMAT_REMINDER}"
+    return f"{head}{STRICT_FORMAT_REMINDER}\n\nEvaluation:{tail}"
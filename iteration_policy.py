@@ -0,0 +1,250 @@
+"""
+Adaptive Iteration Controller
+Decides whether another improve + judge round is worth paying for, instead of
+always running to max_iterations.
+
+Every finished story can be logged as a trajectory (category, judge scores, the
+tokens/seconds spent up to the first judgement, and the tokens/seconds each round
+cost) to $STORY_TRAJECTORY_LOG. TrajectoryStats
+learns from that history, per category and round, how much a round raised the
+best score so far - separately for rounds that follow a plateau, since a stalled
+story rarely recovers. AdaptivePolicy stops when the expected gain per 1k tokens
+or per second falls below a threshold, or when the next round would not fit in
+the story's hard token or latency budget.
+
+The offline simulator replays logged trajectories under different policies, so
+thresholds can be compared without API calls.
+
+Usage:
+    python iteration_policy.py simulate trajectories.jsonl --min-gain-per-1k-tokens 0.3
+    python iteration_policy.py simulate trajectories.jsonl --token-budget 5000 --train-fraction 0.5
+"""
+
+import argparse
+import json
+import os
+from collections import defaultdict
+
+# Fallbacks before any history has been logged
+DEFAULT_EXPECTED_GAIN = 0.75
+DEFAULT_ROUND_TOKENS = 1500
+DEFAULT_ROUND_SECONDS = 8.0
+
+# Pseudo-count pulling sparse per-category estimates toward the all-category ones
+PRIOR_WEIGHT = 3.0
+
+# Rounds beyond this share the statistics of the last one
+MAX_TRACKED_ROUND = 3
+
+
+def log_trajectory(category: str, scores: list, round_tokens: list, round_seconds: list,
+                   target_score: float, log_path: str = None, initial_tokens: int = 0, initial_seconds: float = 0.0):
+    """
+    Append a finished story's trajectory to log_path or $STORY_TRAJECTORY_LOG (no-op when unset).
+
+    initial_tokens/initial_seconds are what detection, drafting and the first judgement
+    cost, so the simulator checks budgets against the same story totals as live runs.
+    """
+    log_path = log_path or os.getenv("STORY_TRAJECTORY_LOG")
+    if not log_path:
+        return
+    record = {
+        "category": category,
+        "scores": scores,
+        "initial_tokens": initial_tokens,
+        "initial_seconds": round(initial_seconds, 3),
+        "round_tokens": round_tokens,
+        "round_seconds": [round(seconds, 3) for seconds in round_seconds],
+        "target_score": target_score,
+    }
+    with open(log_path, "a", encoding="utf-8") as f:
+        f.write(json.dumps(record, ensure_ascii=False) + "\n")
+
+
+def load_trajectories(path: str) -> list:
+    """Read trajectory records from a JSONL file."""
+    with open(path, encoding="utf-8") as f:
+        return [json.loads(line) for line in f if line.strip()]
+
+
+def round_gains(scores: list) -> list:
+    """(round, plateaued_before, gain) for each improve round: gain is the rise in the best score so far."""
+    gains = []
+    for index in range(1, len(scores)):
+        best_before = max(scores[:index])
+        plateaued = index >= 2 and scores[index - 1] <= scores[index - 2]
+        gains.append((min(index, MAX_TRACKED_ROUND), plateaued, max(0.0, scores[index] - best_before)))
+    return gains
+
+
+class TrajectoryStats:
+    """Per-category expected gain and cost of another improve + judge round."""
+
+    def __init__(self, trajectories: list = None):
+        self.gains = defaultdict(list)    # (category, round, plateaued) -> [gain, ...]
+        self.tokens = defaultdict(list)   # category -> [tokens per round, ...]
+        self.seconds = defaultdict(list)  # category -> [seconds per round, ...]
+        for trajectory in trajectories or []:
+            self.add(trajectory)
+
+    def add(self, trajectory: dict):
+        category = trajectory.get("category")
+        for round_index, plateaued, gain in round_gains(trajectory["scores"]):
+            self.gains[(category, round_index, plateaued)].append(gain)
+            self.gains[(None, round_index, plateaued)].append(gain)
+        for key in (category, None):
+            self.tokens[key].extend(trajectory.get("round_tokens", []))
+            self.seconds[key].extend(trajectory.get("round_seconds", []))
+
+    @staticmethod
+    def _smoothed(values: list, prior: float) -> float:
+        return (sum(values) + prior * PRIOR_WEIGHT) / (len(values) + PRIOR_WEIGHT)
+
+    def expected_gain(self, category: str, scores: list) -> float:
+        """Expected rise in the best score from one more round, capped by the headroom to 10."""
+        round_index = min(len(scores), MAX_TRACKED_ROUND)
+        plateaued = len(scores) >= 2 and scores[-1] <= scores[-2]
+        overall = self._smoothed(self.gains[(None, round_index, plateaued)], DEFAULT_EXPECTED_GAIN)
+        expected = self._smoothed(self.gains[(category, round_index, plateaued)], overall)
+        return min(expected, 10.0 - max(scores))
+
+    def expected_round_cost(self, category: str) -> tuple:
+        """(tokens, seconds) one more round is expected to cost."""
+        tokens = self._smoothed(self.tokens[category], self._smoothed(self.tokens[None], DEFAULT_ROUND_TOKENS))
+        seconds = self._smoothed(self.seconds[category], self._smoothed(self.seconds[None], DEFAULT_ROUND_SECONDS))
+        return tokens, seconds
+
+
+class AdaptivePolicy:
+    """
+    Stopping rule on top of target_score / max_iterations.
+
+    should_stop() is asked after each judgement that did not reach the target; it
+    returns a reason to stop, or None to run another round.
+    """
+
+    def __init__(self, stats: TrajectoryStats = None, min_gain_per_1k_tokens: float = 0.0,
+                 min_gain_per_second: float = 0.0, token_budget: int = None, latency_budget: float = None):
+        """
+        Args:
+            stats: Learned trajectory statistics (defaults only, when None)
+            min_gain_per_1k_tokens: Stop when expected score gain per 1k tokens is below this
+            min_gain_per_second: Stop when expected score gain per second is below this
+            token_budget: Hard per-story token limit; a round only starts if it is expected to fit
+            latency_budget: Hard per-story wall-clock limit in seconds, same rule
+        """
+        self.stats = stats or TrajectoryStats()
+        self.min_gain_per_1k_tokens = min_gain_per_1k_tokens
+        self.min_gain_per_second = min_gain_per_second
+        self.token_budget = token_budget
+        self.latency_budget = latency_budget
+
+    @classmethod
+    def from_log(cls, log_path: str = None, **kwargs) -> "AdaptivePolicy":
+        """Build a policy from a trajectory log ($STORY_TRAJECTORY_LOG by default), if it exists."""
+        log_path = log_path or os.getenv("STORY_TRAJECTORY_LOG")
+        trajectories = load_trajectories(log_path) if log_path and os.path.exists(log_path) else []
+        return cls(TrajectoryStats(trajectories), **kwargs)
+
+    def should_stop(self, category: str, scores: list, tokens_used: int, seconds_elapsed: float):
+        """Return a reason to stop improving, or None to continue."""
+        round_tokens, round_seconds = self.stats.expected_round_cost(category)
+        if self.token_budget is not None and tokens_used + round_tokens > self.token_budget:
+            return f"token budget ({tokens_used} used, next round ~{round_tokens:.0f}, budget {self.token_budget})"
+        if self.latency_budget is not None and seconds_elapsed + round_seconds > self.latency_budget:
+            return (f"latency budget ({seconds_elapsed:.1f}s used, next round ~{round_seconds:.1f}s, "
+                    f"budget {self.latency_budget:g}s)")
+
+        gain = self.stats.expected_gain(category, scores)
+        if gain * 1000 / round_tokens < self.min_gain_per_1k_tokens:
+            return f"expected gain {gain:.2f} points is too small for ~{round_tokens:.0f} tokens"
+        if gain / round_seconds < self.min_gain_per_second:
+            return f"expected gain {gain:.2f} points is too small for ~{round_seconds:.1f}s"
+        return None
+
+
+def simulate(trajectories: list, policy: AdaptivePolicy = None, target_score: float = 8,
+             max_iterations: int = 3) -> dict:
+    """
+    Replay logged trajectories under a policy (None = fixed target/max_iterations rule).
+
+    A replay ends where its log ends, so policies can only stop earlier than the
+    logged run, never later. Budgets are checked against the story's totals, starting
+    from the logged initial cost (detection, draft and first judgement), as in live runs.
+
+    Returns:
+        dict with mean best score, pass rate, rounds, tokens and seconds per story
+    """
+    totals = {"stories": 0, "best_score": 0.0, "passed": 0, "rounds": 0, "tokens": 0.0, "seconds": 0.0}
+    for trajectory in trajectories:
+        scores_log = trajectory["scores"]
+        round_tokens = trajectory.get("round_tokens", [])
+        round_seconds = trajectory.get("round_seconds", [])
+        scores = [scores_log[0]]
+        initial_tokens = trajectory.get("initial_tokens", 0)
+        initial_seconds = trajectory.get("initial_seconds", 0.0)
+        tokens, seconds = initial_tokens, initial_seconds
+        while len(scores) < min(len(scores_log), max_iterations) and scores[-1] < target_score:
+            if policy is not None and policy.should_stop(trajectory.get("category"), scores, tokens, seconds):
+                break
+            rounds = len(scores)
+            tokens += round_tokens[rounds - 1] if rounds - 1 < len(round_tokens) else DEFAULT_ROUND_TOKENS
+            seconds += round_seconds[rounds - 1] if rounds - 1 < len(round_seconds) else DEFAULT_ROUND_SECONDS
+            scores.append(scores_log[rounds])
+        totals["stories"] += 1
+        totals["best_score"] += max(scores)
+        totals["passed"] += max(scores) >= target_score
+        totals["rounds"] += len(scores) - 1
+        totals["tokens"] += tokens - initial_tokens
+        totals["seconds"] += seconds - initial_seconds
+
+    count = max(totals["stories"], 1)
+    return {
+        "stories": totals["stories"],
+        "mean_best_score": round(totals["best_score"] / count, 3),
+        "pass_rate": round(totals["passed"] / count, 3),
+        "rounds_per_story": round(totals["rounds"] / count, 2),
+        "round_tokens_per_story": round(totals["tokens"] / count, 1),
+        "round_seconds_per_story": round(totals["seconds"] / count, 2),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Compare iteration stopping policies on logged trajectories.")
+    sub = parser.add_subparsers(dest="command", required=True)
+    sim_parser = sub.add_parser("simulate", help="Replay a trajectory log under fixed and adaptive policies")
+    sim_parser.add_argument("log", help="JSONL written via STORY_TRAJECTORY_LOG")
+    sim_parser.add_argument("--target-score", type=float, default=8)
+    sim_parser.add_argument("--max-iterations", type=int, default=3)
+    sim_parser.add_argument("--min-gain-per-1k-tokens", type=float, default=0.3)
+    sim_parser.add_argument("--min-gain-per-second", type=float, default=0.0)
+    sim_parser.add_argument("--token-budget", type=int)
+    sim_parser.add_argument("--latency-budget", type=float)
+    sim_parser.add_argument("--train-fraction", type=float, default=1.0,
+                            help="Learn from this leading fraction of the log, replay the rest (1.0 = all)")
+    args = parser.parse_args()
+
+    trajectories = load_trajectories(args.log)
+    split = int(len(trajectories) * args.train_fraction)
+    train, test = (trajectories[:split], trajectories[split:]) if args.train_fraction < 1.0 else (trajectories,) * 2
+    policy = AdaptivePolicy(
+        TrajectoryStats(train),
+        min_gain_per_1k_tokens=args.min_gain_per_1k_tokens,
+        min_gain_per_second=args.min_gain_per_second,
+        token_budget=args.token_budget,
+        latency_budget=args.latency_budget,
+    )
+    results = [("fixed", simulate(test, None, args.target_score, args.max_iterations)),
+               ("adaptive", simulate(test, policy, args.target_score, args.max_iterations))]
+
+    columns = ["mean_best_score", "pass_rate", "rounds_per_story", "round_tokens_per_story", "round_seconds_per_story"]
+    print("\n" + "="*100)
+    print(f"ITERATION POLICY SIMULATION ({len(test)} trajectories, learned from {len(train)})")
+    print("="*100)
+    print(f"{'policy':>10}  " + "  ".join(f"{column:>24}" for column in columns))
+    for name, row in results:
+        print(f"{name:>10}  " + "  ".join(f"{row[column]!s:>24}" for column in columns))
+
+
+if __name__ == "__main__":
+    main()
@@ -1,36 +1,116 @@
-import os
-import re
-import openai
+import time
+from concurrent.futures import ThreadPoolExecutor
 from dotenv import load_dotenv
-from pathlib import Path
 
-# Load environment variables from .env file
+# Load environment variables from .env file, before the modules below read their settings
+# (openai itself is only imported on the first model call, see model_client.py)
 load_dotenv()
 
-def call_model(prompt: str, max_tokens=800, temperature=0.1) -> str:
-    openai.api_key = os.getenv("OPENAI_API_KEY")
-    resp = openai.ChatCompletion.create(
-        model="gpt-3.5-turbo",
-        messages=[{"role": "user", "content": prompt}],
-        stream=False,
-        max_tokens=max_tokens,
-        temperature=temperature,
-    )
-    return resp.choices[0].message["content"]  # type: ignore
+from batch_judge import judge_batch, rank_by_scores
+from category_classifier import confidence_threshold, get_classifier, log_category_label, shadow_rate, should_shadow
+from content_safety import is_safety_feedback, prefilter_story
+from evaluation_parser import (
+    FEEDBACK_TOKEN_BUDGET,
+    SCORE_PATTERN,
+    add_format_reminder,
+    compact_evaluation,
+    parse_score,
+)
+from iteration_policy import AdaptivePolicy, log_trajectory
+from model_client import get_client
+from model_router import get_router
+from story_library import StoryLibrary, open_library
+from targeted_revision import (
+    build_paragraph_revision_prompt,
+    parse_revised_paragraphs,
+    patch_paragraphs,
+    plan_revision,
+    revision_max_tokens,
+)
+from tracing import propagate, tracer
+
+
+def call_model(prompt: str, max_tokens=800, temperature=0.1, timeout: float = None, pin_cache: bool = False,
+               stage: str = None) -> str:
+    """
+    Call the chat model through the shared rate-limited, retrying client.
+
+    When a response cache is configured (STORY_CACHE_PATH), low-temperature calls are
+    served from it; pass pin_cache=True to also cache a high-temperature call.
+    With a stage (detect, draft, judge, improve, feedback), the model router picks
+    the model and falls back to the next one on failure (see model_router.py).
+    """
+    if stage is not None:
+        return get_router().complete(stage, prompt, max_tokens=max_tokens, temperature=temperature,
+                                     timeout=timeout, pin_cache=pin_cache)
+    return get_client().complete(prompt, max_tokens=max_tokens, temperature=temperature,
+                                 timeout=timeout, pin_cache=pin_cache)
+
+
+async def acall_model(prompt: str, max_tokens=800, temperature=0.1, timeout: float = None,
+                      pin_cache: bool = False, stage: str = None) -> str:
+    """Async counterpart of call_model, used by the concurrent batch pipeline."""
+    if stage is not None:
+        return await get_router().acomplete(stage, prompt, max_tokens=max_tokens, temperature=temperature,
+                                            timeout=timeout, pin_cache=pin_cache)
+    return await get_client().acomplete(prompt, max_tokens=max_tokens, temperature=temperature,
+                                        timeout=timeout, pin_cache=pin_cache)
+
+
+def stream_model(prompt: str, max_tokens=800, temperature=0.1, timeout: float = None, pin_cache: bool = False,
+                 stage: str = None):
+    """Yield the model's reply in pieces as they arrive; close the generator to cancel the call."""
+    if stage is not None:
+        return get_router().stream(stage, prompt, max_tokens=max_tokens, temperature=temperature,
+                                   timeout=timeout, pin_cache=pin_cache)
+    return get_client().stream(prompt, max_tokens=max_tokens, temperature=temperature,
+                               timeout=timeout, pin_cache=pin_cache)
+
+
+def astream_model(prompt: str, max_tokens=800, temperature=0.1, timeout: float = None, pin_cache: bool = False,
+                  stage: str = None):
+    """Async counterpart of stream_model (an async generator)."""
+    if stage is not None:
+        return get_router().astream(stage, prompt, max_tokens=max_tokens, temperature=temperature,
+                                    timeout=timeout, pin_cache=pin_cache)
+    return get_client().astream(prompt, max_tokens=max_tokens, temperature=temperature,
+                                timeout=timeout, pin_cache=pin_cache)
+
+
+def print_token(token: str):
+    """Console sink for streamed tokens."""
+    print(token, end="", flush=True)
+
+
+def collect_stream(chunks, on_token=None) -> str:
+    """Join streamed pieces into the full reply, passing each piece to on_token as it arrives."""
+    parts = []
+    for chunk in chunks:
+        parts.append(chunk)
+        if on_token is not None:
+            on_token(chunk)
+    return "".join(parts)
 
 
 def extract_score_from_evaluation(evaluation: str) -> float:
-    """Parse score from judge's response like 'Score: 7/10' or 'Score: 8.5/10'"""
-    # Updated regex to support decimal scores like 9.5/10 and two-digit scores like 10/10
-    match = re.search(r'Score:\s*(\d+(?:\.\d+)?)/10', evaluation)
-    if match:
-        return float(match.group(1))
-    return 5.0  # Default if parsing fails
+    """
+    Parse score from judge's response like 'Score: 7/10' or 'Score: 8.5/10'.
+    
+    Raises EvaluationParseError when there is no valid score (call_judge already
+    re-asks the judge once before giving up).
+    """
+    return parse_score(evaluation)
 
 
-def detect_story_category(user_input: str) -> str:
-    """Detect the category of story requested (adventure, educational, calming, fantasy)."""
-    detection_prompt = f"""Analyze this story request and categorize it into ONE of these types:
+VALID_CATEGORIES = ['adventure', 'educational', 'calming', 'fantasy', 'friendship']
+
+# Local classifier confidence needed to skip the LLM category call ($CATEGORY_CONFIDENCE_THRESHOLD;
+# set above 1.0 to always ask the LLM)
+LOCAL_CATEGORY_THRESHOLD = confidence_threshold()
+
+
+# Prompt templates, filled in with str.format() (built once at import, not per call)
+DETECTION_PROMPT = """Analyze this story request and categorize it into ONE of these types:
 - adventure: Action-filled, exciting journeys or quests
 - educational: Learning-focused, teaching concepts or lessons
 - calming: Gentle, soothing, peaceful stories
@@ -41,64 +121,36 @@ Story request: {user_input}
 
 Respond with ONLY the category name (one word).
 Category:"""
-    
-    category = call_model(detection_prompt, max_tokens=10, temperature=0.1).strip().lower()
-    
-    # Validate category
-    valid_categories = ['adventure', 'educational', 'calming', 'fantasy', 'friendship']
-    if category not in valid_categories:
-        category = 'adventure'  # Default
-    
-    return category
 
-
-def get_category_specific_requirements(category: str) -> str:
-    """Return tailored requirements based on story category."""
-    requirements = {
-        'adventure': """- Build excitement gradually but end calmly
+# Extra storyteller requirements per category (unknown categories get the adventure ones)
+CATEGORY_REQUIREMENTS = {
+    'adventure': """- Build excitement gradually but end calmly
 - Include a brave protagonist overcoming challenges
 - Use active, engaging language but avoid overstimulation
 - Ensure the adventure concludes peacefully for bedtime""",
-        
-        'educational': """- Weave learning naturally into the narrative
+    
+    'educational': """- Weave learning naturally into the narrative
 - Teach one clear concept or lesson
 - Use simple explanations appropriate for ages 5-10
 - Make learning fun and memorable through story""",
-        
-        'calming': """- Use slow, gentle pacing throughout
+    
+    'calming': """- Use slow, gentle pacing throughout
 - Include soothing imagery (soft clouds, gentle breezes, quiet nights)
 - Minimize conflict or make it very mild
 - Focus on peaceful, tranquil settings""",
-        
-        'fantasy': """- Create magical elements that spark wonder, not fear
+    
+    'fantasy': """- Create magical elements that spark wonder, not fear
 - Keep magic whimsical and gentle
 - Ground fantasy in relatable emotions
 - Ensure magical elements lead to peaceful resolution""",
-        
-        'friendship': """- Emphasize positive relationships and cooperation
+    
+    'friendship': """- Emphasize positive relationships and cooperation
 - Show characters supporting each other
 - Include themes of kindness, sharing, and understanding
 - Demonstrate healthy conflict resolution"""
-    }
-    
-    return requirements.get(category, requirements['adventure'])
-
+}
 
-def generate_initial_story(user_input: str, category: str = None) -> str:
-    """Generate the initial story draft using the storyteller agent with category-specific tailoring."""
-    
-    # Detect category if not provided
-    if category is None:
-        category = detect_story_category(user_input)
-    
-    print("\n" + "="*70)
-    print(f"STEP 1: GENERATING INITIAL STORY DRAFT (Category: {category.upper()})")
-    print("="*70)
-    
-    # Get category-specific requirements
-    category_requirements = get_category_specific_requirements(category)
-    
-    storyteller_prompt = f"""You are an expert children's storyteller specializing in bedtime stories for ages 5-10.
+STORYTELLER_PROMPT = """You are an expert children's storyteller specializing in bedtime stories for ages 5-10.
 
 Write an engaging bedtime story based on this request: {user_input}
 
@@ -110,31 +162,16 @@ General Requirements:
 - End with a peaceful, happy conclusion that's appropriate for bedtime
 - Use proper paragraphs for readability
 
-Category-Specific Requirements ({category.upper()}):
-{category_requirements}
+Category-Specific Requirements ({category_name}):
+{requirements}
 
 Story:"""
-    
-    story = call_model(storyteller_prompt, max_tokens=500, temperature=0.7)
-    return story, category
 
 
-def judge_story(story: str, iteration: int, previous_evaluation: str = None) -> str:
-    """Evaluate the story using the judge agent with comparative feedback."""
-    
-    if previous_evaluation and iteration > 1:
-        # Comparative evaluation for iterations after the first
-        judge_prompt = f"""You are a children's literature expert and editor specializing in bedtime stories for ages 5-10.
-
-You previously evaluated an earlier version of this story. Now evaluate this IMPROVED version:
+# Initial evaluation
+JUDGE_PROMPT = """You are a children's literature expert and editor specializing in bedtime stories for ages 5-10.
 
-Previous Feedback Given:
-{previous_evaluation}
-
-Improved Story to Evaluate:
-{story}
-
-Evaluate based on these criteria:
+Evaluate the following story on these criteria:
 1. Age-appropriateness (vocabulary, themes, content suitable for 5-10 year olds)
 2. Story structure (clear beginning, middle, end with proper story arc)
 3. Engagement (interesting, holds attention, imaginative)
@@ -142,6 +179,9 @@ Evaluate based on these criteria:
 5. Length and pacing (appropriate for bedtime reading)
 6. Content safety (NO scary/violent/sad themes inappropriate for bedtime)
 
+Story to evaluate:
+{story}
+
 ⚠️ CRITICAL SCORING RULES - DEDUCT POINTS HEAVILY:
 Any story containing the following should receive a LOW score:
 - Scary, frightening, or nightmare-inducing content (monsters, ghosts, darkness, being lost/alone, shadows, creepy atmosphere)
@@ -153,21 +193,26 @@ Any story containing the following should receive a LOW score:
 
 A bedtime story MUST be calming, positive, and leave the child feeling safe and happy. Deduct at least 5 points for any violation of content safety.
 
-IMPORTANT: Acknowledge if previous issues were addressed. Only raise NEW concerns or remaining issues. If improvements were made, increase the score accordingly.
-
 Provide your evaluation in this format:
 Score: X/10
-Improvements Made: [what was fixed from previous feedback]
 Strengths: [list 2-3 specific strengths]
-Weaknesses: [list remaining or new areas for improvement]
-Suggestions: [provide concrete, actionable suggestions]
+Weaknesses: [list 2-3 specific areas for improvement]
+Suggestions: [provide concrete, actionable suggestions to improve the story]
 
 Evaluation:"""
-    else:
-        # Initial evaluation
-        judge_prompt = f"""You are a children's literature expert and editor specializing in bedtime stories for ages 5-10.
 
-Evaluate the following story on these criteria:
+# Comparative evaluation for iterations after the first
+COMPARATIVE_JUDGE_PROMPT = """You are a children's literature expert and editor specializing in bedtime stories for ages 5-10.
+
+You previously evaluated an earlier version of this story. Now evaluate this IMPROVED version:
+
+Previous Feedback Given:
+{previous_feedback}
+
+Improved Story to Evaluate:
+{story}
+
+Evaluate based on these criteria:
 1. Age-appropriateness (vocabulary, themes, content suitable for 5-10 year olds)
 2. Story structure (clear beginning, middle, end with proper story arc)
 3. Engagement (interesting, holds attention, imaginative)
@@ -175,9 +220,6 @@ Evaluate the following story on these criteria:
 5. Length and pacing (appropriate for bedtime reading)
 6. Content safety (NO scary/violent/sad themes inappropriate for bedtime)
 
-Story to evaluate:
-{story}
-
 ⚠️ CRITICAL SCORING RULES - DEDUCT POINTS HEAVILY:
 Any story containing the following should receive a LOW score:
 - Scary, frightening, or nightmare-inducing content (monsters, ghosts, darkness, being lost/alone, shadows, creepy atmosphere)
@@ -189,45 +231,353 @@ Any story containing the following should receive a LOW score:
 
 A bedtime story MUST be calming, positive, and leave the child feeling safe and happy. Deduct at least 5 points for any violation of content safety.
 
+IMPORTANT: Acknowledge if previous issues were addressed. Only raise NEW concerns or remaining issues. If improvements were made, increase the score accordingly.
+
 Provide your evaluation in this format:
 Score: X/10
+Improvements Made: [what was fixed from previous feedback]
 Strengths: [list 2-3 specific strengths]
-Weaknesses: [list 2-3 specific areas for improvement]
-Suggestions: [provide concrete, actionable suggestions to improve the story]
+Weaknesses: [list remaining or new areas for improvement]
+Suggestions: [provide concrete, actionable suggestions]
 
 Evaluation:"""
+
+IMPROVEMENT_PROMPT = """You are an expert children's storyteller. You previously wrote this bedtime story for ages 5-10:
+
+{story}
+
+A children's literature expert provided this feedback:
+
+{feedback}
+
+Please rewrite the story, addressing ALL the feedback and suggestions provided. Maintain what worked well and fix the identified weaknesses. Ensure the improved story is engaging, age-appropriate, and perfect for bedtime.
+
+Improved Story:"""
+
+FEEDBACK_PROMPT = """You are an expert children's storyteller. Here is a bedtime story you wrote:
+
+{story}
+
+The reader has requested the following change:
+{feedback}
+
+Please rewrite the story incorporating this feedback while maintaining:
+- Age-appropriateness for 5-10 year olds
+- Bedtime suitability (calming, peaceful ending)
+- The {category} story style
+
+Revised Story:"""
+
+
+def build_detection_prompt(user_input: str) -> str:
+    """Build the category detection prompt for a story request."""
+    return DETECTION_PROMPT.format(user_input=user_input)
+
+
+def parse_category(response: str) -> str:
+    """Normalize the detector's reply to one of VALID_CATEGORIES."""
+    category = response.strip().lower()
     
-    print("\n" + "="*70)
-    print(f"STEP {iteration * 2}: JUDGING STORY (Iteration {iteration})")
-    print("="*70)
+    # Validate category
+    if category not in VALID_CATEGORIES:
+        category = 'adventure'  # Default
+    
+    return category
+
+
+def detect_story_category(user_input: str, confidence_threshold: float = LOCAL_CATEGORY_THRESHOLD) -> str:
+    """
+    Detect the category of story requested (adventure, educational, calming, fantasy).
+
+    The local classifier answers when its confidence is at least confidence_threshold;
+    otherwise the LLM is asked and its label is logged for future training. A
+    CATEGORY_SHADOW_RATE fraction of confident predictions is also sent to the LLM
+    (its label is used and both are logged), so agreement can be measured there too.
+    """
+    with tracer.span("detect") as span:
+        local_category, confidence = get_classifier().predict(user_input)
+        shadow = confidence >= confidence_threshold and should_shadow()
+        if confidence >= confidence_threshold and not shadow:
+            span.set(source="local", category=local_category, confidence=round(confidence, 3))
+            return local_category
+        
+        start = time.perf_counter()
+        detection_prompt = build_detection_prompt(user_input)
+        category = parse_category(call_model(detection_prompt, max_tokens=10, temperature=0.1, stage="detect"))
+        log_category_label(user_input, category, time.perf_counter() - start, local_category, confidence,
+                           shadow_rate() if shadow else None)
+        span.set(source="shadow" if shadow else "llm", category=category, local_category=local_category,
+                 confidence=round(confidence, 3))
+        return category
+
+
+def get_category_specific_requirements(category: str) -> str:
+    """Return tailored requirements based on story category."""
+    return CATEGORY_REQUIREMENTS.get(category, CATEGORY_REQUIREMENTS['adventure'])
+
+
+def build_storyteller_prompt(user_input: str, category: str) -> str:
+    """Build the storyteller prompt with category-specific requirements."""
+    return STORYTELLER_PROMPT.format(user_input=user_input, category_name=category.upper(),
+                                     requirements=get_category_specific_requirements(category))
+
+
+def generate_initial_story(user_input: str, category: str = None, on_token=None) -> str:
+    """
+    Generate the initial story draft using the storyteller agent with category-specific tailoring.
+    
+    Pass on_token (e.g. print_token) to stream the draft as it is written.
+    """
+    
+    # Detect category if not provided
+    if category is None:
+        category = detect_story_category(user_input)
+    
+    with tracer.span("draft", category=category,
+                     banner=f"STEP 1: GENERATING INITIAL STORY DRAFT (Category: {category.upper()})"):
+        storyteller_prompt = build_storyteller_prompt(user_input, category)
+        if on_token is not None:
+            story = collect_stream(
+                stream_model(storyteller_prompt, max_tokens=500, temperature=0.7, stage="draft"), on_token
+            )
+        else:
+            story = call_model(storyteller_prompt, max_tokens=500, temperature=0.7, stage="draft")
+    return story, category
+
+
+def build_adaptation_prompt(seed_story: str, user_input: str, category: str) -> str:
+    """Build the prompt adapting a stored story to a similar new request."""
+    return build_feedback_prompt(
+        seed_story, f"Adapt the story to this new request, changing only what it needs: {user_input}", category
+    )
+
+
+def adapt_library_story(seed: dict, user_input: str, on_token=None) -> tuple:
+    """
+    Adapt a similar stored story (a StoryLibrary record) to the new request.
+    
+    Returns:
+        (story, category) - the category is the stored story's
+    """
+    category = seed["category"]
+    with tracer.span("draft", category=category, seeded=True,
+                     banner=f"STEP 1: ADAPTING A STORED STORY ({seed['similarity']:.0%} similar request)"):
+        prompt = build_adaptation_prompt(seed["story"], user_input, category)
+        if on_token is not None:
+            story = collect_stream(stream_model(prompt, max_tokens=600, temperature=0.7, stage="feedback"), on_token)
+        else:
+            story = call_model(prompt, max_tokens=600, temperature=0.7, stage="feedback")
+    return story, category
+
+
+def generate_initial_drafts(user_input: str, category: str = None, num_drafts: int = 3) -> tuple:
+    """Generate num_drafts independent story drafts concurrently. Returns (drafts, category)."""
+    if category is None:
+        category = detect_story_category(user_input)
+    
+    with tracer.span("draft", category=category, num_drafts=num_drafts,
+                     banner=f"STEP 1: GENERATING {num_drafts} STORY DRAFTS IN PARALLEL (Category: {category.upper()})"):
+        storyteller_prompt = build_storyteller_prompt(user_input, category)
+        with ThreadPoolExecutor(max_workers=num_drafts) as pool:
+            drafts = list(pool.map(
+                propagate(lambda _: call_model(storyteller_prompt, max_tokens=500, temperature=0.7, stage="draft")),
+                range(num_drafts),
+            ))
+    return drafts, category
+
+
+def build_judge_prompt(story: str, iteration: int, previous_evaluation: str = None,
+                       feedback_budget: int = FEEDBACK_TOKEN_BUDGET) -> str:
+    """
+    Build the judge prompt, switching to comparative judging after the first iteration.
+    
+    The previous evaluation is compacted to its score, weaknesses and suggestions
+    (at most feedback_budget tokens) - all the judge needs to check what was fixed.
+    """
+    if previous_evaluation and iteration > 1:
+        return COMPARATIVE_JUDGE_PROMPT.format(
+            previous_feedback=compact_evaluation(previous_evaluation, token_budget=feedback_budget), story=story
+        )
+    return JUDGE_PROMPT.format(story=story)
+
+
+def call_judge(judge_prompt: str, early_exit_score: float = None) -> str:
+    """
+    Run a judge prompt. With early_exit_score, the reply is streamed and cancelled as soon
+    as a 'Score: X/10' line at or above that score arrives, skipping the written critique.
+    
+    A reply without a score is re-asked once; a second miss raises EvaluationParseError.
+    """
+    evaluation = _read_judge(judge_prompt, early_exit_score)
+    if SCORE_PATTERN.search(evaluation) is None:
+        print("\n⚠ Judge reply had no 'Score: X/10' line - asking again.")
+        evaluation = _read_judge(add_format_reminder(judge_prompt), early_exit_score)
+        parse_score(evaluation)  # Raises EvaluationParseError rather than guessing a score
+    return evaluation
+
+
+def _read_judge(judge_prompt: str, early_exit_score: float = None) -> str:
+    if early_exit_score is None:
+        return call_model(judge_prompt, max_tokens=500, temperature=0.1, stage="judge")
     
-    evaluation = call_model(judge_prompt, max_tokens=500, temperature=0.1)
+    chunks = stream_model(judge_prompt, max_tokens=500, temperature=0.1, stage="judge")
+    evaluation = ""
+    score_seen = False
+    try:
+        for chunk in chunks:
+            evaluation += chunk
+            if score_seen:
+                continue
+            match = SCORE_PATTERN.search(evaluation)
+            if match:
+                score_seen = True
+                if float(match.group(1)) >= early_exit_score:
+                    return evaluation[:match.end()]
+    finally:
+        chunks.close()
     return evaluation
 
 
-def improve_story(original_story: str, evaluation: str, iteration: int) -> str:
-    """Improve the story based on judge's feedback."""
-    improvement_prompt = f"""You are an expert children's storyteller. You previously wrote this bedtime story for ages 5-10:
+def judge_story(story: str, iteration: int, previous_evaluation: str = None, early_exit_score: float = None) -> str:
+    """
+    Evaluate the story using the judge agent with comparative feedback.
+    
+    With early_exit_score, a passing evaluation is cut short after its score line.
+    """
+    judge_prompt = build_judge_prompt(story, iteration, previous_evaluation)
+    
+    with tracer.span("judge", iteration=iteration,
+                     banner=f"STEP {iteration * 2}: JUDGING STORY (Iteration {iteration})") as span:
+        evaluation = call_judge(judge_prompt, early_exit_score)
+        span.set(score=extract_score_from_evaluation(evaluation))
+    return evaluation
 
-{original_story}
 
-A children's literature expert provided this feedback:
+# Versions scoring within this margin of the best are re-ranked side by side (listwise judging)
+LISTWISE_TIE_MARGIN = 0.5
 
-{evaluation}
 
-Please rewrite the story, addressing ALL the feedback and suggestions provided. Maintain what worked well and fix the identified weaknesses. Ensure the improved story is engaging, age-appropriate, and perfect for bedtime.
+def judge_drafts(drafts: list, early_exit_score: float = None, category: str = None,
+                 listwise: bool = False) -> tuple:
+    """
+    Judge several first drafts in parallel. Returns (evaluations, scores, ranking) in
+    draft order; ranking lists draft indices best first.
+    
+    When category is given, drafts that fail the content-safety prefilter get its
+    feedback instead of a judge call. With listwise=True the remaining drafts are
+    scored and ranked against each other in a single judge call.
+    """
+    if listwise:
+        with tracer.span("judge", iteration=1, num_drafts=len(drafts), listwise=True,
+                         banner=f"STEP 2: JUDGING {len(drafts)} DRAFTS IN ONE LISTWISE CALL") as span:
+            evaluations = [prefilter_story(draft, category) if category is not None else None for draft in drafts]
+            pending = [index for index, evaluation in enumerate(evaluations) if evaluation is None]
+            ranking = []
+            if pending:
+                batch_evaluations, _, batch_ranking = judge_batch([drafts[index] for index in pending])
+                for index, evaluation in zip(pending, batch_evaluations):
+                    evaluations[index] = evaluation
+                ranking = [pending[position] for position in batch_ranking]
+            scores = [extract_score_from_evaluation(evaluation) for evaluation in evaluations]
+            ranking += [index for index in rank_by_scores(scores) if index not in ranking]
+            span.set(score=max(scores), draft_scores=scores, ranking=ranking)
+        return evaluations, scores, ranking
+    
+    def judge(draft: str) -> str:
+        if category is not None:
+            safety_feedback = prefilter_story(draft, category)
+            if safety_feedback is not None:
+                return safety_feedback
+        return call_judge(build_judge_prompt(draft, 1), early_exit_score)
+    
+    with tracer.span("judge", iteration=1, num_drafts=len(drafts),
+                     banner=f"STEP 2: JUDGING {len(drafts)} DRAFTS IN PARALLEL") as span:
+        with ThreadPoolExecutor(max_workers=len(drafts)) as pool:
+            evaluations = list(pool.map(propagate(judge), drafts))
+        scores = [extract_score_from_evaluation(evaluation) for evaluation in evaluations]
+        span.set(score=max(scores), draft_scores=scores)
+    return evaluations, scores, rank_by_scores(scores)
+
+
+def rank_versions(story_versions: list, scores: list, margin: float = LISTWISE_TIE_MARGIN) -> int:
+    """
+    Index of the best story version. When several versions score within margin of
+    the best, they are ranked side by side in one listwise judge call.
+    """
+    best = max(scores)
+    close = [index for index, score in enumerate(scores) if best - score <= margin]
+    if len(close) < 2:
+        return scores.index(best)
+    with tracer.span("judge", listwise=True, candidates=[index + 1 for index in close],
+                     banner=f"RANKING {len(close)} CLOSE VERSIONS SIDE BY SIDE") as span:
+        _, _, ranking = judge_batch([story_versions[index] for index in close])
+        span.set(ranking=[close[position] + 1 for position in ranking])
+    return close[ranking[0]]
 
-Improved Story:"""
+
+def build_improvement_prompt(original_story: str, evaluation: str, feedback_budget: int = FEEDBACK_TOKEN_BUDGET) -> str:
+    """Build the prompt asking the storyteller to address the judge's feedback (compacted to feedback_budget tokens)."""
+    feedback = compact_evaluation(evaluation, ("weaknesses", "suggestions", "strengths"), feedback_budget)
+    return IMPROVEMENT_PROMPT.format(story=original_story, feedback=feedback)
+
+
+def revise_paragraphs(plan: tuple, feedback: str, feedback_intro: str, on_token=None, stage: str = "improve"):
+    """
+    Rewrite only the paragraphs selected by plan_revision and patch them into the story.
+    The rewrite is routed as the given stage (improve, or feedback for reader requests).
     
-    print("\n" + "="*70)
-    print(f"STEP {iteration * 2 + 1}: IMPROVING STORY BASED ON FEEDBACK (Iteration {iteration})")
-    print("="*70)
+    Returns:
+        The patched story, or None if the reply was missing a requested paragraph
+    """
+    paragraphs, indices = plan
+    prompt = build_paragraph_revision_prompt(paragraphs, indices, feedback, feedback_intro)
+    max_tokens = revision_max_tokens(paragraphs, indices)
+    print(f"\n✂ Targeted revision of paragraph(s) {', '.join(str(i + 1) for i in indices)} of {len(paragraphs)}")
+    if on_token is not None:
+        reply = collect_stream(stream_model(prompt, max_tokens=max_tokens, temperature=0.7, stage=stage), on_token)
+    else:
+        reply = call_model(prompt, max_tokens=max_tokens, temperature=0.7, stage=stage)
+    revised = parse_revised_paragraphs(reply, indices)
+    if revised is None:
+        print("\n⚠ Targeted revision reply was incomplete - falling back to a full rewrite.")
+        return None
+    return patch_paragraphs(paragraphs, revised)
+
+
+def improve_story(original_story: str, evaluation: str, iteration: int, on_token=None, targeted: bool = False) -> str:
+    """
+    Improve the story based on judge's feedback (streamed to on_token when given).
     
-    improved_story = call_model(improvement_prompt, max_tokens=500, temperature=0.7)
+    With targeted=True, only the paragraphs the feedback points at are rewritten;
+    feedback that spans most of the story still gets a full rewrite.
+    """
+    improvement_prompt = build_improvement_prompt(original_story, evaluation)
+    
+    with tracer.span("improve", iteration=iteration,
+                     banner=f"STEP {iteration * 2 + 1}: IMPROVING STORY BASED ON FEEDBACK (Iteration {iteration})") as span:
+        plan = plan_revision(original_story, evaluation) if targeted else None
+        if plan is not None:
+            feedback = compact_evaluation(evaluation, ("weaknesses", "suggestions", "strengths"))
+            improved_story = revise_paragraphs(
+                plan, feedback, "A children's literature expert provided this feedback:", on_token
+            )
+            if improved_story is not None:
+                span.set(mode="targeted", paragraphs=[index + 1 for index in plan[1]])
+                return improved_story
+        span.set(mode="full")
+        if on_token is not None:
+            improved_story = collect_stream(
+                stream_model(improvement_prompt, max_tokens=500, temperature=0.7, stage="improve"), on_token
+            )
+        else:
+            improved_story = call_model(improvement_prompt, max_tokens=500, temperature=0.7, stage="improve")
     return improved_story
 
 
-def generate_story_with_quality_control(user_input: str, target_score=8, max_iterations=3):
+def generate_story_with_quality_control(user_input: str, target_score=8, max_iterations=3, num_drafts=1,
+                                        stream=False, early_exit_judge=False, safety_prefilter=True,
+                                        targeted_revision=False, listwise_judge=False,
+                                        policy: AdaptivePolicy = None, library: StoryLibrary = None):
     """
     Generate a story and iteratively improve it based on judge feedback.
     
@@ -235,64 +585,176 @@ def generate_story_with_quality_control(user_input: str, target_score=8, max_ite
         user_input: The story request from the user
         target_score: Minimum acceptable quality score (1-10)
         max_iterations: Maximum number of improvement iterations
+        num_drafts: Drafts to write and judge in parallel before the loop (best-of-N);
+                    the best draft enters the improvement loop
+        stream: Print story text to the console as it is generated
+        early_exit_judge: Stop reading a judge reply once it shows a passing score,
+                          skipping the written critique of stories that already pass
+        safety_prefilter: Scan every version for banned themes first; hard violations
+                          skip the judge and go straight back to improve_story
+        targeted_revision: Rewrite only the paragraphs the feedback refers to
+                           (full rewrite when it concerns most of the story)
+        listwise_judge: Judge drafts together in one call, and settle close calls
+                        between versions by ranking them side by side
+        policy: Optional stopping policy (iteration_policy.AdaptivePolicy) that ends
+                the loop early when another round isn't worth its tokens/seconds
+                or would exceed the story's budget
+        library: Optional StoryLibrary consulted first: a near-identical request with a
+                 passing story is served as is, a similar one is adapted instead of
+                 drafting from scratch; the final story is stored in it
     
     Returns:
-        tuple: (final_story, all_evaluations, score_progression, all_story_versions)
+        tuple: (final_story, all_evaluations, score_progression, all_story_versions, category)
     """
-    
-    # Initial story generation with category detection
-    story, category = generate_initial_story(user_input)
-    print(f"\n[Initial Draft]:\n{story}")
-    
-    evaluations = []
-    scores = []
-    story_versions = [story]  # Track all story versions
-    previous_evaluation = None
-    
-    # Iterative improvement loop
-    for iteration in range(1, max_iterations + 1):
-        # Judge the current story (with comparative feedback after first iteration)
-        evaluation = judge_story(story, iteration, previous_evaluation)
-        score = extract_score_from_evaluation(evaluation)
+    if max_iterations < 1:
+        raise ValueError(f"max_iterations must be at least 1, got {max_iterations}")
+    with tracer.span("story", request=user_input[:80]) as story_span:
+        story_start = time.perf_counter()
+        
+        def usage() -> tuple:
+            """(tokens, seconds) spent on this story so far."""
+            tokens = story_span.attrs.get("prompt_tokens", 0) + story_span.attrs.get("completion_tokens", 0)
+            return tokens, time.perf_counter() - story_start
         
-        evaluations.append(evaluation)
-        scores.append(score)
+        on_token = print_token if stream else None
+        early_exit_score = target_score if early_exit_judge else None
         
-        print(f"\n[Evaluation {iteration}]:\n{evaluation}")
-        print(f"\n>>> Current Score: {score}/10")
+        library_mode, seed = library.lookup(user_input, target_score) if library is not None else (None, None)
+        if library_mode == "served":
+            print(f"\n📚 Serving a stored story ({seed['similarity']:.0%} match for \"{seed['request']}\", "
+                  f"score {seed['score']}/10)")
+            print(f"\n{seed['story']}")
+            story_span.set(category=seed["category"], library="served", scores=seed["scores"])
+            return seed["story"], seed["evaluations"], seed["scores"], [seed["story"]], seed["category"]
+    
+        first_evaluation = None
+        if library_mode == "seeded":
+            # Adapt a similar stored story instead of drafting from scratch
+            story, category = adapt_library_story(seed, user_input, on_token=on_token)
+            story_span.set(library="seeded", seed_id=seed["id"])
+            if stream:
+                print()
+            else:
+                print(f"\n[Adapted Draft]:\n{story}")
+        elif num_drafts > 1:
+            # Speculative drafting: N drafts and N judgements in parallel, keep the best
+            drafts, category = generate_initial_drafts(user_input, num_drafts=num_drafts)
+            draft_evaluations, draft_scores, draft_ranking = judge_drafts(
+                drafts, early_exit_score, category=category if safety_prefilter else None,
+                listwise=listwise_judge
+            )
+            best_idx = draft_ranking[0]
+            story, first_evaluation = drafts[best_idx], draft_evaluations[best_idx]
+            print(f"\nDraft scores: {', '.join(f'{s}/10' for s in draft_scores)}")
+            print(f"\n[Best Initial Draft (Draft {best_idx + 1})]:\n{story}")
+        else:
+            # Initial story generation with category detection
+            story, category = generate_initial_story(user_input, on_token=on_token)
+            if stream:
+                print()  # Draft was already streamed to the console
+            else:
+                print(f"\n[Initial Draft]:\n{story}")
+    
+        story_span.set(category=category)  # Later stage spans inherit the category
+    
+        evaluations = []
+        scores = []
+        story_versions = [story]  # Track all story versions
+        checkpoints = []  # (tokens, seconds) after each judgement, for the trajectory log
+        previous_evaluation = None
+        judge_calls_avoided = 0
+        if first_evaluation is not None:
+            judge_calls_avoided = sum(is_safety_feedback(e) for e in draft_evaluations)
+    
+        # Iterative improvement loop
+        for iteration in range(1, max_iterations + 1):
+            safety_feedback = None
+            if safety_prefilter and not (iteration == 1 and first_evaluation is not None):
+                with tracer.span("safety_prefilter", iteration=iteration) as span:
+                    safety_feedback = prefilter_story(story, category)
+                    span.set(passed=safety_feedback is None)
         
-        # Check if we've reached the target score
-        if score >= target_score:
-            print(f"\n✓ Story meets quality threshold of {target_score}/10!")
-            if iteration < max_iterations:
-                print(f"Skipping remaining {max_iterations - iteration} iteration(s).")
-            break
+            # Judge the current story (with comparative feedback after first iteration)
+            if iteration == 1 and first_evaluation is not None:
+                evaluation = first_evaluation  # Already judged alongside the other drafts
+            elif safety_feedback is not None:
+                banner = f"STEP {iteration * 2}: CONTENT SAFETY PREFILTER FAILED (Iteration {iteration}) - SKIPPING JUDGE"
+                with tracer.span("judge", iteration=iteration, skipped=True, banner=banner) as span:
+                    evaluation = safety_feedback
+                    span.set(score=extract_score_from_evaluation(evaluation))
+                judge_calls_avoided += 1
+            else:
+                evaluation = judge_story(story, iteration, previous_evaluation, early_exit_score)
+            score = extract_score_from_evaluation(evaluation)
         
-        # Check for plateau (score not improving)
-        if len(scores) >= 2 and scores[-1] <= scores[-2]:
-            print(f"\n⚠ Score plateaued at {score}/10 (no improvement from previous iteration).")
-            if iteration < max_iterations:
-                print(f"Continuing to try {max_iterations - iteration} more iteration(s)...")
+            evaluations.append(evaluation)
+            scores.append(score)
+            checkpoints.append(usage())
         
-        # Check if this is the last iteration
-        if iteration == max_iterations:
-            print(f"\n⚠ Max iterations ({max_iterations}) reached.")
-            print(f"Final score: {score}/10 (target was {target_score}/10)")
+            print(f"\n[Evaluation {iteration}]:\n{evaluation}")
+            print(f"\n>>> Current Score: {score}/10")
+        
+            # Check if we've reached the target score
+            if score >= target_score:
+                print(f"\n✓ Story meets quality threshold of {target_score}/10!")
+                if iteration < max_iterations:
+                    print(f"Skipping remaining {max_iterations - iteration} iteration(s).")
+                break
+        
+            # Ask the stopping policy whether another round is worth its cost
+            stop_reason = None
+            if policy is not None and iteration < max_iterations:
+                stop_reason = policy.should_stop(category, scores, *checkpoints[-1])
+        
+            # Check for plateau (score not improving)
+            if len(scores) >= 2 and scores[-1] <= scores[-2]:
+                print(f"\n⚠ Score plateaued at {score}/10 (no improvement from previous iteration).")
+                if iteration < max_iterations and not stop_reason:
+                    print(f"Continuing to try {max_iterations - iteration} more iteration(s)...")
+        
+            # Check if this is the last iteration
+            if iteration == max_iterations or stop_reason:
+                if stop_reason:
+                    print(f"\n⏹ Stopping after iteration {iteration}: {stop_reason}")
+                else:
+                    print(f"\n⚠ Max iterations ({max_iterations}) reached.")
+                print(f"Final score: {score}/10 (target was {target_score}/10)")
             
-            # Find and return the best version
-            best_score_idx = scores.index(max(scores))
-            if best_score_idx < len(story_versions) - 1:
-                print(f"\n📌 Returning best version from iteration {best_score_idx + 1} with score {scores[best_score_idx]}/10")
-                story = story_versions[best_score_idx]
-            break
+                # Find and return the best version
+                if listwise_judge:
+                    best_score_idx = rank_versions(story_versions, scores)
+                else:
+                    best_score_idx = scores.index(max(scores))
+                if best_score_idx < len(story_versions) - 1:
+                    print(f"\n📌 Returning best version from iteration {best_score_idx + 1} with score {scores[best_score_idx]}/10")
+                    story = story_versions[best_score_idx]
+                break
         
-        # Improve the story based on feedback
-        previous_evaluation = evaluation
-        story = improve_story(story, evaluation, iteration)
-        story_versions.append(story)
-        print(f"\n[Improved Story (Version {iteration + 1})]:\n{story}")
-    
-    return story, evaluations, scores, story_versions, category
+            # Improve the story based on feedback
+            previous_evaluation = evaluation
+            story = improve_story(story, evaluation, iteration, on_token=on_token, targeted=targeted_revision)
+            story_versions.append(story)
+            if stream:
+                print()
+            else:
+                print(f"\n[Improved Story (Version {iteration + 1})]:\n{story}")
+    
+        if judge_calls_avoided:
+            print(f"\n🛡 Content safety prefilter avoided {judge_calls_avoided} judge call(s).")
+    
+        story_span.set(scores=scores, judge_calls_avoided=judge_calls_avoided)
+        log_trajectory(
+            category, scores,
+            round_tokens=[after[0] - before[0] for before, after in zip(checkpoints, checkpoints[1:])],
+            round_seconds=[after[1] - before[1] for before, after in zip(checkpoints, checkpoints[1:])],
+            target_score=target_score,
+            initial_tokens=checkpoints[0][0] if checkpoints else 0,
+            initial_seconds=checkpoints[0][1] if checkpoints else 0.0,
+        )
+        if library is not None:
+            library.add(user_input, category, story, scores, evaluations,
+                        score=max(score for version, score in zip(story_versions, scores) if version == story))
+        return story, evaluations, scores, story_versions, category
 
 
 def get_user_feedback(story: str, category: str) -> tuple:
@@ -365,28 +827,39 @@ def generate_audio_story(story: str, output_filename: str = "bedtime_story.mp3",
         return ""
 
 
-def apply_user_feedback(story: str, feedback: str, category: str) -> str:
-    """Apply user feedback to regenerate the story."""
-    print("\n" + "="*70)
-    print("APPLYING USER FEEDBACK")
-    print("="*70)
-    
-    feedback_prompt = f"""You are an expert children's storyteller. Here is a bedtime story you wrote:
+def build_feedback_prompt(story: str, feedback: str, category: str) -> str:
+    """Build the prompt asking the storyteller to apply the reader's requested change."""
+    return FEEDBACK_PROMPT.format(story=story, feedback=feedback, category=category)
 
-{story}
 
-The reader has requested the following change:
-{feedback}
-
-Please rewrite the story incorporating this feedback while maintaining:
-- Age-appropriateness for 5-10 year olds
-- Bedtime suitability (calming, peaceful ending)
-- The {category} story style
-
-Revised Story:"""
+def apply_user_feedback(story: str, feedback: str, category: str, on_token=None, targeted: bool = False) -> str:
+    """
+    Apply user feedback to regenerate the story (streamed to on_token when given).
     
-    revised_story = call_model(feedback_prompt, max_tokens=600, temperature=0.7)
-    print(f"\n[Revised Story Based on Feedback]:\n{revised_story}")
+    With targeted=True, feedback about specific paragraphs, characters or the
+    opening/ending only rewrites those paragraphs.
+    """
+    feedback_prompt = build_feedback_prompt(story, feedback, category)
+    
+    with tracer.span("feedback", category=category, banner="APPLYING USER FEEDBACK") as span:
+        plan = plan_revision(story, feedback) if targeted else None
+        if plan is not None:
+            feedback_intro = f"The reader has requested the following change (keep the {category} story style):"
+            revised_story = revise_paragraphs(plan, feedback, feedback_intro, stage="feedback")
+            if revised_story is not None:
+                span.set(mode="targeted", paragraphs=[index + 1 for index in plan[1]])
+                print(f"\n[Revised Story Based on Feedback]:\n{revised_story}")
+                return revised_story
+        span.set(mode="full")
+        if on_token is not None:
+            print("\n[Revised Story Based on Feedback]:")
+            revised_story = collect_stream(
+                stream_model(feedback_prompt, max_tokens=600, temperature=0.7, stage="feedback"), on_token
+            )
+            print()
+        else:
+            revised_story = call_model(feedback_prompt, max_tokens=600, temperature=0.7, stage="feedback")
+            print(f"\n[Revised Story Based on Feedback]:\n{revised_story}")
     return revised_story
 
 
@@ -400,11 +873,13 @@ def main():
     
     user_input = input("What kind of story do you want to hear? ")
     
-    # Generate story with quality control
+    # Generate story with quality control (served from the story library when STORY_LIBRARY_PATH is set)
     final_story, evaluations, scores, story_versions, category = generate_story_with_quality_control(
         user_input, 
         target_score=8, 
-        max_iterations=3
+        max_iterations=3,
+        stream=True,
+        library=open_library()
     )
     
     # Display final results
@@ -416,7 +891,7 @@ def main():
     # User feedback loop
     feedback_text, needs_changes = get_user_feedback(final_story, category)
     if needs_changes:
-        final_story = apply_user_feedback(final_story, feedback_text, category)
+        final_story = apply_user_feedback(final_story, feedback_text, category, on_token=print_token)
         print("\n" + "="*70)
         print("FINAL STORY (AFTER USER FEEDBACK)")
         print("="*70)
@@ -0,0 +1,295 @@
+"""
+Local Mock OpenAI Server
+A stand-in for the ChatCompletion endpoint so the pipeline can be benchmarked and
+regression-tested without spending API money.
+
+- Configurable latency distribution (lognormal around a median) and token throughput
+- Error injection: random 5xx errors and 429 rate limits
+- Prompt-aware canned responses: category words, templated stories, judge
+  evaluations that follow a scripted score trajectory (single or listwise batches),
+  and targeted paragraph rewrites
+- Supports stream=True (server-sent events), like the real API
+
+Usage:
+    python mock_openai_server.py --port 8765 --latency-ms 400 --trajectory 6.5,7.5,8.5
+    # then point the client at it: OPENAI_API_BASE=http://127.0.0.1:8765/v1
+"""
+
+import argparse
+import json
+import math
+import random
+import re
+import threading
+import time
+import uuid
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+from category_classifier import get_classifier
+
+SCORE_PATTERN = re.compile(r'Score:\s*(\d+(?:\.\d+)?)/10')
+
+STORY_TEMPLATE = """Once upon a time, in a quiet little village at the edge of a meadow, there lived {hero}. Every evening, {hero} watched the sky turn from gold to soft lavender and wondered what the night would bring.
+
+One gentle evening, {hero} set out to {quest}. Along the way, a friendly owl named Hoot offered to help, and together they followed a path of glowing fireflies through the tall, whispering grass. They stopped to share berries with a family of rabbits and listened to the crickets sing their evening song.
+
+At last they found what they were looking for, and {hero} smiled the biggest smile. "Thank you for helping me," {hero} said to Hoot. "Everything is better with a friend."
+
+As the moon rose high and round, {hero} walked home, climbed into a warm, cozy bed, and drifted off to sleep, dreaming of tomorrow's adventures. The end."""
+
+EVALUATION_TEMPLATE = """Score: {score:g}/10
+Strengths: Gentle pacing and warm imagery; a clear beginning, middle and end; age-appropriate vocabulary.
+Weaknesses: The middle section could be more vivid; the main character's feelings are told rather than shown.
+Suggestions: Add one sensory detail to the second paragraph and let the hero express a feeling in their own words."""
+
+
+class MockConfig:
+    """Behaviour of the mock server; every field can be changed while it is running."""
+
+    def __init__(self, latency_ms: float = 300.0, latency_sigma: float = 0.5, tokens_per_second: float = 80.0,
+                 error_rate: float = 0.0, rate_limit_rate: float = 0.0, trajectory: list = None,
+                 score_jitter: float = 0.0, seed: int = None):
+        """
+        Args:
+            latency_ms: Median time to first token
+            latency_sigma: Lognormal sigma of the first-token latency (0 = fixed)
+            tokens_per_second: Completion throughput after the first token
+            error_rate: Probability of answering with HTTP 500
+            rate_limit_rate: Probability of answering with HTTP 429
+            trajectory: Judge scores for successive versions of a story, e.g. [6.5, 7.5, 8.5]
+            score_jitter: Uniform +/- noise added to first-draft scores (for best-of-N runs)
+            seed: Random seed for reproducible runs
+        """
+        self.latency_ms = latency_ms
+        self.latency_sigma = latency_sigma
+        self.tokens_per_second = tokens_per_second
+        self.error_rate = error_rate
+        self.rate_limit_rate = rate_limit_rate
+        self.trajectory = trajectory or [6.5, 7.5, 8.5]
+        self.score_jitter = score_jitter
+        self.random = random.Random(seed)
+        self.lock = threading.Lock()
+        self.counters = {"requests": 0, "errors": 0, "rate_limited": 0}
+
+    def sample_latency(self) -> float:
+        with self.lock:
+            if self.latency_sigma <= 0:
+                return self.latency_ms / 1000
+            return self.random.lognormvariate(math.log(self.latency_ms / 1000), self.latency_sigma)
+
+    def roll(self, probability: float) -> bool:
+        with self.lock:
+            return self.random.random() < probability
+
+    def count(self, name: str):
+        with self.lock:
+            self.counters[name] += 1
+
+
+def count_tokens(text: str) -> int:
+    """Approximate token count, matching the client's estimate."""
+    return len(text) // 4 + 1
+
+
+def next_score(prompt: str, config: MockConfig) -> float:
+    """
+    Score for a judge prompt, following the scripted trajectory.
+
+    The first judgement gets trajectory[0]; a comparative judgement quotes the previous
+    score, so it gets the value that follows it.
+    """
+    trajectory = config.trajectory
+    previous = SCORE_PATTERN.search(prompt)
+    if previous is None:
+        score = trajectory[0]
+        if config.score_jitter:
+            with config.lock:
+                score += config.random.uniform(-config.score_jitter, config.score_jitter)
+        return round(min(10.0, max(1.0, score)) * 2) / 2
+    previous_score = float(previous.group(1))
+    if previous_score in trajectory:
+        return trajectory[min(trajectory.index(previous_score) + 1, len(trajectory) - 1)]
+    higher = [score for score in trajectory if score > previous_score]
+    return higher[0] if higher else trajectory[-1]
+
+
+def build_story(prompt: str) -> str:
+    """Fill the story template with words from the request so stories differ per request."""
+    match = re.search(r"based on this request: (.+)", prompt)
+    request = match.group(1).strip() if match else "a curious little bunny"
+    hero_match = re.search(r"\b(?:a|an|the)\s+([a-z]+(?:\s+[a-z]+)?)", request.lower())
+    hero = f"a {hero_match.group(1)}" if hero_match else "a curious little bunny"
+    return STORY_TEMPLATE.format(hero=hero, quest="find the brightest star in the sky")
+
+
+def build_revised_paragraphs(prompt: str) -> str:
+    """Answer a targeted-revision prompt: each requested paragraph with one gentle sentence added."""
+    paragraphs = dict(re.findall(r"^\[(\d+)\] (.+)$", prompt, re.MULTILINE))
+    requested = re.search(r"Rewrite ONLY paragraph\(s\) ([\d, ]+)", prompt)
+    numbers = re.findall(r"\d+", requested.group(1)) if requested else []
+    return "\n\n".join(
+        f"[{number}] {paragraphs.get(number, '')} A soft breeze hummed a sleepy tune, and everything felt warm and safe."
+        for number in numbers
+    )
+
+
+def build_batch_evaluation(prompt: str, config: MockConfig) -> str:
+    """Answer a listwise judge prompt: one evaluation per story block, then a ranking."""
+    stories_text = prompt.split("=== End of stories ===")[0]
+    blocks = re.split(r"^=== Story (\d+) ===$", stories_text, flags=re.MULTILINE)
+    scores = {int(number): next_score(block, config) for number, block in zip(blocks[1::2], blocks[2::2])}
+    parts = [f"Story {number}:\n" + EVALUATION_TEMPLATE.format(score=score) for number, score in scores.items()]
+    ranking = sorted(scores, key=lambda number: -scores[number])
+    parts.append("Ranking: " + ", ".join(str(number) for number in ranking))
+    return "\n\n".join(parts)
+
+
+def build_reply(prompt: str, config: MockConfig) -> str:
+    """Choose a canned response based on which agent's prompt this is."""
+    stripped = prompt.rstrip()
+    if stripped.endswith("Category:"):
+        request = re.search(r"Story request: (.+)", prompt)
+        category, _ = get_classifier().predict(request.group(1) if request else prompt)
+        return category
+    if stripped.endswith("Evaluation:"):
+        return EVALUATION_TEMPLATE.format(score=next_score(prompt, config))
+    if stripped.endswith("Evaluations:"):
+        return build_batch_evaluation(prompt, config)
+    if stripped.endswith("Revised Paragraphs:"):
+        return build_revised_paragraphs(prompt)
+    return build_story(prompt)
+
+
+class MockHandler(BaseHTTPRequestHandler):
+    config = MockConfig()
+
+    def log_message(self, format, *args):
+        pass  # Keep benchmark output clean
+
+    def _send_json(self, status: int, payload: dict):
+        body = json.dumps(payload).encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_POST(self):
+        if not self.path.rstrip("/").endswith("/chat/completions"):
+            self._send_json(404, {"error": {"message": f"Unknown path {self.path}", "type": "invalid_request_error"}})
+            return
+
+        length = int(self.headers.get("Content-Length", 0))
+        request = json.loads(self.rfile.read(length) or b"{}")
+        config = self.config
+        config.count("requests")
+
+        if config.roll(config.rate_limit_rate):
+            config.count("rate_limited")
+            self._send_json(429, {"error": {"message": "Rate limit reached (mock)", "type": "rate_limit_error"}})
+            return
+        if config.roll(config.error_rate):
+            config.count("errors")
+            self._send_json(500, {"error": {"message": "Internal server error (mock)", "type": "server_error"}})
+            return
+
+        prompt = request["messages"][-1]["content"]
+        reply = build_reply(prompt, config)
+        max_tokens = request.get("max_tokens") or 800
+        words = re.findall(r"\S+\s*", reply)
+        while words and count_tokens("".join(words)) > max_tokens:
+            words.pop()
+        reply = "".join(words)
+
+        time.sleep(config.sample_latency())
+        if request.get("stream"):
+            self._stream(request, words)
+        else:
+            time.sleep(count_tokens(reply) / config.tokens_per_second)
+            self._send_json(200, {
+                "id": f"chatcmpl-mock-{uuid.uuid4().hex[:12]}",
+                "object": "chat.completion",
+                "created": int(time.time()),
+                "model": request.get("model", "mock"),
+                "choices": [{"index": 0, "message": {"role": "assistant", "content": reply}, "finish_reason": "stop"}],
+                "usage": {
+                    "prompt_tokens": count_tokens(prompt),
+                    "completion_tokens": count_tokens(reply),
+                    "total_tokens": count_tokens(prompt) + count_tokens(reply),
+                },
+            })
+
+    def _stream(self, request: dict, words: list):
+        self.send_response(200)
+        self.send_header("Content-Type", "text/event-stream")
+        self.send_header("Cache-Control", "no-cache")
+        self.end_headers()
+        chunk_id = f"chatcmpl-mock-{uuid.uuid4().hex[:12]}"
+        try:
+            for word in words:
+                time.sleep(count_tokens(word) / self.config.tokens_per_second)
+                chunk = {
+                    "id": chunk_id,
+                    "object": "chat.completion.chunk",
+                    "created": int(time.time()),
+                    "model": request.get("model", "mock"),
+                    "choices": [{"index": 0, "delta": {"content": word}, "finish_reason": None}],
+                }
+                self.wfile.write(f"data: {json.dumps(chunk)}\n\n".encode("utf-8"))
+                self.wfile.flush()
+            self.wfile.write(b"data: [DONE]\n\n")
+            self.wfile.flush()
+        except (BrokenPipeError, ConnectionResetError):
+            pass  # Client cancelled the stream (e.g. early-exit judging)
+
+
+def start_mock_server(config: MockConfig = None, host: str = "127.0.0.1", port: int = 0) -> tuple:
+    """
+    Start the mock server on a background thread.
+
+    Returns:
+        (server, api_base) - call server.shutdown() to stop it
+    """
+    handler = type("ConfiguredMockHandler", (MockHandler,), {"config": config or MockConfig()})
+    server = ThreadingHTTPServer((host, port), handler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server, f"http://{host}:{server.server_address[1]}/v1"
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Run a local mock of the OpenAI ChatCompletion endpoint.")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8765)
+    parser.add_argument("--latency-ms", type=float, default=300.0, help="Median time to first token")
+    parser.add_argument("--latency-sigma", type=float, default=0.5, help="Lognormal spread of latency")
+    parser.add_argument("--tokens-per-second", type=float, default=80.0)
+    parser.add_argument("--error-rate", type=float, default=0.0, help="Fraction of HTTP 500 responses")
+    parser.add_argument("--rate-limit-rate", type=float, default=0.0, help="Fraction of HTTP 429 responses")
+    parser.add_argument("--trajectory", default="6.5,7.5,8.5", help="Judge scores for successive versions")
+    parser.add_argument("--score-jitter", type=float, default=0.0)
+    parser.add_argument("--seed", type=int)
+    args = parser.parse_args()
+
+    config = MockConfig(
+        latency_ms=args.latency_ms,
+        latency_sigma=args.latency_sigma,
+        tokens_per_second=args.tokens_per_second,
+        error_rate=args.error_rate,
+        rate_limit_rate=args.rate_limit_rate,
+        trajectory=[float(score) for score in args.trajectory.split(",")],
+        score_jitter=args.score_jitter,
+        seed=args.seed,
+    )
+    server, api_base = start_mock_server(config, args.host, args.port)
+    print(f"🧪 Mock OpenAI server listening on {api_base}")
+    print(f"   Set OPENAI_API_BASE={api_base} (any OPENAI_API_KEY works)")
+    try:
+        while True:
+            time.sleep(3600)
+    except KeyboardInterrupt:
+        server.shutdown()
+
+
+if __name__ == "__main__":
+    main()
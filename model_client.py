@@ -0,0 +1,498 @@
+"""
+Shared OpenAI Model Client
+A single, reusable client for every agent (category detector, storyteller,
+judge, feedback applier) so the whole process stays inside one API quota.
+
+- Keeps HTTP connections alive (one requests.Session / aiohttp session)
+- Token-bucket limits on both requests per minute and tokens per minute
+- Retries 429s and transient 5xx/connection errors with jittered exponential backoff
+- Honours a per-call deadline across queueing and all retry attempts
+- Optional on-disk response cache for low-temperature calls (see response_cache.py)
+- Streaming variants that yield tokens as they arrive and can be cancelled early
+- A "call_model" tracing span per call (wait time, tokens, cache hit, retries)
+
+Configuration comes from the environment (OPENAI_API_KEY, OPENAI_MODEL,
+OPENAI_RPM, OPENAI_TPM, STORY_CACHE_PATH) or from ModelClient arguments.
+"""
+
+import asyncio
+import os
+import random
+import threading
+import time
+
+from response_cache import ResponseCache, make_cache_key
+from tracing import tracer
+
+DEFAULT_MODEL = "gpt-3.5-turbo"
+
+# Names in openai.error (resolved on first use, like the openai import itself)
+RETRYABLE_ERRORS = ("RateLimitError", "Timeout", "APIConnectionError", "ServiceUnavailableError", "TryAgain")
+
+
+class DeadlineExceeded(TimeoutError):
+    """Raised when a model call cannot finish before its deadline."""
+
+
+def estimate_tokens(text: str) -> int:
+    """Rough token count (~4 characters per token) used for rate limiting."""
+    return len(text) // 4 + 1
+
+
+def is_retryable(error: Exception) -> bool:
+    """Return True for rate limits, timeouts and transient server errors."""
+    import openai
+
+    if isinstance(error, tuple(getattr(openai.error, name) for name in RETRYABLE_ERRORS)):
+        return True
+    if isinstance(error, openai.error.APIError):
+        status = getattr(error, "http_status", None)
+        return status is None or status >= 500
+    return False
+
+
+class TokenBucket:
+    """
+    Thread-safe token bucket refilled continuously at `per_minute` tokens per minute.
+
+    reserve() deducts immediately and returns how long the caller must wait before
+    using the reservation, so sync and async callers can share one bucket.
+    """
+
+    def __init__(self, per_minute: float):
+        self.capacity = float(per_minute)
+        self.rate = self.capacity / 60.0
+        self.tokens = self.capacity
+        self.updated = time.monotonic()
+        self.lock = threading.Lock()
+
+    def _refill(self):
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def reserve(self, amount: float) -> float:
+        """Take `amount` tokens and return the seconds to wait until they are available."""
+        amount = min(amount, self.capacity)
+        with self.lock:
+            self._refill()
+            self.tokens -= amount
+            if self.tokens >= 0:
+                return 0.0
+            return -self.tokens / self.rate
+
+    def refund(self, amount: float):
+        """Give back tokens that were reserved but not used."""
+        if amount <= 0:
+            return
+        with self.lock:
+            self._refill()
+            self.tokens = min(self.capacity, self.tokens + amount)
+
+
+class ModelClient:
+    """Rate-limited, retrying chat completion client shared by all agents."""
+
+    def __init__(self, model: str = None, api_key: str = None, requests_per_minute: float = None,
+                 tokens_per_minute: float = None, max_retries: int = 5, base_delay: float = 1.0,
+                 max_delay: float = 30.0, timeout: float = 60.0, cache: ResponseCache = None):
+        """
+        Args:
+            model: Chat model name (default: $OPENAI_MODEL or gpt-3.5-turbo)
+            api_key: API key (default: $OPENAI_API_KEY)
+            requests_per_minute: RPM limit (default: $OPENAI_RPM or 3500)
+            tokens_per_minute: TPM limit (default: $OPENAI_TPM or 90000)
+            max_retries: Retries after the first attempt for retryable errors
+            base_delay: First backoff delay in seconds (doubles each retry)
+            max_delay: Upper bound on a single backoff delay
+            timeout: Default per-call deadline in seconds, including retries
+            cache: Optional ResponseCache consulted before calling the API
+        """
+        self.model = model or os.getenv("OPENAI_MODEL", DEFAULT_MODEL)
+        self.api_key = api_key or os.getenv("OPENAI_API_KEY")
+        self.request_bucket = TokenBucket(requests_per_minute or float(os.getenv("OPENAI_RPM", 3500)))
+        self.token_bucket = TokenBucket(tokens_per_minute or float(os.getenv("OPENAI_TPM", 90000)))
+        self.max_retries = max_retries
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.timeout = timeout
+        self.cache = cache
+        self.stats = {"calls": 0, "retries": 0, "prompt_tokens": 0, "completion_tokens": 0}
+        self._stats_lock = threading.Lock()
+        self._session = None
+        self._aiosessions = {}
+
+    # ------------------------------------------------------------------
+    # Shared helpers
+    # ------------------------------------------------------------------
+
+    def _request_kwargs(self, prompt: str, max_tokens: int, temperature: float, request_timeout: float,
+                        stream: bool = False, model: str = None) -> dict:
+        return {
+            "model": model or self.model,
+            "messages": [{"role": "user", "content": prompt}],
+            "stream": stream,
+            "max_tokens": max_tokens,
+            "temperature": temperature,
+            "api_key": self.api_key,
+            "request_timeout": request_timeout,
+        }
+
+    def _reserve(self, prompt: str, max_tokens: int) -> tuple:
+        """Reserve one request and the estimated tokens; returns (wait_seconds, reserved_tokens)."""
+        reserved = estimate_tokens(prompt) + max_tokens
+        wait = max(self.request_bucket.reserve(1), self.token_bucket.reserve(reserved))
+        return wait, reserved
+
+    def _backoff(self, attempt: int, error: Exception) -> float:
+        """Full-jitter exponential backoff, respecting a Retry-After header when present."""
+        headers = getattr(error, "headers", None) or {}
+        retry_after = headers.get("retry-after") if hasattr(headers, "get") else None
+        if retry_after:
+            try:
+                return min(self.max_delay, float(retry_after))
+            except ValueError:
+                pass
+        return random.uniform(0, min(self.max_delay, self.base_delay * (2 ** attempt)))
+
+    def _record(self, resp, reserved: int, span):
+        usage = resp.get("usage") or {}
+        span.set(prompt_tokens=usage.get("prompt_tokens", 0), completion_tokens=usage.get("completion_tokens", 0))
+        with self._stats_lock:
+            self.stats["calls"] += 1
+            self.stats["prompt_tokens"] += usage.get("prompt_tokens", 0)
+            self.stats["completion_tokens"] += usage.get("completion_tokens", 0)
+        if usage.get("total_tokens"):
+            self.token_bucket.refund(reserved - usage["total_tokens"])
+
+    def _record_stream(self, prompt: str, content: str, reserved: int, span):
+        """Streamed responses carry no usage block, so count estimated tokens instead."""
+        prompt_tokens, completion_tokens = estimate_tokens(prompt), estimate_tokens(content)
+        span.set(prompt_tokens=prompt_tokens, completion_tokens=completion_tokens)
+        with self._stats_lock:
+            self.stats["calls"] += 1
+            self.stats["prompt_tokens"] += prompt_tokens
+            self.stats["completion_tokens"] += completion_tokens
+        self.token_bucket.refund(reserved - prompt_tokens - completion_tokens)
+
+    @staticmethod
+    def _delta(chunk) -> str:
+        return chunk.choices[0].delta.get("content") or ""
+
+    def _cache_key(self, prompt: str, max_tokens: int, temperature: float, pin_cache: bool, model: str):
+        """Cache key for this call, or None when the call should bypass the cache."""
+        if self.cache is None or not self.cache.should_cache(temperature, pin_cache):
+            return None
+        return make_cache_key(model, prompt, temperature, max_tokens)
+
+    def _count_retry(self, span):
+        span.add("retries")
+        with self._stats_lock:
+            self.stats["retries"] += 1
+
+    @staticmethod
+    def _remaining(deadline: float) -> float:
+        return deadline - time.monotonic()
+
+    # ------------------------------------------------------------------
+    # Sync API
+    # ------------------------------------------------------------------
+
+    def _sync_session(self):
+        if self._session is None:
+            import requests
+            from requests.adapters import HTTPAdapter
+
+            session = requests.Session()
+            adapter = HTTPAdapter(pool_connections=4, pool_maxsize=64)
+            session.mount("https://", adapter)
+            session.mount("http://", adapter)
+            self._session = session
+        return self._session
+
+    def complete(self, prompt: str, max_tokens=800, temperature=0.1, timeout: float = None,
+                 pin_cache: bool = False, model: str = None) -> str:
+        """Blocking chat completion with rate limiting, retries and a deadline (model overrides the default)."""
+        model = model or self.model
+        with tracer.span("call_model", model=model, max_tokens=max_tokens, temperature=temperature) as span:
+            cache_key = self._cache_key(prompt, max_tokens, temperature, pin_cache, model)
+            if cache_key is not None:
+                cached = self.cache.get(cache_key)
+                span.set(cache_hit=cached is not None)
+                if cached is not None:
+                    return cached
+
+            content = self._complete(prompt, max_tokens, temperature, timeout, span, model)
+            if cache_key is not None:
+                self.cache.put(cache_key, content)
+            return content
+
+    def _complete(self, prompt: str, max_tokens: int, temperature: float, timeout: float, span, model: str) -> str:
+        import openai  # Deferred: openai (and what it imports) dominates cold start
+
+        deadline = time.monotonic() + (timeout or self.timeout)
+        openai.requestssession = self._sync_session()
+
+        for attempt in range(self.max_retries + 1):
+            wait, reserved = self._reserve(prompt, max_tokens)
+            if wait >= self._remaining(deadline):
+                self.token_bucket.refund(reserved)
+                raise DeadlineExceeded(f"rate limit wait of {wait:.1f}s exceeds the call deadline")
+            if wait > 0:
+                span.add("wait_seconds", wait)
+                time.sleep(wait)
+            try:
+                resp = openai.ChatCompletion.create(
+                    **self._request_kwargs(prompt, max_tokens, temperature, self._remaining(deadline), model=model)
+                )
+                self._record(resp, reserved, span)
+                return resp.choices[0].message["content"]  # type: ignore
+            except Exception as e:
+                self.token_bucket.refund(reserved)  # The failed attempt used none of its reservation
+                if not is_retryable(e) or attempt == self.max_retries:
+                    raise
+                delay = self._backoff(attempt, e)
+                if delay >= self._remaining(deadline):
+                    raise DeadlineExceeded(f"deadline reached after {attempt + 1} attempt(s): {e}") from e
+                self._count_retry(span)
+                time.sleep(delay)
+
+    def stream(self, prompt: str, max_tokens=800, temperature=0.1, timeout: float = None,
+               pin_cache: bool = False, model: str = None):
+        """
+        Yield the completion in pieces as they arrive.
+
+        Errors before the first chunk are retried like complete(); once text has been
+        yielded the call is not retried. Closing the generator early cancels the request,
+        and a cancelled response is never written to the cache.
+        """
+        model = model or self.model
+        span = tracer.start_span("call_model", model=model, max_tokens=max_tokens,
+                                 temperature=temperature, stream=True)
+        try:
+            yield from self._stream(prompt, max_tokens, temperature, timeout, pin_cache, span, model)
+        finally:
+            span.end()
+
+    def _stream(self, prompt: str, max_tokens: int, temperature: float, timeout: float, pin_cache: bool, span,
+                model: str):
+        cache_key = self._cache_key(prompt, max_tokens, temperature, pin_cache, model)
+        if cache_key is not None:
+            cached = self.cache.get(cache_key)
+            span.set(cache_hit=cached is not None)
+            if cached is not None:
+                yield cached
+                return
+
+        import openai  # Deferred: openai (and what it imports) dominates cold start
+
+        deadline = time.monotonic() + (timeout or self.timeout)
+        openai.requestssession = self._sync_session()
+
+        for attempt in range(self.max_retries + 1):
+            wait, reserved = self._reserve(prompt, max_tokens)
+            if wait >= self._remaining(deadline):
+                self.token_bucket.refund(reserved)
+                raise DeadlineExceeded(f"rate limit wait of {wait:.1f}s exceeds the call deadline")
+            if wait > 0:
+                span.add("wait_seconds", wait)
+                time.sleep(wait)
+            try:
+                chunks = openai.ChatCompletion.create(
+                    **self._request_kwargs(prompt, max_tokens, temperature, self._remaining(deadline), stream=True,
+                                         model=model)
+                )
+                first_chunk = next(chunks, None)
+                break
+            except Exception as e:
+                self.token_bucket.refund(reserved)  # The failed attempt used none of its reservation
+                if not is_retryable(e) or attempt == self.max_retries:
+                    raise
+                delay = self._backoff(attempt, e)
+                if delay >= self._remaining(deadline):
+                    raise DeadlineExceeded(f"deadline reached after {attempt + 1} attempt(s): {e}") from e
+                self._count_retry(span)
+                time.sleep(delay)
+
+        parts = []
+        try:
+            if first_chunk is not None:
+                parts.append(self._delta(first_chunk))
+                if parts[-1]:
+                    yield parts[-1]
+                for chunk in chunks:
+                    parts.append(self._delta(chunk))
+                    if parts[-1]:
+                        yield parts[-1]
+        finally:
+            if hasattr(chunks, "close"):
+                chunks.close()
+            self._record_stream(prompt, "".join(parts), reserved, span)
+
+        if cache_key is not None:
+            self.cache.put(cache_key, "".join(parts))
+
+    # ------------------------------------------------------------------
+    # Async API
+    # ------------------------------------------------------------------
+
+    def _async_session(self):
+        """One keep-alive aiohttp session per event loop."""
+        loop = asyncio.get_running_loop()
+        session = self._aiosessions.get(loop)
+        if session is None or session.closed:
+            import aiohttp
+
+            session = aiohttp.ClientSession(connector=aiohttp.TCPConnector(limit=100))
+            self._aiosessions[loop] = session
+        return session
+
+    async def acomplete(self, prompt: str, max_tokens=800, temperature=0.1, timeout: float = None,
+                        pin_cache: bool = False, model: str = None) -> str:
+        """Async chat completion with rate limiting, retries and a deadline."""
+        model = model or self.model
+        with tracer.span("call_model", model=model, max_tokens=max_tokens, temperature=temperature) as span:
+            cache_key = self._cache_key(prompt, max_tokens, temperature, pin_cache, model)
+            if cache_key is not None:
+                cached = await self.cache.aget(cache_key)
+                span.set(cache_hit=cached is not None)
+                if cached is not None:
+                    return cached
+
+            content = await self._acomplete(prompt, max_tokens, temperature, timeout, span, model)
+            if cache_key is not None:
+                await self.cache.aput(cache_key, content)
+            return content
+
+    async def _acomplete(self, prompt: str, max_tokens: int, temperature: float, timeout: float, span,
+                         model: str) -> str:
+        import openai  # Deferred: openai (and what it imports) dominates cold start
+
+        deadline = time.monotonic() + (timeout or self.timeout)
+        openai.aiosession.set(self._async_session())
+
+        for attempt in range(self.max_retries + 1):
+            wait, reserved = self._reserve(prompt, max_tokens)
+            if wait >= self._remaining(deadline):
+                self.token_bucket.refund(reserved)
+                raise DeadlineExceeded(f"rate limit wait of {wait:.1f}s exceeds the call deadline")
+            if wait > 0:
+                span.add("wait_seconds", wait)
+                await asyncio.sleep(wait)
+            try:
+                resp = await openai.ChatCompletion.acreate(
+                    **self._request_kwargs(prompt, max_tokens, temperature, self._remaining(deadline), model=model)
+                )
+                self._record(resp, reserved, span)
+                return resp.choices[0].message["content"]  # type: ignore
+            except Exception as e:
+                self.token_bucket.refund(reserved)  # The failed attempt used none of its reservation
+                if not is_retryable(e) or attempt == self.max_retries:
+                    raise
+                delay = self._backoff(attempt, e)
+                if delay >= self._remaining(deadline):
+                    raise DeadlineExceeded(f"deadline reached after {attempt + 1} attempt(s): {e}") from e
+                self._count_retry(span)
+                await asyncio.sleep(delay)
+
+    async def astream(self, prompt: str, max_tokens=800, temperature=0.1, timeout: float = None,
+                      pin_cache: bool = False, model: str = None):
+        """Async counterpart of stream(); closing the generator early cancels the request."""
+        model = model or self.model
+        span = tracer.start_span("call_model", model=model, max_tokens=max_tokens,
+                                 temperature=temperature, stream=True)
+        chunks = self._astream(prompt, max_tokens, temperature, timeout, pin_cache, span, model)
+        try:
+            async for chunk in chunks:
+                yield chunk
+        finally:
+            await chunks.aclose()
+            span.end()
+
+    async def _astream(self, prompt: str, max_tokens: int, temperature: float, timeout: float,
+                       pin_cache: bool, span, model: str):
+        cache_key = self._cache_key(prompt, max_tokens, temperature, pin_cache, model)
+        if cache_key is not None:
+            cached = await self.cache.aget(cache_key)
+            span.set(cache_hit=cached is not None)
+            if cached is not None:
+                yield cached
+                return
+
+        import openai  # Deferred: openai (and what it imports) dominates cold start
+
+        deadline = time.monotonic() + (timeout or self.timeout)
+        openai.aiosession.set(self._async_session())
+
+        for attempt in range(self.max_retries + 1):
+            wait, reserved = self._reserve(prompt, max_tokens)
+            if wait >= self._remaining(deadline):
+                self.token_bucket.refund(reserved)
+                raise DeadlineExceeded(f"rate limit wait of {wait:.1f}s exceeds the call deadline")
+            if wait > 0:
+                span.add("wait_seconds", wait)
+                await asyncio.sleep(wait)
+            try:
+                chunks = await openai.ChatCompletion.acreate(
+                    **self._request_kwargs(prompt, max_tokens, temperature, self._remaining(deadline), stream=True,
+                                         model=model)
+                )
+                try:
+                    first_chunk = await chunks.__anext__()
+                except StopAsyncIteration:
+                    first_chunk = None
+                break
+            except Exception as e:
+                self.token_bucket.refund(reserved)  # The failed attempt used none of its reservation
+                if not is_retryable(e) or attempt == self.max_retries:
+                    raise
+                delay = self._backoff(attempt, e)
+                if delay >= self._remaining(deadline):
+                    raise DeadlineExceeded(f"deadline reached after {attempt + 1} attempt(s): {e}") from e
+                self._count_retry(span)
+                await asyncio.sleep(delay)
+
+        parts = []
+        try:
+            if first_chunk is not None:
+                parts.append(self._delta(first_chunk))
+                if parts[-1]:
+                    yield parts[-1]
+                async for chunk in chunks:
+                    parts.append(self._delta(chunk))
+                    if parts[-1]:
+                        yield parts[-1]
+        finally:
+            if hasattr(chunks, "aclose"):
+                await chunks.aclose()
+            self._record_stream(prompt, "".join(parts), reserved, span)
+
+        if cache_key is not None:
+            await self.cache.aput(cache_key, "".join(parts))
+
+    async def aclose(self):
+        """Close the aiohttp session belonging to the running event loop."""
+        session = self._aiosessions.pop(asyncio.get_running_loop(), None)
+        if session is not None and not session.closed:
+            await session.close()
+
+
+_default_client = None
+_default_client_lock = threading.Lock()
+
+
+def get_client() -> ModelClient:
+    """Return the process-wide client shared by all agents, creating it on first use."""
+    global _default_client
+    if _default_client is None:
+        with _default_client_lock:
+            if _default_client is None:
+                cache_path = os.getenv("STORY_CACHE_PATH")
+                _default_client = ModelClient(cache=ResponseCache(cache_path) if cache_path else None)
+    return _default_client
+
+
+def set_client(client: ModelClient):
+    """Replace the process-wide client (e.g. to change limits or the model)."""
+    global _default_client
+    _default_client = client
@@ -0,0 +1,368 @@
+"""
+Per-Stage Model Routing
+Picks the model for each pipeline stage (detect, draft, judge, improve, feedback)
+instead of sending every call to the one model configured on the shared client.
+
+- Each stage has an ordered list of models: the primary first, then fallbacks
+- Cheap stages (one-word category detection) run on the fast model outright
+- Optional per-stage caps on max_tokens, a fixed temperature and a per-attempt timeout
+- A rolling window of latency and errors per (stage, model): when a model's p95
+  latency or error rate crosses the stage's threshold it is skipped in favour of
+  the next one, until its old samples expire and it gets traffic again
+- A call that fails or times out on one model is retried on the next, so a slow
+  backend costs one attempt timeout rather than stalling the pipeline
+
+Every decision is recorded as a "route" tracing span (stage, model, reason, p95,
+error rate), counted in ModelRouter.decisions, and optionally appended to
+$STORY_ROUTING_LOG as JSONL.
+
+Routes can be overridden with a JSON file at $STORY_ROUTES_PATH, e.g.
+    {"judge": {"models": ["gpt-4", "gpt-3.5-turbo"], "p95_seconds": 10}}
+A model of null means the shared client's default model ($OPENAI_MODEL).
+"""
+
+import json
+import math
+import os
+import threading
+import time
+from collections import Counter, defaultdict, deque
+
+from model_client import DeadlineExceeded, get_client
+from tracing import tracer
+
+FAST_MODEL = os.getenv("OPENAI_FAST_MODEL", "gpt-3.5-turbo")
+
+STAGES = ("detect", "draft", "judge", "improve", "feedback")
+
+# max_tokens caps the caller's budget; temperature (when set) replaces the caller's;
+# timeout is per attempt, so a slow model hands over to the next one in time
+DEFAULT_ROUTES = {
+    "detect": {"models": [FAST_MODEL], "max_tokens": 10, "timeout": 10.0},
+    "draft": {"models": [None, FAST_MODEL], "timeout": 45.0, "p95_seconds": 25.0, "max_error_rate": 0.3},
+    "judge": {"models": [None, FAST_MODEL], "timeout": 40.0, "p95_seconds": 20.0, "max_error_rate": 0.3},
+    "improve": {"models": [None, FAST_MODEL], "timeout": 45.0, "p95_seconds": 25.0, "max_error_rate": 0.3},
+    "feedback": {"models": [None, FAST_MODEL], "timeout": 45.0, "p95_seconds": 25.0, "max_error_rate": 0.3},
+}
+
+# Samples older than this are forgotten, so a downgraded model is retried later
+WINDOW_SECONDS = 120.0
+
+# Health thresholds only apply once a model has this many recent samples
+MIN_SAMPLES = 5
+
+
+def load_routes(path: str = None) -> dict:
+    """Default routes, overridden per stage by the JSON file at path or $STORY_ROUTES_PATH."""
+    routes = {stage: dict(route) for stage, route in DEFAULT_ROUTES.items()}
+    path = path or os.getenv("STORY_ROUTES_PATH")
+    if path:
+        with open(path, encoding="utf-8") as f:
+            for stage, override in json.load(f).items():
+                routes.setdefault(stage, {"models": [None]}).update(override)
+    return routes
+
+
+def percentile(values: list, fraction: float) -> float:
+    """Nearest-rank percentile of a non-empty list."""
+    ordered = sorted(values)
+    return ordered[max(0, math.ceil(fraction * len(ordered)) - 1)]
+
+
+class ModelRouter:
+    """Chooses a model per stage and falls back on errors, slow calls and unhealthy models."""
+
+    def __init__(self, routes: dict = None, window_seconds: float = WINDOW_SECONDS,
+                 min_samples: int = MIN_SAMPLES, log_path: str = None):
+        """
+        Args:
+            routes: stage -> route dict (default: DEFAULT_ROUTES plus $STORY_ROUTES_PATH)
+            window_seconds: How long latency/error samples count toward a model's health
+            min_samples: Samples needed before a model can be judged unhealthy
+            log_path: JSONL file for routing decisions (default: $STORY_ROUTING_LOG)
+        """
+        self.routes = routes or load_routes()
+        self.window_seconds = window_seconds
+        self.min_samples = min_samples
+        self.log_path = log_path or os.getenv("STORY_ROUTING_LOG")
+        self.decisions = Counter()  # (stage, model, reason) -> count
+        self._samples = defaultdict(deque)  # (stage, model) -> deque of (time, seconds, ok)
+        self._lock = threading.Lock()
+
+    # ------------------------------------------------------------------
+    # Health tracking
+    # ------------------------------------------------------------------
+
+    def record(self, stage: str, model: str, seconds: float, ok: bool):
+        """Add one call's outcome to the rolling window."""
+        with self._lock:
+            self._samples[(stage, model)].append((time.monotonic(), seconds, ok))
+
+    def health(self, stage: str, model: str) -> dict:
+        """Recent sample count, p95 latency (successful calls) and error rate."""
+        cutoff = time.monotonic() - self.window_seconds
+        with self._lock:
+            samples = self._samples[(stage, model)]
+            while samples and samples[0][0] < cutoff:
+                samples.popleft()
+            latencies = [seconds for _, seconds, ok in samples if ok]
+            errors = sum(1 for _, _, ok in samples if not ok)
+            count = len(samples)
+        return {
+            "samples": count,
+            "p95": percentile(latencies, 0.95) if latencies else None,
+            "error_rate": errors / count if count else 0.0,
+        }
+
+    def _problem(self, route: dict, health: dict):
+        """Why a model is currently unhealthy for this route, or None."""
+        if health["samples"] < self.min_samples:
+            return None
+        max_error_rate = route.get("max_error_rate")
+        if max_error_rate is not None and health["error_rate"] > max_error_rate:
+            return f"error rate {health['error_rate']:.0%}"
+        p95_seconds = route.get("p95_seconds")
+        if p95_seconds is not None and health["p95"] is not None and health["p95"] > p95_seconds:
+            return f"p95 {health['p95']:.1f}s"
+        return None
+
+    # ------------------------------------------------------------------
+    # Decisions
+    # ------------------------------------------------------------------
+
+    def route(self, stage: str) -> dict:
+        if stage not in self.routes:
+            raise KeyError(f"unknown stage {stage!r} (known: {', '.join(self.routes)})")
+        return self.routes[stage]
+
+    def plan(self, stage: str) -> list:
+        """
+        Order the stage's models for one call.
+
+        Returns:
+            list of (model, reason): healthy models in configured order, then unhealthy
+            ones by lowest p95 (so a call always has somewhere to go)
+        """
+        route = self.route(stage)
+        default_model = get_client().model
+        healthy, unhealthy, skipped = [], [], []
+        seen = set()
+        for position, model in enumerate(route["models"]):
+            model = model or default_model
+            if model in seen:  # e.g. the default model is also the fast model
+                continue
+            seen.add(model)
+            health = self.health(stage, model)
+            problem = self._problem(route, health)
+            if problem is not None:
+                skipped.append(f"{model} {problem}")
+                unhealthy.append((health["p95"] or 0.0, model, f"unhealthy: {problem}"))
+            elif position == 0:
+                healthy.append((model, "primary"))
+            elif skipped and not healthy:
+                healthy.append((model, "downgrade: " + "; ".join(skipped)))
+            else:
+                healthy.append((model, "fallback"))
+        return healthy + [(model, reason) for _, model, reason in sorted(unhealthy, key=lambda item: item[0])]
+
+    def _log(self, stage: str, model: str, reason: str, health: dict, outcome: str):
+        self.decisions[(stage, model, reason.split(":")[0])] += 1
+        if not self.log_path:
+            return
+        record = {"time": round(time.time(), 3), "stage": stage, "model": model, "reason": reason,
+                  "p95": health["p95"], "error_rate": round(health["error_rate"], 3), "outcome": outcome}
+        with self._lock:
+            with open(self.log_path, "a", encoding="utf-8") as f:
+                f.write(json.dumps(record) + "\n")
+
+    def _call_kwargs(self, route: dict, max_tokens: int, temperature: float) -> dict:
+        if route.get("max_tokens") is not None:
+            max_tokens = min(max_tokens, route["max_tokens"])
+        if route.get("temperature") is not None:
+            temperature = route["temperature"]
+        return {"max_tokens": max_tokens, "temperature": temperature}
+
+    @staticmethod
+    def _attempt_timeout(route: dict, deadline: float, last: bool) -> float:
+        """
+        Per-attempt timeout: the route's (unless no model is left to fall back to),
+        shortened to what is left of the caller's deadline.
+        """
+        timeout = None if last else route.get("timeout")
+        if deadline is None:
+            return timeout
+        remaining = deadline - time.monotonic()
+        if remaining <= 0:
+            raise DeadlineExceeded("no time left to try another model")
+        return remaining if timeout is None else min(timeout, remaining)
+
+    # ------------------------------------------------------------------
+    # Routed calls (same signatures as ModelClient plus the stage)
+    # ------------------------------------------------------------------
+
+    def complete(self, stage: str, prompt: str, max_tokens=800, temperature=0.1, timeout: float = None,
+                 pin_cache: bool = False) -> str:
+        """Blocking completion on the stage's best model, falling back to the next on failure."""
+        route = self.route(stage)
+        kwargs = self._call_kwargs(route, max_tokens, temperature)
+        deadline = time.monotonic() + timeout if timeout else None
+        error = None
+        plan = self.plan(stage)
+        for position, (model, reason) in enumerate(plan):
+            last = position == len(plan) - 1
+            health = self.health(stage, model)
+            with tracer.span("route", stage=stage, model=model, reason=reason, p95=health["p95"],
+                             error_rate=round(health["error_rate"], 3)) as span:
+                start = time.perf_counter()
+                try:
+                    content = get_client().complete(prompt, timeout=self._attempt_timeout(route, deadline, last),
+                                                    pin_cache=pin_cache, model=model, **kwargs)
+                except Exception as e:
+                    self.record(stage, model, time.perf_counter() - start, ok=False)
+                    self._log(stage, model, reason, health, f"error: {type(e).__name__}")
+                    span.set(outcome="error", error=f"{type(e).__name__}: {e}")
+                    error = e
+                    continue
+                self.record(stage, model, time.perf_counter() - start, ok=True)
+                self._log(stage, model, reason, health, "ok")
+                return content
+        raise error
+
+    async def acomplete(self, stage: str, prompt: str, max_tokens=800, temperature=0.1, timeout: float = None,
+                        pin_cache: bool = False) -> str:
+        """Async counterpart of complete()."""
+        route = self.route(stage)
+        kwargs = self._call_kwargs(route, max_tokens, temperature)
+        deadline = time.monotonic() + timeout if timeout else None
+        error = None
+        plan = self.plan(stage)
+        for position, (model, reason) in enumerate(plan):
+            last = position == len(plan) - 1
+            health = self.health(stage, model)
+            with tracer.span("route", stage=stage, model=model, reason=reason, p95=health["p95"],
+                             error_rate=round(health["error_rate"], 3)) as span:
+                start = time.perf_counter()
+                try:
+                    content = await get_client().acomplete(
+                        prompt, timeout=self._attempt_timeout(route, deadline, last), pin_cache=pin_cache,
+                        model=model, **kwargs
+                    )
+                except Exception as e:
+                    self.record(stage, model, time.perf_counter() - start, ok=False)
+                    self._log(stage, model, reason, health, f"error: {type(e).__name__}")
+                    span.set(outcome="error", error=f"{type(e).__name__}: {e}")
+                    error = e
+                    continue
+                self.record(stage, model, time.perf_counter() - start, ok=True)
+                self._log(stage, model, reason, health, "ok")
+                return content
+        raise error
+
+    def stream(self, stage: str, prompt: str, max_tokens=800, temperature=0.1, timeout: float = None,
+               pin_cache: bool = False):
+        """
+        Streaming counterpart of complete().
+
+        Falls back only while nothing has been yielded yet; once tokens have reached
+        the caller, a failure is raised rather than restarting the reply elsewhere.
+        """
+        route = self.route(stage)
+        kwargs = self._call_kwargs(route, max_tokens, temperature)
+        deadline = time.monotonic() + timeout if timeout else None
+        error = None
+        plan = self.plan(stage)
+        for position, (model, reason) in enumerate(plan):
+            last = position == len(plan) - 1
+            health = self.health(stage, model)
+            span = tracer.start_span("route", stage=stage, model=model, reason=reason, p95=health["p95"],
+                                     error_rate=round(health["error_rate"], 3))
+            start = time.perf_counter()
+            started = False
+            try:
+                for chunk in get_client().stream(prompt, timeout=self._attempt_timeout(route, deadline, last),
+                                                 pin_cache=pin_cache, model=model, **kwargs):
+                    started = True
+                    yield chunk
+            except Exception as e:
+                self.record(stage, model, time.perf_counter() - start, ok=False)
+                self._log(stage, model, reason, health, f"error: {type(e).__name__}")
+                span.set(outcome="error", error=f"{type(e).__name__}: {e}")
+                if started:
+                    raise
+                error = e
+                continue
+            finally:
+                span.end()
+            self.record(stage, model, time.perf_counter() - start, ok=True)
+            self._log(stage, model, reason, health, "ok")
+            return
+        raise error
+
+    async def astream(self, stage: str, prompt: str, max_tokens=800, temperature=0.1, timeout: float = None,
+                      pin_cache: bool = False):
+        """Async counterpart of stream() (an async generator)."""
+        route = self.route(stage)
+        kwargs = self._call_kwargs(route, max_tokens, temperature)
+        deadline = time.monotonic() + timeout if timeout else None
+        error = None
+        plan = self.plan(stage)
+        for position, (model, reason) in enumerate(plan):
+            last = position == len(plan) - 1
+            health = self.health(stage, model)
+            span = tracer.start_span("route", stage=stage, model=model, reason=reason, p95=health["p95"],
+                                     error_rate=round(health["error_rate"], 3))
+            start = time.perf_counter()
+            started = False
+            chunks = get_client().astream(prompt, timeout=self._attempt_timeout(route, deadline, last),
+                                          pin_cache=pin_cache, model=model, **kwargs)
+            try:
+                async for chunk in chunks:
+                    started = True
+                    yield chunk
+            except Exception as e:
+                self.record(stage, model, time.perf_counter() - start, ok=False)
+                self._log(stage, model, reason, health, f"error: {type(e).__name__}")
+                span.set(outcome="error", error=f"{type(e).__name__}: {e}")
+                if started:
+                    raise
+                error = e
+                continue
+            finally:
+                await chunks.aclose()
+                span.end()
+            self.record(stage, model, time.perf_counter() - start, ok=True)
+            self._log(stage, model, reason, health, "ok")
+            return
+        raise error
+
+    def summary(self) -> dict:
+        """Decision counts and current health per stage and model."""
+        stages = {}
+        for stage, route in self.routes.items():
+            models = [model or get_client().model for model in route["models"]]
+            stages[stage] = {model: self.health(stage, model) for model in dict.fromkeys(models)}
+        return {
+            "decisions": {f"{stage}/{model}/{reason}": count
+                          for (stage, model, reason), count in sorted(self.decisions.items())},
+            "health": stages,
+        }
+
+
+_default_router = None
+_default_router_lock = threading.Lock()
+
+
+def get_router() -> ModelRouter:
+    """Return the process-wide router, creating it on first use."""
+    global _default_router
+    if _default_router is None:
+        with _default_router_lock:
+            if _default_router is None:
+                _default_router = ModelRouter()
+    return _default_router
+
+
+def set_router(router: ModelRouter):
+    """Replace the process-wide router (e.g. with custom routes)."""
+    global _default_router
+    _default_router = router
@@ -0,0 +1,151 @@
+"""
+Persistent Prompt-Response Cache
+SQLite-backed cache for deterministic (low-temperature) model calls such as
+category detection and judging, so re-submitted requests and re-run batches
+don't pay for identical calls twice.
+
+Entries are keyed by a hash of (model, prompt, temperature, max_tokens), evicted
+least-recently-used once the cache exceeds max_entries, and optionally expire
+after ttl_seconds.
+
+Lookups stay read-only most of the time: last_access is only rewritten when it is
+older than ACCESS_RESOLUTION_SECONDS. Inserts keep a running entry count and only
+run an eviction pass, down to EVICT_TO_FRACTION of max_entries, once it goes over.
+aget()/aput() run the SQLite work on a worker thread for async callers.
+"""
+
+import asyncio
+import hashlib
+import json
+import sqlite3
+import threading
+import time
+
+# last_access is rewritten at most this often per entry (LRU order coarser than this doesn't matter)
+ACCESS_RESOLUTION_SECONDS = 60.0
+
+# An eviction pass trims the cache to this fraction of max_entries, so it runs once per batch of inserts
+EVICT_TO_FRACTION = 0.9
+
+
+def make_cache_key(model: str, prompt: str, temperature: float, max_tokens: int) -> str:
+    """Stable hash of everything that determines a model response."""
+    payload = json.dumps([model, prompt, float(temperature), int(max_tokens)], ensure_ascii=False)
+    return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+
+class ResponseCache:
+    """Size-bounded LRU cache of model responses stored in a SQLite file."""
+
+    def __init__(self, path: str = "response_cache.sqlite3", max_entries: int = 10000,
+                 ttl_seconds: float = None, max_temperature: float = 0.2):
+        """
+        Args:
+            path: SQLite database file (":memory:" for a process-local cache)
+            max_entries: Number of responses kept before LRU eviction
+            ttl_seconds: Optional expiry; None keeps entries until evicted
+            max_temperature: Calls at or below this temperature are cached by default;
+                             hotter (creative) calls bypass the cache unless pinned
+        """
+        self.path = path
+        self.max_entries = max_entries
+        self.ttl_seconds = ttl_seconds
+        self.max_temperature = max_temperature
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute(
+            """CREATE TABLE IF NOT EXISTS responses (
+                   key TEXT PRIMARY KEY,
+                   response TEXT NOT NULL,
+                   created REAL NOT NULL,
+                   last_access REAL NOT NULL
+               )"""
+        )
+        self._conn.execute("CREATE INDEX IF NOT EXISTS responses_last_access ON responses(last_access)")
+        self._conn.commit()
+        self._count = self._conn.execute("SELECT COUNT(*) FROM responses").fetchone()[0]
+
+    def should_cache(self, temperature: float, pin: bool = False) -> bool:
+        """Low-temperature calls are cached; creative calls only when explicitly pinned."""
+        return pin or temperature <= self.max_temperature
+
+    def get(self, key: str):
+        """Return the cached response for key, or None on a miss or expired entry."""
+        now = time.time()
+        with self._lock:
+            row = self._conn.execute("SELECT response, created, last_access FROM responses WHERE key = ?",
+                                     (key,)).fetchone()
+            if row is not None and self.ttl_seconds is not None and now - row[1] > self.ttl_seconds:
+                self._conn.execute("DELETE FROM responses WHERE key = ?", (key,))
+                self._conn.commit()
+                self._count -= 1
+                row = None
+            if row is None:
+                self.misses += 1
+                return None
+            if now - row[2] > ACCESS_RESOLUTION_SECONDS:
+                self._conn.execute("UPDATE responses SET last_access = ? WHERE key = ?", (now, key))
+                self._conn.commit()
+            self.hits += 1
+            return row[0]
+
+    def put(self, key: str, response: str):
+        """Store a response; once the cache is over max_entries, evict the least recently used entries."""
+        now = time.time()
+        with self._lock:
+            exists = self._conn.execute("SELECT 1 FROM responses WHERE key = ?", (key,)).fetchone() is not None
+            self._conn.execute(
+                "INSERT OR REPLACE INTO responses (key, response, created, last_access) VALUES (?, ?, ?, ?)",
+                (key, response, now, now),
+            )
+            self._count += not exists
+            if self._count > self.max_entries:
+                self._evict()
+            self._conn.commit()
+
+    def _evict(self):
+        # Recount first: other processes may share the file
+        self._count = self._conn.execute("SELECT COUNT(*) FROM responses").fetchone()[0]
+        excess = self._count - int(self.max_entries * EVICT_TO_FRACTION)
+        if self._count > self.max_entries and excess > 0:
+            self._conn.execute(
+                "DELETE FROM responses WHERE key IN (SELECT key FROM responses ORDER BY last_access LIMIT ?)",
+                (excess,),
+            )
+            self._count -= excess
+
+    async def aget(self, key: str):
+        """get() on a worker thread, for use inside an event loop."""
+        return await asyncio.to_thread(self.get, key)
+
+    async def aput(self, key: str, response: str):
+        """put() on a worker thread, for use inside an event loop."""
+        await asyncio.to_thread(self.put, key, response)
+
+    def stats(self) -> dict:
+        """Hit/miss counters and current size."""
+        with self._lock:
+            size = self._conn.execute("SELECT COUNT(*) FROM responses").fetchone()[0]
+        total = self.hits + self.misses
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": round(self.hits / total, 3) if total else 0.0,
+            "entries": size,
+        }
+
+    def clear(self):
+        """Remove every cached response and reset the counters."""
+        with self._lock:
+            self._conn.execute("DELETE FROM responses")
+            self._conn.commit()
+            self._count = 0
+        self.hits = 0
+        self.misses = 0
+
+    def close(self):
+        with self._lock:
+            self._conn.close()
@@ -0,0 +1,166 @@
+"""
+Checkpointed Run Log
+Append-only, per-request log of pipeline stage outputs, so a batch or service
+run that crashes, is killed or is redeployed resumes each request from its last
+completed stage instead of starting over at category detection.
+
+Each request gets one JSONL file under the run directory. Every completed stage
+appends one line, flushed and fsynced before the pipeline moves on:
+
+    {"stage": "start", "request": ...}
+    {"stage": "category", "category": ...}
+    {"stage": "draft", "story": ..., "evaluation": ..., "judge_calls_avoided": ..., "library": ...}
+    {"stage": "judge", "iteration": 2, "evaluation": ..., "avoided": 0}
+    {"stage": "improve", "iteration": 2, "story": ...}
+    {"stage": "final", "result": {...}}
+
+Each log keeps one append handle open until its final entry. Async callers use
+arecord(), which does the write and fsync on a worker thread so a disk flush
+never stalls the event loop.
+
+A line torn by a crash mid-write is ignored on replay. A log whose request text
+differs from the one being run (e.g. a reused request_id) is set aside as
+.stale and the request starts fresh.
+"""
+
+import asyncio
+import json
+import os
+import re
+import threading
+import time
+from pathlib import Path
+
+
+def _file_name(request_id: str) -> str:
+    """Filesystem-safe file name for a request id."""
+    return re.sub(r"[^A-Za-z0-9_.-]", "_", str(request_id))[:120] + ".jsonl"
+
+
+def read_entries(path: Path) -> list:
+    """Stage entries of a log file, stopping at a line torn by an interrupted write."""
+    entries = []
+    try:
+        with open(path, encoding="utf-8") as f:
+            for line in f:
+                try:
+                    entries.append(json.loads(line))
+                except json.JSONDecodeError:
+                    break
+    except FileNotFoundError:
+        pass
+    return entries
+
+
+class RequestLog:
+    """The append-only stage log of one request."""
+
+    def __init__(self, path: Path, request: str):
+        self.path = path
+        self.request = request
+        self._file = None  # Opened on the first record, closed after "final"
+        self._lock = threading.Lock()
+        self._repair()
+        entries = read_entries(path)
+        if entries and entries[0].get("request") != request:
+            os.replace(path, path.with_name(f"{path.name}.{int(time.time())}.stale"))
+            entries = []
+        self.resumed = bool(entries)
+        if not entries:
+            self.record("start", request=request)
+
+    def _repair(self):
+        """Cut a torn last line, so new entries start on a line of their own."""
+        try:
+            data = self.path.read_bytes()
+        except FileNotFoundError:
+            return
+        if data and not data.endswith(b"\n"):
+            with open(self.path, "r+b") as f:
+                f.truncate(data.rfind(b"\n") + 1)
+
+    def record(self, stage: str, **data):
+        """Append one completed stage and make it durable before returning."""
+        line = json.dumps({"stage": stage, "time": round(time.time(), 3), **data}, ensure_ascii=False)
+        with self._lock:
+            if self._file is None:
+                self._file = open(self.path, "a", encoding="utf-8")
+            self._file.write(line + "\n")
+            self._file.flush()
+            os.fsync(self._file.fileno())
+            if stage == "final":
+                self._close()
+
+    async def arecord(self, stage: str, **data):
+        """record() on a worker thread, for use inside an event loop."""
+        await asyncio.to_thread(self.record, stage, **data)
+
+    def _close(self):
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+
+    def close(self):
+        """Close the append handle (the next record reopens it)."""
+        with self._lock:
+            self._close()
+
+    def state(self) -> dict:
+        """
+        Replay the log.
+
+        Returns:
+            dict with category, draft (the "draft" entry or None), judged
+            (iteration -> (evaluation, avoided)), improved (iteration -> story)
+            and final (the finished result or None)
+        """
+        state = {"category": None, "draft": None, "judged": {}, "improved": {}, "final": None}
+        for entry in read_entries(self.path):
+            stage = entry["stage"]
+            if stage == "category":
+                state["category"] = entry["category"]
+            elif stage == "draft":
+                state["draft"] = entry
+            elif stage == "judge":
+                state["judged"][entry["iteration"]] = (entry["evaluation"], entry.get("avoided", 0))
+            elif stage == "improve":
+                state["improved"][entry["iteration"]] = entry["story"]
+            elif stage == "final":
+                state["final"] = entry["result"]
+        return state
+
+
+class RunLog:
+    """Directory of per-request stage logs for one batch or service."""
+
+    def __init__(self, directory: str = "runs"):
+        """
+        Args:
+            directory: Folder holding one <request_id>.jsonl per request (created if missing)
+        """
+        self.directory = Path(directory)
+        self.directory.mkdir(parents=True, exist_ok=True)
+
+    def request_log(self, request_id: str, request: str) -> RequestLog:
+        """Open (or start) the log of one request."""
+        return RequestLog(self.directory / _file_name(request_id), request)
+
+    def unfinished(self) -> list:
+        """(request_id, entries) of every log without a final result, oldest first (ids in file-name form)."""
+        logs = []
+        for path in sorted(self.directory.glob("*.jsonl"), key=lambda path: path.stat().st_mtime):
+            entries = read_entries(path)
+            if entries and entries[0]["stage"] == "start" and not any(e["stage"] == "final" for e in entries):
+                logs.append((path.stem, entries))
+        return logs
+
+    def entries(self, request_id: str) -> list:
+        """Every logged stage entry of request_id (empty when it has no log)."""
+        return read_entries(self.directory / _file_name(request_id))
+
+    def finished(self, request_id: str):
+        """The finished result recorded for request_id, or None."""
+        for entry in reversed(self.entries(request_id)):
+            if entry["stage"] == "final":
+                return entry["result"]
+        return None
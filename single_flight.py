@@ -0,0 +1,199 @@
+"""
+Single-Flight Request Deduplication
+When the same request ("a story about a sleepy dragon") arrives several times
+within seconds, only the first copy runs the detect/draft/judge/improve pipeline;
+copies that arrive while it is in flight attach to it and share its result.
+
+- Requests are compared after normalization (story_library.normalize_request):
+  case, Unicode forms, punctuation, whitespace and filler/stop words
+  ("please write a story about ...") are ignored
+- Pipeline options that change the output (target score, iterations, category,
+  drafts, ...) are part of the key, so differently configured runs never merge
+- A finished flight is forgotten immediately: this shares work, it is not a cache
+  (see response_cache.py for that)
+- Each caller can pass a personalization (e.g. "Name the dragon Mia"), applied
+  to its copy of the shared story afterwards as a single feedback-stage call
+
+Progress events (on_event) are fanned out to every caller attached to an async
+flight; a caller that attaches late first gets the events it missed. The
+request_id and the run log are those of the caller that started the flight.
+"""
+
+import asyncio
+import threading
+from concurrent.futures import Future
+
+from async_pipeline import aapply_user_feedback, agenerate_story_with_quality_control
+from main_iterative import apply_user_feedback, generate_story_with_quality_control
+from story_library import normalize_request
+
+# Options that only affect reporting or scheduling, not the story, so they are left out of the key.
+# stream_tokens stays keyed: a flight only produces token events if its leader asked for them.
+UNKEYED_OPTIONS = frozenset({"on_event", "request_id", "judge_batcher", "policy", "stream", "run_log"})
+
+
+def request_key(user_input: str, **options) -> tuple:
+    """Key shared by requests that would produce interchangeable stories."""
+    keyed = tuple(sorted((name, repr(value)) for name, value in options.items() if name not in UNKEYED_OPTIONS))
+    return normalize_request(user_input), keyed
+
+
+class EventFanout:
+    """Forwards a flight's progress events to every attached caller, replaying past events to late joiners."""
+
+    def __init__(self):
+        self.history = []      # (name, data) already sent
+        self.subscribers = []  # on_event callbacks
+
+    def emit(self, name: str, data: dict):
+        self.history.append((name, data))
+        for callback in list(self.subscribers):
+            callback(name, data)
+
+    def subscribe(self, callback):
+        for name, data in self.history:
+            callback(name, data)
+        self.subscribers.append(callback)
+
+
+class SingleFlight:
+    """
+    Registry of in-flight work keyed by request.
+
+    do() serves threads (sync pipeline), ado() serves one event loop (async
+    pipeline); the two registries are separate.
+    """
+
+    def __init__(self):
+        self.stats = {"leaders": 0, "followers": 0}
+        self._lock = threading.Lock()
+        self._flights = {}   # key -> concurrent.futures.Future
+        self._aflights = {}  # key -> (asyncio.Task, EventFanout)
+
+    def do(self, key, fn, *args, **kwargs) -> tuple:
+        """
+        Run fn(*args, **kwargs) unless an identical call is in flight, then wait for it.
+
+        Returns:
+            (result, shared) - shared is True when the result came from another caller's flight
+        """
+        with self._lock:
+            future = self._flights.get(key)
+            leader = future is None
+            if leader:
+                future = self._flights[key] = Future()
+                self.stats["leaders"] += 1
+            else:
+                self.stats["followers"] += 1
+        if not leader:
+            return future.result(), True
+
+        try:
+            future.set_result(fn(*args, **kwargs))
+        except BaseException as e:
+            future.set_exception(e)
+        finally:
+            with self._lock:
+                del self._flights[key]
+        return future.result(), False
+
+    async def ado(self, key, coroutine_fn, *args, on_event=None, **kwargs) -> tuple:
+        """
+        Async counterpart of do(): await coroutine_fn(*args, **kwargs) or the identical flight.
+
+        The flight runs as its own task, so cancelling one waiting caller (even
+        the one that started it) does not cancel it for the others. coroutine_fn is
+        called with on_event set to the flight's EventFanout, and every caller's
+        on_event receives all of the flight's events.
+        """
+        flight = self._aflights.get(key)
+        shared = flight is not None
+        if shared:
+            self.stats["followers"] += 1
+            task, fanout = flight
+        else:
+            self.stats["leaders"] += 1
+            fanout = EventFanout()
+            task = asyncio.ensure_future(coroutine_fn(*args, on_event=fanout.emit, **kwargs))
+            self._aflights[key] = (task, fanout)
+            task.add_done_callback(lambda _: self._aflights.pop(key, None))
+        if on_event is not None:
+            fanout.subscribe(on_event)
+        return await asyncio.shield(task), shared
+
+    async def cancel_all(self):
+        """Cancel every async flight, e.g. on shutdown (shielded flights outlive their cancelled callers)."""
+        tasks = [task for task, _ in self._aflights.values()]
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+
+    def in_flight(self) -> int:
+        return len(self._flights) + len(self._aflights)
+
+
+_default_registry = SingleFlight()
+
+
+def generate_story_single_flight(user_input: str, personalization: str = None,
+                                 registry: SingleFlight = None, **options) -> tuple:
+    """
+    generate_story_with_quality_control behind the single-flight registry.
+
+    Args:
+        user_input: The story request from the user
+        personalization: Optional change applied to this caller's copy of the story
+        registry: SingleFlight to use (default: the process-wide one)
+        **options: Passed through to generate_story_with_quality_control
+
+    Returns:
+        (story, evaluations, scores, story_versions, category, shared)
+    """
+    registry = registry or _default_registry
+    key = request_key(user_input, **options)
+    (story, evaluations, scores, story_versions, category), shared = registry.do(
+        key, generate_story_with_quality_control, user_input, **options
+    )
+    if personalization:
+        story = apply_user_feedback(story, personalization, category, targeted=True)
+    return story, evaluations, scores, story_versions, category, shared
+
+
+async def _alimited(semaphore: asyncio.Semaphore, coroutine_fn, *args, **kwargs):
+    if semaphore is None:
+        return await coroutine_fn(*args, **kwargs)
+    async with semaphore:
+        return await coroutine_fn(*args, **kwargs)
+
+
+async def agenerate_story_single_flight(user_input: str, personalization: str = None,
+                                        registry: SingleFlight = None, semaphore: asyncio.Semaphore = None,
+                                        **options) -> dict:
+    """
+    agenerate_story_with_quality_control behind the single-flight registry.
+
+    Args:
+        user_input: The story request from the user
+        personalization: Optional change applied to this caller's copy of the story
+        registry: SingleFlight to use (default: the process-wide one)
+        semaphore: Optional concurrency limit, held only while this caller runs a
+                   pipeline or its personalization (waiting on a shared flight is free)
+        **options: Passed through to agenerate_story_with_quality_control
+
+    Returns:
+        the pipeline's result dict (a copy per caller) plus "shared" and, when a
+        personalization was applied, "personalization"
+    """
+    registry = registry or _default_registry
+    key = request_key(user_input, **options)
+    result, shared = await registry.ado(key, _alimited, semaphore, agenerate_story_with_quality_control,
+                                        user_input, **options)
+    result = dict(result, shared=shared)
+    if shared and options.get("run_log") is not None:
+        # The stages ran under the leader's log; this caller's log only needs the outcome
+        await options["run_log"].arecord("final", result=result)
+    if personalization:
+        result["story"] = await _alimited(semaphore, aapply_user_feedback, result["story"], personalization,
+                                          result["category"], targeted=True)
+        result["personalization"] = personalization
+    return result
@@ -0,0 +1,480 @@
+"""
+Staged Batch Pipeline
+Runs a batch as a pipeline of stages joined by queues, instead of one coroutine
+per story that walks through its own stages:
+
+    detect -> draft -> judge <-> improve -> audio -> output
+
+- Each stage has its own worker pool, sized for its latency profile (detection
+  is mostly the local classifier, drafts/judgements/improvements wait on the
+  API, narration is CPU/TTS-bound and runs on threads)
+- While one story waits on the network its neighbours use the other stages, and
+  audio for finished stories is rendered while later stories are still being
+  written and judged
+- Queue depth is sampled per stage (mean, max, optional JSONL time series) along
+  with each stage's busy time, so the bottleneck stage is visible and its pool
+  can be resized (--workers judge=12,audio=4)
+- Requests already in the output file are skipped, and stages are checkpointed
+  per request in the same format as the regular batch (run_log.py), so either
+  runner can resume the other's logs
+
+The per-story logic (stop at target_score or max_iterations, fall back to the
+best-scoring version, content-safety prefilter, shared JudgeBatcher) matches
+agenerate_story_with_quality_control. Best-of-N drafts, listwise judging,
+adaptive stopping, the story library and single-flight dedupe stay in
+batch_stories.py.
+
+Usage:
+    python staged_batch.py requests.jsonl stories.jsonl --audio --workers draft=8,judge=12,audio=4
+"""
+
+import argparse
+import asyncio
+import json
+import sys
+import time
+from pathlib import Path
+
+from add_audio import TTS_ENGINES, generate_audio_from_text
+from async_pipeline import adetect_story_category, agenerate_initial_story, aimprove_story, ajudge_story
+from audio_cache import get_audio_cache
+from batch_judge import JudgeBatcher
+from batch_stories import finished_request_ids, load_requests
+from content_safety import prefilter_story
+from main_iterative import extract_score_from_evaluation
+from model_client import get_client
+from run_log import RunLog
+from tracing import ChromeTraceSink, JsonlSink, tracer
+
+STAGES = ("detect", "draft", "judge", "improve", "audio")
+
+# Workers per stage: detection mostly runs the local classifier, the text stages
+# wait on the API, narration is CPU/TTS-bound (each job also fans out its own chunks)
+DEFAULT_WORKERS = {"detect": 4, "draft": 8, "judge": 8, "improve": 8, "audio": 2}
+
+# Stories admitted into the pipeline at once (bounds memory and keeps output in rough input order)
+MAX_IN_FLIGHT = 64
+
+# How often queue depths are sampled
+DEPTH_SAMPLE_SECONDS = 0.25
+
+
+def parse_workers(spec: str) -> dict:
+    """Worker counts from "judge=12,audio=4" on top of DEFAULT_WORKERS."""
+    workers = dict(DEFAULT_WORKERS)
+    for part in filter(None, (part.strip() for part in (spec or "").split(","))):
+        stage, _, count = part.partition("=")
+        if stage not in STAGES or not count.isdigit() or int(count) < 1:
+            raise ValueError(f"Invalid worker spec {part!r} (expected stage=count, stages: {', '.join(STAGES)})")
+        workers[stage] = int(count)
+    return workers
+
+
+class StagedPipeline:
+    """Stage queues, their worker pools and per-stage metrics for one batch."""
+
+    def __init__(self, on_result, workers: dict = None, target_score=8, max_iterations=3,
+                 early_exit_judge=False, targeted_revision=False, safety_prefilter=True,
+                 judge_batcher: JudgeBatcher = None, audio=False, audio_dir="audio", audio_engine="gtts",
+                 audio_speed=0.9, max_in_flight: int = MAX_IN_FLIGHT):
+        """
+        Args:
+            on_result: async callback(item, result, error) when a story leaves the pipeline
+            workers: Worker count per stage (missing stages use DEFAULT_WORKERS)
+            audio: Narrate each final story (the audio stage is skipped otherwise)
+            max_in_flight: Stories admitted at once; submit() waits for room beyond that
+            (other args as in agenerate_story_with_quality_control / add_audio.generate_audio_from_text)
+        """
+        self.on_result = on_result
+        self.workers = dict(DEFAULT_WORKERS, **(workers or {}))
+        self.target_score = target_score
+        self.max_iterations = max_iterations
+        self.early_exit_score = target_score if early_exit_judge else None
+        self.targeted_revision = targeted_revision
+        self.safety_prefilter = safety_prefilter
+        self.judge_batcher = judge_batcher
+        self.audio = audio
+        self.audio_dir = Path(audio_dir)
+        self.audio_engine = audio_engine
+        self.audio_speed = audio_speed
+        self.queues = {stage: asyncio.Queue() for stage in STAGES}
+        self.metrics = {
+            stage: {"workers": self.workers[stage] if stage != "audio" or audio else 0, "processed": 0,
+                    "busy_seconds": 0.0, "depth_total": 0, "max_depth": 0}
+            for stage in STAGES
+        }
+        self.samples = 0
+        self._handlers = {"detect": self._detect, "draft": self._draft, "judge": self._judge,
+                          "improve": self._improve, "audio": self._audio}
+        self._room = asyncio.Semaphore(max_in_flight)
+        self._in_flight = 0
+        self._idle = asyncio.Event()
+        self._idle.set()
+        self._tasks = []
+
+    def start(self, depth_log: str = None):
+        for stage in STAGES:
+            self._tasks += [asyncio.create_task(self._worker(stage)) for _ in range(self.metrics[stage]["workers"])]
+        self._tasks.append(asyncio.create_task(self._sample_depths(depth_log)))
+
+    async def stop(self):
+        for task in self._tasks:
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+
+    async def submit(self, item: dict, run_log=None):
+        """
+        Admit one request (a load_requests() record), waiting while the pipeline is full.
+
+        With a run_log (RequestLog), stages already logged are restored and the
+        story enters the pipeline at its next stage.
+        """
+        await self._room.acquire()
+        self._in_flight += 1
+        self._idle.clear()
+        item = dict(item, start=time.perf_counter(), story_versions=[], evaluations=[], scores=[],
+                    judge_calls_avoided=0, run_log=run_log,
+                    span=tracer.start_span("story", request=item["request"][:80], request_id=item["request_id"],
+                                           staged=True))
+        stage = self._restore(item) if run_log is not None else "detect"
+        if stage == "done":
+            await self._finish(item, item.pop("logged_result", None) or await self._result(item))
+        else:
+            self.queues[stage].put_nowait(item)
+
+    async def join(self):
+        """Wait until every admitted story has left the pipeline."""
+        await self._idle.wait()
+
+    async def _record(self, item: dict, stage: str, **data):
+        if item["run_log"] is not None:
+            await item["run_log"].arecord(stage, **data)
+
+    def _restore(self, item: dict) -> str:
+        """Load logged stages into item; returns the stage it continues at ("done" when finished)."""
+        state = item["run_log"].state()
+        if state["final"] is not None:
+            item["logged_result"] = state["final"]
+            return "done"
+        item["category"] = item["category"] or state["category"]
+        if item["category"]:
+            item["span"].set(category=item["category"])
+        if state["draft"] is None:
+            return "draft" if item["category"] else "detect"
+        draft = state["draft"]
+        item["story_versions"].append(draft["story"])
+        item["judge_calls_avoided"] = draft["judge_calls_avoided"]
+        judged = dict(state["judged"])
+        if draft["evaluation"] is not None:
+            judged.setdefault(1, (draft["evaluation"], 0))  # Best-of-N drafts were judged with the draft
+        iteration = 1
+        while iteration in judged:
+            evaluation, avoided = judged[iteration]
+            item["evaluations"].append(evaluation)
+            item["scores"].append(extract_score_from_evaluation(evaluation))
+            item["judge_calls_avoided"] += avoided
+            if iteration not in state["improved"]:
+                break
+            item["story_versions"].append(state["improved"][iteration])
+            iteration += 1
+        if len(item["scores"]) < len(item["story_versions"]):
+            return "judge"
+        return self._next_after_judgement(item)
+
+    async def _worker(self, stage: str):
+        queue, handler, metrics = self.queues[stage], self._handlers[stage], self.metrics[stage]
+        while True:
+            item = await queue.get()
+            start = time.perf_counter()
+            try:
+                with tracer.activate(item["span"]):
+                    next_stage = await handler(item)
+                    result = await self._result(item) if next_stage == "done" else None
+            except Exception as e:
+                await self._finish(item, None, f"{type(e).__name__}: {e}")
+            else:
+                if next_stage == "done":
+                    await self._finish(item, result)
+                else:
+                    self.queues[next_stage].put_nowait(item)
+            finally:
+                metrics["processed"] += 1
+                metrics["busy_seconds"] += time.perf_counter() - start
+                queue.task_done()
+
+    async def _detect(self, item: dict) -> str:
+        if item["category"] is None:
+            item["category"] = await adetect_story_category(item["request"])
+        item["span"].set(category=item["category"])  # Later stage spans inherit the category
+        await self._record(item, "category", category=item["category"])
+        return "draft"
+
+    async def _draft(self, item: dict) -> str:
+        story, _ = await agenerate_initial_story(item["request"], item["category"])
+        item["story_versions"].append(story)
+        await self._record(item, "draft", story=story, evaluation=None, judge_calls_avoided=0, library=None)
+        return "judge"
+
+    async def _judge(self, item: dict) -> str:
+        story, iteration = item["story_versions"][-1], len(item["story_versions"])
+        previous_evaluation = item["evaluations"][-1] if item["evaluations"] else None
+        evaluation, avoided = None, 0
+        if self.safety_prefilter:
+            with tracer.span("safety_prefilter", iteration=iteration) as span:
+                evaluation = prefilter_story(story, item["category"])
+                span.set(passed=evaluation is None)
+            avoided = int(evaluation is not None)
+        if evaluation is None and self.judge_batcher is not None:
+            with tracer.span("judge", iteration=iteration, batched=True) as span:
+                evaluation = await self.judge_batcher.judge(story, previous_evaluation)
+                span.set(score=extract_score_from_evaluation(evaluation))
+        elif evaluation is None:
+            evaluation = await ajudge_story(story, iteration, previous_evaluation, self.early_exit_score)
+        item["evaluations"].append(evaluation)
+        item["scores"].append(extract_score_from_evaluation(evaluation))
+        item["judge_calls_avoided"] += avoided
+        await self._record(item, "judge", iteration=iteration, evaluation=evaluation, avoided=avoided)
+        return self._next_after_judgement(item)
+
+    def _next_after_judgement(self, item: dict) -> str:
+        """improve, or (with the final version chosen) audio / done."""
+        scores = item["scores"]
+        if scores[-1] < self.target_score and len(scores) < self.max_iterations:
+            return "improve"
+        if scores[-1] < self.target_score:
+            # Fall back to the best-scoring version
+            item["final_index"] = scores.index(max(scores))
+        else:
+            item["final_index"] = len(scores) - 1
+        return "audio" if self.audio else "done"
+
+    async def _improve(self, item: dict) -> str:
+        iteration = len(item["story_versions"])
+        story = await aimprove_story(item["story_versions"][-1], item["evaluations"][-1], iteration,
+                                     targeted=self.targeted_revision)
+        item["story_versions"].append(story)
+        await self._record(item, "improve", iteration=iteration, story=story)
+        return "judge"
+
+    async def _audio(self, item: dict) -> str:
+        self.audio_dir.mkdir(parents=True, exist_ok=True)
+        story = item["story_versions"][item["final_index"]]
+        with tracer.span("audio", engine=self.audio_engine) as span:
+            # TTS blocks, so it runs on a thread while the event loop keeps the text stages busy
+            item["audio_path"] = await asyncio.to_thread(
+                generate_audio_from_text, story, str(self.audio_dir / item["request_id"]), self.audio_speed,
+                self.audio_engine, cache=get_audio_cache(),
+            )
+            span.set(ok=item["audio_path"] is not None)
+        return "done"
+
+    async def _result(self, item: dict) -> dict:
+        result = {
+            "story": item["story_versions"][item["final_index"]],
+            "category": item["category"],
+            "evaluations": item["evaluations"],
+            "scores": item["scores"],
+            "story_versions": item["story_versions"],
+            "judge_calls_avoided": item["judge_calls_avoided"],
+            "stop_reason": None,
+            "library": None,
+        }
+        await self._record(item, "final", result=result)
+        if self.audio:
+            result = dict(result, audio_path=item.get("audio_path"))
+        return result
+
+    async def _finish(self, item: dict, result: dict, error: str = None):
+        span = item["span"]
+        span.set(category=item["category"], scores=item["scores"], judge_calls_avoided=item["judge_calls_avoided"])
+        if error is not None:
+            span.set(error=error)
+        span.end()
+        try:
+            await self.on_result(item, result, error)
+        except Exception as e:
+            # A failing callback must not take the worker down with it (the stage would lose capacity)
+            print(f"❌ [{item['request_id']}] result handler failed: {type(e).__name__}: {e}", file=sys.stderr)
+        finally:
+            self._in_flight -= 1
+            self._room.release()
+            if not self._in_flight:
+                self._idle.set()
+
+    async def _sample_depths(self, depth_log: str = None):
+        log = open(depth_log, "a", encoding="utf-8") if depth_log else None
+        try:
+            while True:
+                await asyncio.sleep(DEPTH_SAMPLE_SECONDS)
+                self.samples += 1
+                depths = {stage: queue.qsize() for stage, queue in self.queues.items()}
+                for stage, depth in depths.items():
+                    self.metrics[stage]["depth_total"] += depth
+                    self.metrics[stage]["max_depth"] = max(self.metrics[stage]["max_depth"], depth)
+                if log is not None:
+                    log.write(json.dumps({"time": round(time.time(), 3), "in_flight": self._in_flight, **depths})
+                              + "\n")
+        finally:
+            if log is not None:
+                log.close()
+
+    def stage_summary(self, elapsed_seconds: float) -> dict:
+        """Per stage: workers, items processed, mean/max queue depth and worker utilization."""
+        summary = {}
+        for stage, metrics in self.metrics.items():
+            capacity = metrics["workers"] * elapsed_seconds
+            summary[stage] = {
+                "workers": metrics["workers"],
+                "processed": metrics["processed"],
+                "mean_depth": round(metrics["depth_total"] / self.samples, 2) if self.samples else 0.0,
+                "max_depth": metrics["max_depth"],
+                "utilization": round(metrics["busy_seconds"] / capacity, 3) if capacity else 0.0,
+            }
+        return summary
+
+
+async def run_staged_batch(input_path: str, output_path: str, workers: dict = None, target_score=8,
+                           max_iterations=3, early_exit_judge=False, targeted_revision=False, judge_batch_size=1,
+                           audio=False, audio_dir="audio", audio_engine="gtts", run_dir=None, resume=True,
+                           depth_log: str = None) -> dict:
+    """
+    Generate (and optionally narrate) stories for every request in input_path through the staged pipeline.
+
+    Output records match batch_stories.run_batch (plus "audio_path" with audio).
+
+    Returns:
+        dict summary with counts, wall-clock time and per-stage metrics ("stages")
+    """
+    requests = load_requests(input_path)
+    skipped = 0
+    if resume:
+        finished = finished_request_ids(output_path)
+        pending = [item for item in requests if item["request_id"] not in finished]
+        skipped = len(requests) - len(pending)
+        requests = pending
+        if skipped:
+            print(f"⏭ Skipping {skipped} finished request(s)")
+    run_log = RunLog(run_dir) if run_dir else None
+    summary = {"total": len(requests) + skipped, "skipped": skipped, "succeeded": 0, "failed": 0,
+               "judge_calls_avoided": 0}
+    start = time.perf_counter()
+
+    with open(output_path, "a", encoding="utf-8") as out:
+
+        async def on_result(item: dict, result: dict, error: str):
+            record = {"request_id": item["request_id"], "request": item["request"]}
+            if error is None:
+                record.update(result)
+                summary["succeeded"] += 1
+                summary["judge_calls_avoided"] += result["judge_calls_avoided"]
+            else:
+                record["error"] = error
+                summary["failed"] += 1
+            record["elapsed_seconds"] = round(time.perf_counter() - item["start"], 3)
+            out.write(json.dumps(record, ensure_ascii=False) + "\n")
+            out.flush()
+            status = "✓" if error is None else "❌"
+            print(f"{status} [{item['request_id']}] done in {record['elapsed_seconds']}s")
+
+        pipeline = StagedPipeline(
+            on_result,
+            workers=workers,
+            target_score=target_score,
+            max_iterations=max_iterations,
+            early_exit_judge=early_exit_judge,
+            targeted_revision=targeted_revision,
+            judge_batcher=JudgeBatcher(max_batch=judge_batch_size) if judge_batch_size > 1 else None,
+            audio=audio,
+            audio_dir=audio_dir,
+            audio_engine=audio_engine,
+        )
+        pipeline.start(depth_log)
+        try:
+            for item in requests:
+                log = (await asyncio.to_thread(run_log.request_log, item["request_id"], item["request"])
+                       if run_log is not None else None)
+                await pipeline.submit(item, log)
+            await pipeline.join()
+        finally:
+            await pipeline.stop()
+            await get_client().aclose()
+
+    summary["elapsed_seconds"] = round(time.perf_counter() - start, 3)
+    summary["stages"] = pipeline.stage_summary(summary["elapsed_seconds"])
+    return summary
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Generate stories for a JSONL file through a staged pipeline.")
+    parser.add_argument("input", help="Input JSONL file of story requests")
+    parser.add_argument("output", help="Output JSONL file (results are appended)")
+    parser.add_argument("--workers", default="",
+                        help="Worker pools per stage, e.g. draft=8,judge=12,audio=4 (defaults: "
+                             + ",".join(f"{stage}={count}" for stage, count in DEFAULT_WORKERS.items()) + ")")
+    parser.add_argument("--target-score", type=float, default=8, help="Quality threshold (default: 8)")
+    parser.add_argument("--max-iterations", type=int, default=3, help="Judge/improve rounds (default: 3)")
+    parser.add_argument("--early-exit-judge", action="store_true",
+                        help="Stream judge replies and stop reading once a passing score appears")
+    parser.add_argument("--targeted-revision", action="store_true",
+                        help="Rewrite only the paragraphs the judge's feedback points at")
+    parser.add_argument("--judge-batch", type=int, default=1,
+                        help="Judge up to N stories from different requests in one call (default: 1)")
+    parser.add_argument("--audio", action="store_true", help="Narrate each final story (audio stage)")
+    parser.add_argument("--audio-engine", default="gtts", choices=sorted(TTS_ENGINES))
+    parser.add_argument("--audio-dir", default="audio", help="Folder for narration files (default: audio)")
+    parser.add_argument("--depth-log", help="Append per-stage queue depths to this JSONL file every "
+                                            f"{DEPTH_SAMPLE_SECONDS}s")
+    parser.add_argument("--trace-jsonl", help="Write per-stage/per-call tracing spans to this JSONL file")
+    parser.add_argument("--trace-chrome", help="Write a Chrome trace-event file (open in chrome://tracing or Perfetto)")
+    parser.add_argument("--run-dir", help="Folder for per-request stage logs (default: <output>.runs)")
+    parser.add_argument("--no-resume", action="store_true",
+                        help="Run every request again, ignoring the output file and stage logs")
+    args = parser.parse_args()
+
+    try:
+        workers = parse_workers(args.workers)
+    except ValueError as e:
+        parser.error(str(e))
+    if args.trace_jsonl:
+        tracer.add_sink(JsonlSink(args.trace_jsonl))
+    if args.trace_chrome:
+        tracer.add_sink(ChromeTraceSink(args.trace_chrome))
+
+    summary = asyncio.run(run_staged_batch(
+        args.input,
+        args.output,
+        workers=workers,
+        target_score=args.target_score,
+        max_iterations=args.max_iterations,
+        early_exit_judge=args.early_exit_judge,
+        targeted_revision=args.targeted_revision,
+        judge_batch_size=args.judge_batch,
+        audio=args.audio,
+        audio_dir=args.audio_dir,
+        audio_engine=args.audio_engine,
+        run_dir=None if args.no_resume else (args.run_dir or args.output + ".runs"),
+        resume=not args.no_resume,
+        depth_log=args.depth_log,
+    ))
+
+    print("\n" + "="*70)
+    print("STAGED BATCH SUMMARY")
+    print("="*70)
+    print(f"Requests: {summary['total']}  Succeeded: {summary['succeeded']}  Failed: {summary['failed']}"
+          + (f"  Skipped (already done): {summary['skipped']}" if summary["skipped"] else ""))
+    print(f"Wall-clock time: {summary['elapsed_seconds']}s")
+    print(f"Judge calls avoided by content safety prefilter: {summary['judge_calls_avoided']}")
+    print(f"\n{'stage':>8}  {'workers':>7}  {'items':>6}  {'mean depth':>10}  {'max depth':>9}  {'busy':>6}")
+    for stage, row in summary["stages"].items():
+        if row["workers"]:
+            print(f"{stage:>8}  {row['workers']:>7}  {row['processed']:>6}  {row['mean_depth']:>10}  "
+                  f"{row['max_depth']:>9}  {row['utilization']:>6.0%}")
+    active = {stage: row for stage, row in summary["stages"].items() if row["workers"]}
+    bottleneck = max(active, key=lambda stage: (active[stage]["mean_depth"], active[stage]["utilization"]))
+    if active[bottleneck]["mean_depth"] > 0:
+        print(f"Bottleneck: {bottleneck} (longest queue) - consider --workers {bottleneck}="
+              f"{active[bottleneck]['workers'] * 2}")
+
+
+if __name__ == "__main__":
+    main()
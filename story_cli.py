@@ -0,0 +1,207 @@
+"""
+Story CLI
+Non-interactive entry point for scripts, cron and job runners: everything comes
+from arguments or stdin, nothing waits on input().
+
+- One request as an argument (or piped on stdin), or many as JSONL (--input
+  file or "-"; same fields as batch_stories.py: request, request_id, category)
+- Category override, target score, iteration cap, optional narration (--audio)
+- --format text prints just the story; json/jsonl print the full result record.
+  Progress goes to stderr (--verbose), so stdout can be piped as is
+- Exit status: 0 when every request succeeded, 1 when any failed, 2 on bad usage
+
+Startup stays cheap: arguments are parsed before the pipeline is imported, the
+pipeline never imports openai until its first model call, and the TTS modules
+are only imported with --audio (see benchmark_startup.py).
+
+Usage:
+    python story_cli.py "a sleepy dragon who loves pancakes" --format json
+    echo "a brave little turtle" | python story_cli.py --max-iterations 2
+    python story_cli.py --input requests.jsonl --format jsonl --audio --audio-engine espeak > stories.jsonl
+"""
+
+import argparse
+import json
+import os
+import sys
+import time
+
+FORMATS = ("text", "json", "jsonl")
+
+
+def read_requests(args) -> list:
+    """Requests from --input (JSONL), the positional argument or stdin, as load_requests()-style dicts."""
+    if args.input:
+        lines = sys.stdin if args.input == "-" else open(args.input, encoding="utf-8")
+        requests = []
+        with lines:
+            for line_number, line in enumerate(lines, start=1):
+                line = line.strip()
+                if not line:
+                    continue
+                record = json.loads(line)
+                text = record.get("request") or record.get("body") or record.get("prompt")
+                if not text:
+                    print(f"⚠ Skipping line {line_number}: no request text", file=sys.stderr)
+                    continue
+                requests.append({
+                    "request_id": str(record.get("request_id", line_number)),
+                    "request": text,
+                    "category": record.get("category") or args.category,
+                })
+        return requests
+
+    text = args.request
+    if text in (None, "-"):
+        text = "" if sys.stdin.isatty() and text is None else sys.stdin.read()
+    text = " ".join(text.split())
+    return [{"request_id": "1", "request": text, "category": args.category}] if text else []
+
+
+async def generate(item: dict, args) -> dict:
+    """Run one request through the async pipeline (plus narration) and build its output record."""
+    # Imported here, after argument parsing, so --help and usage errors stay instant
+    from async_pipeline import agenerate_story_with_quality_control
+
+    start = time.perf_counter()
+    record = {"request_id": item["request_id"], "request": item["request"]}
+
+    def on_event(name: str, data: dict):
+        if args.verbose and name not in ("token", "final"):
+            details = ", ".join(f"{key}={value}" for key, value in data.items() if key != "story")
+            print(f"  [{item['request_id']}] {name}" + (f": {details}" if details else ""), file=sys.stderr)
+
+    try:
+        result = await agenerate_story_with_quality_control(
+            item["request"],
+            target_score=args.target_score,
+            max_iterations=args.max_iterations,
+            category=item["category"],
+            on_event=on_event,
+            targeted_revision=args.targeted_revision,
+            library=args.library_instance,
+        )
+        record.update(result)
+        if args.audio:
+            record["audio_path"] = await narrate(result["story"], item, args)
+            if record["audio_path"] is None:
+                record["error"] = f"narration failed ({args.audio_engine})"
+    except Exception as e:
+        record["error"] = f"{type(e).__name__}: {e}"
+    record["elapsed_seconds"] = round(time.perf_counter() - start, 3)
+    return record
+
+
+async def narrate(story: str, item: dict, args) -> str:
+    """Render the story to audio on a thread; returns the file path (None when the engine failed)."""
+    import asyncio
+    from contextlib import redirect_stdout
+
+    from add_audio import generate_audio_from_text
+    from audio_cache import get_audio_cache
+
+    output = args.audio_out if args.audio_out and not args.input else os.path.join(args.audio_dir, item["request_id"])
+
+    def render():
+        with redirect_stdout(sys.stderr):  # Keep the narration banners off stdout
+            return generate_audio_from_text(story, output, args.speed, args.audio_engine, cache=get_audio_cache())
+
+    return await asyncio.to_thread(render)
+
+
+def emit(record: dict, args):
+    """Write one finished record to stdout in the chosen format."""
+    if args.format == "text":
+        if "error" in record:
+            print(f"❌ [{record['request_id']}] {record['error']}", file=sys.stderr)
+        if "story" not in record:
+            return
+        if args.input:
+            print(f"=== {record['request_id']}: {record['request']} ===")
+        print(record["story"].strip())
+        if args.input:
+            print()
+    else:
+        if args.format == "json" and not args.input:
+            print(json.dumps(record, ensure_ascii=False, indent=2))
+        else:
+            print(json.dumps(record, ensure_ascii=False))
+    sys.stdout.flush()
+
+
+async def run(requests: list, args) -> int:
+    """Generate every request (at most --concurrency at once), printing records as they finish."""
+    import asyncio
+
+    from model_client import get_client
+
+    semaphore = asyncio.Semaphore(args.concurrency)
+    failed = 0
+
+    async def process(item: dict):
+        nonlocal failed
+        async with semaphore:
+            record = await generate(item, args)
+        failed += "error" in record
+        emit(record, args)
+
+    try:
+        await asyncio.gather(*(process(item) for item in requests))
+    finally:
+        await get_client().aclose()
+    return 1 if failed else 0
+
+
+def build_parser() -> argparse.ArgumentParser:
+    parser = argparse.ArgumentParser(description="Generate bedtime stories without prompts (for scripts and cron).")
+    parser.add_argument("request", nargs="?", help='Story request ("-" or omitted: read it from stdin)')
+    parser.add_argument("--input", metavar="JSONL", help='JSONL file of requests ("-" for stdin)')
+    parser.add_argument("--category", choices=["adventure", "educational", "calming", "fantasy", "friendship"],
+                        help="Skip category detection and use this category")
+    parser.add_argument("--target-score", type=float, default=8, help="Quality threshold (default: 8)")
+    parser.add_argument("--max-iterations", type=int, default=3, help="Judge/improve rounds (default: 3)")
+    parser.add_argument("--targeted-revision", action="store_true",
+                        help="Rewrite only the paragraphs the judge's feedback points at")
+    parser.add_argument("--format", choices=FORMATS, default="text",
+                        help="text: the story only; json: full result; jsonl: one result per line (default: text)")
+    parser.add_argument("--concurrency", type=int, default=4, help="Requests generated at once with --input (default: 4)")
+    parser.add_argument("--audio", action="store_true", help="Also narrate each story")
+    parser.add_argument("--audio-engine", default="gtts", choices=["gtts", "pyttsx3", "espeak"])
+    parser.add_argument("--speed", type=float, default=0.9, help="Narration speed (default: 0.9)")
+    parser.add_argument("--audio-out", help="Audio file for a single request (default: <audio-dir>/1)")
+    parser.add_argument("--audio-dir", default="audio", help="Folder for narration files with --input (default: audio)")
+    parser.add_argument("--library", help="Story library to serve similar requests from and store results in "
+                                          "(default: $STORY_LIBRARY_PATH, off when unset)")
+    parser.add_argument("--cache", help="SQLite response cache for detection/judge calls")
+    parser.add_argument("--verbose", action="store_true", help="Print pipeline progress to stderr")
+    return parser
+
+
+def main(argv: list = None) -> int:
+    parser = build_parser()
+    args = parser.parse_args(argv)
+    if args.max_iterations < 1 or args.concurrency < 1:
+        parser.error("--max-iterations and --concurrency must be at least 1")
+    if args.input and args.request:
+        parser.error("pass either a request or --input, not both")
+
+    requests = read_requests(args)
+    if not requests:
+        parser.error("no story request given (pass it as an argument, on stdin, or with --input)")
+
+    import asyncio
+
+    from model_client import get_client
+    from response_cache import ResponseCache
+    from story_library import open_library
+
+    if args.cache:
+        get_client().cache = ResponseCache(args.cache)
+    if args.audio and (args.input or not args.audio_out):
+        os.makedirs(args.audio_dir, exist_ok=True)
+    args.library_instance = open_library(args.library)
+    return asyncio.run(run(requests, args))
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,330 @@
+"""
+Story Library
+Persistent store of finished stories (request, category, final story, score
+trajectory and evaluations) with a local full-text index, so a new request can be
+answered from a story that was already written and judged.
+
+- Requests are normalized (case, punctuation, filler words) and indexed with
+  SQLite FTS5; story text is indexed too, for search()
+- match() fetches BM25 candidates from the index and re-ranks them by Jaccard
+  similarity of the normalized requests. Candidates must contain every word
+  (near-identical requests) or, failing that, one of the request's rarest words:
+  a story sharing enough words to reach min_similarity always contains one of
+  them (prefix filtering), and rare words have short posting lists
+- A near-identical request whose story scored at or above the target can be
+  served as is (SERVE_SIMILARITY); a similar one can seed a cheap adaptation
+  instead of a full draft (SEED_SIMILARITY)
+- Word sets ignore order and pronouns, so serving as is also needs the requests'
+  word bigrams (only filler words removed) to agree: "the cat chases the mouse"
+  and "the mouse chases the cat", or "her dog" and "his dog", can only seed
+
+Both lookups are index queries limited to the top MAX_CANDIDATES hits, so a
+match stays in the millisecond range with hundreds of thousands of stories.
+
+Usage:
+    python story_library.py stats
+    python story_library.py search "sleepy dragon"
+"""
+
+import argparse
+import json
+import math
+import os
+import re
+import sqlite3
+import threading
+import time
+import unicodedata
+
+# Jaccard similarity of normalized requests (and of their word bigrams) needed to serve a stored story unchanged
+SERVE_SIMILARITY = 0.9
+
+# ... and to adapt a stored story instead of drafting from scratch
+SEED_SIMILARITY = 0.6
+
+# BM25 candidates re-ranked per lookup
+MAX_CANDIDATES = 50
+
+# Above this many postings, rare-word candidates are taken newest first instead of
+# by BM25 (ranking scores every posting; the newest stories are the likeliest repeats)
+MAX_RANKED_POSTINGS = 10000
+
+STOP_WORDS = frozenset("""
+a an the and or of to for with in on at by from into about that this
+who which is are was were be it its he she they them his her their there
+as but so very all has have had
+please can could would you me my our us i we write tell make create give
+story stories tale bedtime some short little
+""".split())
+
+
+# Words that never change what story is asked for; the order-aware serve check drops only these
+FILLER_WORDS = frozenset("""
+a an the please can could would you me i write tell make create give
+story stories tale bedtime some short little about
+""".split())
+
+
+def normalize_request(text: str) -> str:
+    """Canonical form of a story request: casefolded words without filler (word order is kept)."""
+    text = unicodedata.normalize("NFKC", text).casefold()
+    words = re.findall(r"[^\W_]+(?:'[^\W_]+)?", text)
+    kept = [word for word in words if word not in STOP_WORDS]
+    return " ".join(kept or words)
+
+
+def jaccard(first: str, second: str) -> float:
+    """Word-set Jaccard similarity of two normalized requests."""
+    a, b = set(first.split()), set(second.split())
+    return len(a & b) / len(a | b) if a or b else 0.0
+
+
+def ordered_similarity(first: str, second: str) -> float:
+    """Jaccard similarity of the word bigrams of two raw requests (order and pronouns count, filler doesn't)."""
+    def bigrams(text: str) -> set:
+        words = re.findall(r"[^\W_]+(?:'[^\W_]+)?", unicodedata.normalize("NFKC", text).casefold())
+        words = ["^", *(word for word in words if word not in FILLER_WORDS), "$"]
+        return set(zip(words, words[1:]))
+
+    a, b = bigrams(first), bigrams(second)
+    return len(a & b) / len(a | b)
+
+
+def index_terms(normalized: str) -> list:
+    """Distinct words of a normalized request as the FTS5 tokenizer sees them."""
+    return list(dict.fromkeys(re.findall(r"[^\W_]+", normalized)))
+
+
+def fts_query(terms: list, operator: str = "OR", column: str = None) -> str:
+    """FTS5 query joining quoted terms (so they are never read as operators)."""
+    query = f" {operator} ".join('"' + term.replace('"', '""') + '"' for term in terms)
+    return f"{column} : ({query})" if column else query
+
+
+class StoryLibrary:
+    """SQLite store of finished stories with an FTS5 index over requests and story text."""
+
+    def __init__(self, path: str = "story_library.sqlite3"):
+        """
+        Args:
+            path: SQLite database file (":memory:" for a process-local library)
+        """
+        self.path = path
+        self.hits = {"served": 0, "seeded": 0, "missed": 0}
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute(
+            """CREATE TABLE IF NOT EXISTS stories (
+                   id INTEGER PRIMARY KEY,
+                   request TEXT NOT NULL,
+                   normalized TEXT NOT NULL,
+                   category TEXT,
+                   story TEXT NOT NULL,
+                   score REAL,
+                   scores TEXT NOT NULL,
+                   evaluations TEXT NOT NULL,
+                   created REAL NOT NULL
+               )"""
+        )
+        exists = self._conn.execute(
+            "SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'stories_fts'"
+        ).fetchone()
+        if not exists:
+            self._conn.execute(
+                "CREATE VIRTUAL TABLE stories_fts USING fts5(normalized, story, content='stories', content_rowid='id')"
+            )
+            # Words of the request count ten times as much as words of the story
+            self._conn.execute("INSERT INTO stories_fts(stories_fts, rank) VALUES('rank', 'bm25(10.0, 1.0)')")
+        self._conn.execute("CREATE VIRTUAL TABLE IF NOT EXISTS stories_vocab USING fts5vocab(stories_fts, 'col')")
+        self._conn.commit()
+
+    def add(self, request: str, category: str, story: str, scores: list, evaluations: list,
+            score: float = None) -> int:
+        """
+        Store a finished story and index it.
+
+        Args:
+            score: Score of the stored version (default: the best score in scores)
+
+        Returns:
+            The new story's id
+        """
+        normalized = normalize_request(request)
+        if score is None:
+            score = max(scores) if scores else None
+        with self._lock:
+            cursor = self._conn.execute(
+                "INSERT INTO stories (request, normalized, category, story, score, scores, evaluations, created) "
+                "VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+                (request, normalized, category, story, score, json.dumps(scores),
+                 json.dumps(evaluations, ensure_ascii=False), time.time()),
+            )
+            story_id = cursor.lastrowid
+            self._conn.execute("INSERT INTO stories_fts (rowid, normalized, story) VALUES (?, ?, ?)",
+                               (story_id, normalized, story))
+            self._conn.commit()
+        return story_id
+
+    @staticmethod
+    def _record(row) -> dict:
+        story_id, request, normalized, category, story, score, scores, evaluations = row
+        return {
+            "id": story_id,
+            "request": request,
+            "normalized": normalized,
+            "category": category,
+            "story": story,
+            "score": score,
+            "scores": json.loads(scores),
+            "evaluations": json.loads(evaluations),
+        }
+
+    def _candidates(self, query: str, limit: int, ranked: bool = True) -> list:
+        order = "rank" if ranked else "rowid DESC"
+        with self._lock:
+            rows = self._conn.execute(
+                "SELECT s.id, s.request, s.normalized, s.category, s.story, s.score, s.scores, s.evaluations "
+                f"FROM (SELECT rowid, rank FROM stories_fts WHERE stories_fts MATCH ? ORDER BY {order} LIMIT ?) "
+                "AS hits JOIN stories AS s ON s.id = hits.rowid ORDER BY hits.rank",
+                (query, limit),
+            ).fetchall()
+        return [self._record(row) for row in rows]
+
+    def _document_frequency(self, term: str) -> int:
+        with self._lock:
+            row = self._conn.execute(
+                "SELECT doc FROM stories_vocab WHERE term = ? AND col = 'normalized'", (term,)
+            ).fetchone()
+        return row[0] if row else 0
+
+    def _rarest_terms(self, terms: list, min_similarity: float) -> tuple:
+        """
+        The terms at least one of which any story with Jaccard >= min_similarity must contain.
+
+        Returns:
+            (terms, total postings of those terms)
+        """
+        prefix = max(len(terms) - math.ceil(min_similarity * len(terms)) + 1, 1)
+        frequencies = sorted((self._document_frequency(term), term) for term in terms)[:prefix]
+        return [term for _, term in frequencies], sum(frequency for frequency, _ in frequencies)
+
+    def match(self, request: str, min_score: float = None, category: str = None,
+              min_similarity: float = SEED_SIMILARITY):
+        """
+        Find the stored story whose request is most similar to this one.
+
+        Args:
+            request: The new story request
+            min_score: Only consider stories scored at or above this
+            category: Only consider stories of this category (any, when None)
+            min_similarity: Jaccard similarity below which nothing is returned
+
+        Returns:
+            The stored record plus "similarity", or None
+        """
+        normalized = normalize_request(request)
+        terms = index_terms(normalized)
+        if not terms:
+            return None
+        best = self._best(request, normalized, fts_query(terms, "AND", "normalized"), min_score, category)
+        if best is None or best["similarity"] < SERVE_SIMILARITY:
+            rarest, postings = self._rarest_terms(terms, min_similarity)
+            best = self._best(request, normalized, fts_query(rarest, "OR", "normalized"), min_score, category,
+                              best, ranked=postings <= MAX_RANKED_POSTINGS)
+        if best is None or best["similarity"] < min_similarity:
+            return None
+        return best
+
+    def _best(self, request: str, normalized: str, query: str, min_score: float, category: str,
+              best: dict = None, ranked: bool = True):
+        """
+        Most similar eligible candidate of query, or best if none beats it.
+
+        Ties on word-set similarity go to the candidate whose word order matches
+        better ("order_similarity"), then to the higher score.
+        """
+        def rank(record: dict) -> tuple:
+            return record["similarity"], record["order_similarity"], record["score"] or 0
+
+        for record in self._candidates(query, MAX_CANDIDATES, ranked):
+            if min_score is not None and (record["score"] is None or record["score"] < min_score):
+                continue
+            if category is not None and record["category"] != category:
+                continue
+            candidate = dict(record, similarity=jaccard(normalized, record["normalized"]),
+                             order_similarity=ordered_similarity(request, record["request"]))
+            if best is None or rank(candidate) > rank(best):
+                best = candidate
+        return best
+
+    def lookup(self, request: str, target_score: float, category: str = None) -> tuple:
+        """
+        Decide how to serve a request from the library.
+
+        Returns:
+            ("served", record) for a near-identical passing story (same words in the
+            same order), ("seeded", record) for a similar one to adapt, or (None, None)
+        """
+        record = self.match(request, min_score=target_score, category=category)
+        if record is None:
+            mode = None
+        elif record["similarity"] >= SERVE_SIMILARITY and record["order_similarity"] >= SERVE_SIMILARITY:
+            mode = "served"
+        else:
+            mode = "seeded"
+        self.hits[mode or "missed"] += 1
+        return mode, record
+
+    def search(self, text: str, limit: int = 10) -> list:
+        """Full-text search over requests and story text, best BM25 match first."""
+        terms = index_terms(normalize_request(text))
+        return self._candidates(fts_query(terms), limit) if terms else []
+
+    def count(self) -> int:
+        with self._lock:
+            return self._conn.execute("SELECT COUNT(*) FROM stories").fetchone()[0]
+
+    def stats(self) -> dict:
+        """Stored stories and how lookups were served."""
+        return {"stories": self.count(), **self.hits}
+
+
+def open_library(path: str = None):
+    """The library at path or $STORY_LIBRARY_PATH, or None when neither is set."""
+    path = path or os.getenv("STORY_LIBRARY_PATH")
+    return StoryLibrary(path) if path else None
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Inspect the story library.")
+    parser.add_argument("--path", default=os.getenv("STORY_LIBRARY_PATH", "story_library.sqlite3"))
+    sub = parser.add_subparsers(dest="command", required=True)
+    sub.add_parser("stats", help="Number of stored stories")
+    search_parser = sub.add_parser("search", help="Full-text search over requests and stories")
+    search_parser.add_argument("text")
+    search_parser.add_argument("--limit", type=int, default=10)
+    match_parser = sub.add_parser("match", help="Show how a request would be served")
+    match_parser.add_argument("request")
+    match_parser.add_argument("--target-score", type=float, default=8)
+    args = parser.parse_args()
+
+    library = StoryLibrary(args.path)
+    if args.command == "stats":
+        print(f"{library.count()} stories in {args.path}")
+    elif args.command == "search":
+        for record in library.search(args.text, args.limit):
+            print(f"[{record['id']}] {record['score']}/10 ({record['category']}) {record['request']}")
+    else:
+        start = time.perf_counter()
+        mode, record = library.lookup(args.request, args.target_score)
+        elapsed_ms = (time.perf_counter() - start) * 1000
+        if record is None:
+            print(f"No match ({elapsed_ms:.1f} ms) - a full generation would run")
+        else:
+            print(f"{mode}: [{record['id']}] {record['similarity']:.0%} similar, {record['score']}/10, "
+                  f"\"{record['request']}\" ({elapsed_ms:.1f} ms)")
+
+
+if __name__ == "__main__":
+    main()
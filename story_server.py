@@ -0,0 +1,558 @@
+"""
+Story Server
+Long-running asyncio HTTP service in front of the async pipeline, so stories can
+be requested by other programs (and put behind a load balancer) instead of
+through the interactive main().
+
+- POST a story request, get a job id back at once (202); poll the job or follow
+  it as server-sent events: status, category, draft, score, improved, final,
+  token (with "stream_tokens": true) and finally done or failed
+- A bounded in-process job queue drained by a pool of workers; a full queue
+  answers 429 with Retry-After instead of queueing without limit
+- Each client (X-Client-Id header, else its address) may have at most
+  CLIENT_LIMIT jobs queued or running at once; more are refused with 429
+- Identical requests in flight share one pipeline run (single_flight.py), the
+  story library serves and seeds similar requests (--library), and with
+  --run-dir every stage is checkpointed so jobs interrupted by a restart or
+  deploy are re-queued and resume where they stopped (run_log.py)
+- Follow-up jobs on a finished story: reader feedback (apply_user_feedback) and
+  audio narration (add_audio.py), served back as a file
+
+Endpoints:
+    POST /stories                {"request": ..., "category", "target_score", "max_iterations",
+                                  "num_drafts", "personalization", "stream_tokens"}
+    GET  /jobs/<id>              job status, and its result once done
+    GET  /jobs/<id>/events       server-sent events (replayed from the start, or after Last-Event-ID)
+    POST /jobs/<id>/feedback     {"feedback": ...} -> new job revising the finished story
+    POST /jobs/<id>/audio        {"engine": "gtts", "speed": 0.9} -> new job narrating it
+    GET  /jobs/<id>/audio        the narration file of a finished audio job
+    GET  /health                 queue depth, busy workers, job counts
+
+Only the standard library is used for HTTP (like mock_openai_server.py); one
+request per connection.
+
+Usage:
+    python story_server.py --port 8080 --workers 8 --queue-size 100 --run-dir server.runs
+    curl -s localhost:8080/stories -d '{"request": "a sleepy dragon"}'
+    curl -N localhost:8080/jobs/<id>/events
+"""
+
+import argparse
+import asyncio
+import json
+import os
+import re
+import sys
+import time
+import traceback
+import uuid
+from collections import Counter, OrderedDict
+from http import HTTPStatus
+from pathlib import Path
+
+from add_audio import TTS_ENGINES, generate_audio_from_text
+from async_pipeline import aapply_user_feedback
+from audio_cache import get_audio_cache
+from model_client import get_client
+from run_log import RunLog
+from single_flight import SingleFlight, agenerate_story_single_flight
+from story_library import open_library
+
+# Workers running jobs at once
+WORKERS = int(os.getenv("STORY_SERVER_WORKERS", "8"))
+
+# Jobs waiting for a worker before new submissions get 429
+QUEUE_SIZE = int(os.getenv("STORY_SERVER_QUEUE_SIZE", "100"))
+
+# Jobs one client may have queued or running at once
+CLIENT_LIMIT = int(os.getenv("STORY_SERVER_CLIENT_LIMIT", "4"))
+
+# Finished jobs kept in memory for polling (older ones are still found in the run log)
+MAX_FINISHED_JOBS = 1000
+
+MAX_BODY_BYTES = 64 * 1024
+READ_TIMEOUT_SECONDS = 30.0
+
+# Comment lines sent on idle event streams so proxies don't drop them
+SSE_KEEPALIVE_SECONDS = 15.0
+
+# Story options a client may set, with their types
+STORY_OPTIONS = {
+    "category": str,
+    "target_score": float,
+    "max_iterations": int,
+    "num_drafts": int,
+    "targeted_revision": bool,
+    "early_exit_judge": bool,
+}
+
+JOB_PATH = re.compile(r"/jobs/([0-9a-f]+)(?:/(events|feedback|audio))?")
+
+TERMINAL_EVENTS = ("done", "failed")
+
+
+class RequestError(Exception):
+    """A request the server refuses, with the HTTP status to answer."""
+
+    def __init__(self, status: int, message: str, headers: dict = None):
+        super().__init__(message)
+        self.status = status
+        self.headers = headers or {}
+
+
+class Job:
+    """One queued unit of work (a story, a feedback revision or a narration) and its event history."""
+
+    def __init__(self, kind: str, client: str, request: str = None, options: dict = None,
+                 parent: "Job" = None, job_id: str = None):
+        self.id = job_id or uuid.uuid4().hex[:16]
+        self.kind = kind
+        self.client = client
+        self.request = request
+        self.options = options or {}
+        self.parent = parent
+        self.status = "queued"
+        self.result = None
+        self.error = None
+        self.created = time.time()
+        self.finished = None
+        self.events = []  # [(name, data), ...]; an event's id is its index
+        self._changed = asyncio.Event()
+
+    def emit(self, name: str, data: dict):
+        """Record an event and wake every stream following the job."""
+        self.events.append((name, data))
+        changed, self._changed = self._changed, asyncio.Event()
+        changed.set()
+
+    async def wait_for_events(self, seen: int, timeout: float) -> bool:
+        """Wait until there are more than `seen` events; False on timeout."""
+        if len(self.events) > seen:
+            return True
+        try:
+            await asyncio.wait_for(self._changed.wait(), timeout)
+            return True
+        except asyncio.TimeoutError:
+            return False
+
+    def to_dict(self) -> dict:
+        job = {
+            "id": self.id,
+            "kind": self.kind,
+            "status": self.status,
+            "created": self.created,
+            "finished": self.finished,
+            "events": len(self.events),
+        }
+        if self.parent is not None:
+            job["parent"] = self.parent.id
+        if self.result is not None:
+            job["result"] = self.result
+        if self.error is not None:
+            job["error"] = self.error
+        return job
+
+
+class StoryServer:
+    """Job queue, worker pool and HTTP front end."""
+
+    def __init__(self, workers: int = WORKERS, queue_size: int = QUEUE_SIZE, client_limit: int = CLIENT_LIMIT,
+                 library=None, run_dir: str = None, audio_dir: str = "audio"):
+        """
+        Args:
+            workers: Jobs run at once
+            queue_size: Jobs waiting for a worker before submissions get 429
+            client_limit: Jobs one client may have queued or running
+            library: Optional StoryLibrary to serve, seed and store stories
+            run_dir: Optional folder for per-job stage logs; unfinished jobs found
+                     there are re-queued on start
+            audio_dir: Folder for narration files
+        """
+        self.workers = workers
+        self.client_limit = client_limit
+        self.library = library
+        self.run_log = RunLog(run_dir) if run_dir else None
+        self.audio_dir = Path(audio_dir)
+        self.registry = SingleFlight()
+        self.queue = None  # Created in start(), inside the running loop
+        self.queue_size = queue_size
+        self.jobs = OrderedDict()  # id -> Job, oldest first
+        self.active = Counter()    # client -> jobs queued or running
+        self.busy = 0
+        self.rejected = Counter()  # reason -> count
+        self._server = None
+        self._tasks = []
+
+    # ------------------------------------------------------------------
+    # Jobs
+    # ------------------------------------------------------------------
+
+    def submit(self, job: Job, enforce_limits: bool = True) -> Job:
+        """Queue a job, or raise RequestError(429) when the client or the queue is full."""
+        if enforce_limits and self.active[job.client] >= self.client_limit:
+            self.rejected["client_limit"] += 1
+            raise RequestError(429, f"Client {job.client} already has {self.client_limit} jobs in progress",
+                               {"Retry-After": "5"})
+        try:
+            self.queue.put_nowait(job)
+        except asyncio.QueueFull:
+            self.rejected["queue_full"] += 1
+            raise RequestError(429, "Job queue is full, try again later", {"Retry-After": "10"}) from None
+        self.active[job.client] += 1
+        self.jobs[job.id] = job
+        job.emit("status", {"status": "queued", "queue_depth": self.queue.qsize()})
+        return job
+
+    def _forget_finished(self):
+        finished = [job_id for job_id, job in self.jobs.items() if job.status in ("done", "failed")]
+        for job_id in finished[:max(len(finished) - MAX_FINISHED_JOBS, 0)]:
+            del self.jobs[job_id]
+
+    async def _worker(self):
+        while True:
+            job = await self.queue.get()
+            self.busy += 1
+            try:
+                await self._run(job)
+            finally:
+                self.busy -= 1
+                self.active[job.client] -= 1
+                if not self.active[job.client]:
+                    del self.active[job.client]
+                self.queue.task_done()
+
+    async def _run(self, job: Job):
+        job.status = "running"
+        job.emit("status", {"status": "running"})
+        try:
+            if job.kind == "story":
+                job.result = await self._run_story(job)
+            elif job.kind == "feedback":
+                job.result = await self._run_feedback(job)
+            else:
+                job.result = await self._run_audio(job)
+            job.status = "done"
+            job.emit("done", {"result": job.result})
+        except Exception as e:
+            job.status, job.error = "failed", f"{type(e).__name__}: {e}"
+            job.emit("failed", {"error": job.error})
+        job.finished = time.time()
+        self._forget_finished()
+
+    async def _run_story(self, job: Job) -> dict:
+        options = dict(job.options)
+        personalization = options.pop("personalization", None)
+        stream_tokens = options.pop("stream_tokens", False)
+        run_log = (await asyncio.to_thread(self.run_log.request_log, job.id, job.request)
+                   if self.run_log is not None else None)
+        if run_log is not None and not run_log.resumed:
+            await run_log.arecord("job", options=job.options)  # Lets a restarted server re-queue the job
+        return await agenerate_story_single_flight(
+            job.request, personalization, self.registry,
+            on_event=job.emit, stream_tokens=stream_tokens, library=self.library,
+            run_log=run_log, request_id=job.id, **options,
+        )
+
+    async def _run_feedback(self, job: Job) -> dict:
+        story, category = job.parent.result["story"], job.parent.result["category"]
+        on_token = ((lambda text: job.emit("token", {"stage": "feedback", "text": text}))
+                    if job.options.get("stream_tokens") else None)
+        revised = await aapply_user_feedback(story, job.request, category, on_token=on_token,
+                                             targeted=job.options.get("targeted_revision", False))
+        return {"story": revised, "category": category, "feedback": job.request}
+
+    async def _run_audio(self, job: Job) -> dict:
+        engine = job.options["engine"]
+        self.audio_dir.mkdir(parents=True, exist_ok=True)
+        # TTS blocks (and fans out to its own pool), so keep it off the event loop
+        path = await asyncio.to_thread(generate_audio_from_text, job.parent.result["story"],
+                                       str(self.audio_dir / job.id), job.options["speed"], engine,
+                                       cache=get_audio_cache())
+        if path is None:
+            raise RuntimeError(f"audio generation with {engine} failed (see server log)")
+        return {"path": path, "format": TTS_ENGINES[engine][1]}
+
+    def _resume_logged_jobs(self) -> int:
+        """Re-queue story jobs whose stage logs have no final result (the server stopped mid-job)."""
+        resumed = 0
+        for job_id, entries in self.run_log.unfinished():
+            job_entry = next((entry for entry in entries if entry["stage"] == "job"), None)
+            if job_entry is None:
+                continue
+            job = Job("story", "resumed", entries[0]["request"], job_entry["options"], job_id=job_id)
+            try:
+                self.submit(job, enforce_limits=False)
+            except RequestError:
+                break  # Queue full; the rest stay logged for the next start
+            resumed += 1
+        return resumed
+
+    def find_job(self, job_id: str) -> Job:
+        """The job with this id; finished jobs forgotten since (or from before a restart) come from the run log."""
+        job = self.jobs.get(job_id)
+        if job is None and self.run_log is not None:
+            entries = self.run_log.entries(job_id)
+            result = next((entry["result"] for entry in reversed(entries) if entry["stage"] == "final"), None)
+            if result is not None:
+                job = Job("story", "resumed", entries[0].get("request"), job_id=job_id)
+                job.status, job.result = "done", result
+                job.emit("done", {"result": result})
+        if job is None:
+            raise RequestError(404, f"No job {job_id}")
+        return job
+
+    # ------------------------------------------------------------------
+    # HTTP
+    # ------------------------------------------------------------------
+
+    async def start(self, host: str = "127.0.0.1", port: int = 8080):
+        """Start the workers and the listener; returns the bound port."""
+        self.queue = asyncio.Queue(maxsize=self.queue_size)
+        self._tasks = [asyncio.create_task(self._worker()) for _ in range(self.workers)]
+        resumed = self._resume_logged_jobs() if self.run_log is not None else 0
+        self._server = await asyncio.start_server(self._handle, host, port)
+        if resumed:
+            print(f"♻️  Re-queued {resumed} unfinished job(s) from {self.run_log.directory}")
+        return self._server.sockets[0].getsockname()[1]
+
+    async def stop(self):
+        """Stop accepting connections and cancel the workers (logged jobs resume on the next start)."""
+        self._server.close()
+        await self._server.wait_closed()
+        for task in self._tasks:
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        await self.registry.cancel_all()
+        await get_client().aclose()
+
+    async def _handle(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        try:
+            try:
+                method, path, headers, body = await asyncio.wait_for(_read_request(reader), READ_TIMEOUT_SECONDS)
+                peer = writer.get_extra_info("peername")
+                client = headers.get("x-client-id") or (peer[0] if peer else "unknown")
+                await self._route(method, path, headers, body, client, writer)
+            except RequestError as e:
+                await _send_json(writer, e.status, {"error": str(e)}, e.headers)
+            except asyncio.TimeoutError:
+                await _send_json(writer, 408, {"error": "Request timed out"})
+            except (ConnectionError, asyncio.IncompleteReadError):
+                raise
+            except Exception as e:
+                print(f"❌ Error handling request: {type(e).__name__}: {e}", file=sys.stderr)
+                traceback.print_exc()
+                await _send_json(writer, 500, {"error": "Internal server error"})
+        except (ConnectionError, asyncio.IncompleteReadError):
+            pass  # Client went away
+        finally:
+            writer.close()
+            try:
+                await writer.wait_closed()
+            except ConnectionError:
+                pass
+
+    async def _route(self, method: str, path: str, headers: dict, body: bytes, client: str,
+                     writer: asyncio.StreamWriter):
+        if path == "/health" and method == "GET":
+            await _send_json(writer, 200, self.health())
+            return
+        if path == "/stories" and method == "POST":
+            job = self.submit(Job("story", client, *_parse_story_request(body)))
+            await _send_json(writer, 202, job.to_dict(), {"Location": f"/jobs/{job.id}"})
+            return
+
+        match = JOB_PATH.fullmatch(path)
+        if match is None:
+            raise RequestError(404, f"Unknown path {path}")
+        job, action = self.find_job(match.group(1)), match.group(2)
+        if action is None and method == "GET":
+            await _send_json(writer, 200, job.to_dict())
+        elif action == "events" and method == "GET":
+            await self._stream_events(job, headers, writer)
+        elif action == "audio" and method == "GET":
+            await _send_audio(writer, job)
+        elif action in ("feedback", "audio") and method == "POST":
+            if job.status != "done" or "story" not in (job.result or {}):
+                raise RequestError(409, f"Job {job.id} has no finished story ({job.status})")
+            payload = _parse_json(body)
+            if action == "feedback":
+                feedback = payload.get("feedback")
+                if not isinstance(feedback, str) or not feedback.strip():
+                    raise RequestError(400, '"feedback" must be a non-empty string')
+                options = {name: payload[name] for name in ("stream_tokens", "targeted_revision") if name in payload}
+                follow_up = Job("feedback", client, feedback, options, parent=job)
+            else:
+                engine, speed = payload.get("engine", "gtts"), payload.get("speed", 0.9)
+                if engine not in TTS_ENGINES or not isinstance(speed, (int, float)):
+                    raise RequestError(400, f'"engine" must be one of {sorted(TTS_ENGINES)}, "speed" a number')
+                follow_up = Job("audio", client, options={"engine": engine, "speed": float(speed)}, parent=job)
+            self.submit(follow_up)
+            await _send_json(writer, 202, follow_up.to_dict(), {"Location": f"/jobs/{follow_up.id}"})
+        else:
+            raise RequestError(405, f"{method} not allowed on {path}")
+
+    async def _stream_events(self, job: Job, headers: dict, writer: asyncio.StreamWriter):
+        """Replay the job's events, then follow it until it is done or failed."""
+        writer.write(b"HTTP/1.1 200 OK\r\nContent-Type: text/event-stream\r\nCache-Control: no-cache\r\n"
+                     b"Connection: close\r\n\r\n")
+        last_id = headers.get("last-event-id", "")
+        seen = int(last_id) + 1 if last_id.isdigit() else 0
+        while True:
+            while seen < len(job.events):
+                name, data = job.events[seen]
+                writer.write(f"id: {seen}\nevent: {name}\ndata: {json.dumps(data, ensure_ascii=False)}\n\n"
+                             .encode("utf-8"))
+                seen += 1
+                if name in TERMINAL_EVENTS:
+                    await writer.drain()
+                    return
+            await writer.drain()
+            if not await job.wait_for_events(seen, SSE_KEEPALIVE_SECONDS):
+                writer.write(b": keep-alive\n\n")
+
+    def health(self) -> dict:
+        return {
+            "queue_depth": self.queue.qsize(),
+            "queue_size": self.queue.maxsize,
+            "workers": self.workers,
+            "busy_workers": self.busy,
+            "jobs": dict(Counter(job.status for job in self.jobs.values())),
+            "clients": len(self.active),
+            "rejected": dict(self.rejected),
+            "single_flight": dict(self.registry.stats),
+            "library": self.library.stats() if self.library is not None else None,
+        }
+
+
+async def _read_request(reader: asyncio.StreamReader) -> tuple:
+    """Parse one HTTP/1.1 request: (method, path without query, lowercased headers, body)."""
+    request_line = (await reader.readline()).decode("latin-1").split()
+    if len(request_line) != 3:
+        raise RequestError(400, "Malformed request line")
+    method, target, _ = request_line
+    headers = {}
+    while True:
+        line = (await reader.readline()).decode("latin-1").strip()
+        if not line:
+            break
+        name, _, value = line.partition(":")
+        headers[name.strip().lower()] = value.strip()
+        if len(headers) > 100:
+            raise RequestError(431, "Too many headers")
+    length = headers.get("content-length", "0")
+    if not length.isdigit():
+        raise RequestError(400, "Invalid Content-Length")
+    if int(length) > MAX_BODY_BYTES:
+        raise RequestError(413, f"Body larger than {MAX_BODY_BYTES} bytes")
+    body = await reader.readexactly(int(length))
+    return method.upper(), target.split("?", 1)[0], headers, body
+
+
+def _parse_json(body: bytes) -> dict:
+    try:
+        payload = json.loads(body or b"{}")
+    except (json.JSONDecodeError, UnicodeDecodeError):
+        raise RequestError(400, "Body must be JSON") from None
+    if not isinstance(payload, dict):
+        raise RequestError(400, "Body must be a JSON object")
+    return payload
+
+
+def _has_type(value, kind: type) -> bool:
+    """isinstance for JSON values: bools are not numbers, ints are fine where floats are expected."""
+    if kind is bool or isinstance(value, bool):
+        return kind is bool and isinstance(value, bool)
+    return isinstance(value, (int, float) if kind is float else kind)
+
+
+def _parse_story_request(body: bytes) -> tuple:
+    """(request, options) from a POST /stories body."""
+    payload = _parse_json(body)
+    request = payload.get("request")
+    if not isinstance(request, str) or not request.strip():
+        raise RequestError(400, '"request" must be a non-empty string')
+    options = {}
+    for name, kind in STORY_OPTIONS.items():
+        if payload.get(name) is None:
+            continue
+        if not _has_type(payload[name], kind):
+            raise RequestError(400, f'"{name}" must be {kind.__name__}')
+        options[name] = kind(payload[name])
+    if options.get("max_iterations", 1) < 1 or options.get("num_drafts", 1) < 1:
+        raise RequestError(400, '"max_iterations" and "num_drafts" must be at least 1')
+    if isinstance(payload.get("personalization"), str) and payload["personalization"].strip():
+        options["personalization"] = payload["personalization"]
+    if payload.get("stream_tokens"):
+        options["stream_tokens"] = True
+    return request, options
+
+
+async def _send_json(writer: asyncio.StreamWriter, status: int, payload: dict, headers: dict = None):
+    body = json.dumps(payload, ensure_ascii=False).encode("utf-8")
+    await _send(writer, status, body, "application/json", headers)
+
+
+async def _send(writer: asyncio.StreamWriter, status: int, body: bytes, content_type: str, headers: dict = None):
+    head = [f"HTTP/1.1 {status} {HTTPStatus(status).phrase}", f"Content-Type: {content_type}",
+            f"Content-Length: {len(body)}", "Connection: close"]
+    head += [f"{name}: {value}" for name, value in (headers or {}).items()]
+    writer.write(("\r\n".join(head) + "\r\n\r\n").encode("latin-1") + body)
+    await writer.drain()
+
+
+async def _send_audio(writer: asyncio.StreamWriter, job: Job):
+    if job.kind != "audio" or job.status != "done":
+        raise RequestError(409, f"Job {job.id} is not a finished audio job ({job.kind}, {job.status})")
+    audio = await asyncio.to_thread(Path(job.result["path"]).read_bytes)
+    content_type = "audio/mpeg" if job.result["format"] == "mp3" else f"audio/{job.result['format']}"
+    await _send(writer, 200, audio, content_type)
+
+
+async def serve(host: str, port: int, **kwargs):
+    server = StoryServer(**kwargs)
+    port = await server.start(host, port)
+    print("\n" + "="*70)
+    print("STORY SERVER")
+    print("="*70)
+    print(f"🌐 Listening on http://{host}:{port}")
+    print(f"Workers: {server.workers}  Queue size: {server.queue_size}  Per-client limit: {server.client_limit}")
+    if server.run_log is not None:
+        print(f"Stage logs: {server.run_log.directory}")
+    try:
+        await asyncio.Event().wait()
+    finally:
+        await server.stop()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Serve the story pipeline over HTTP with a job queue and SSE.")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8080)
+    parser.add_argument("--workers", type=int, default=WORKERS, help=f"Jobs run at once (default: {WORKERS})")
+    parser.add_argument("--queue-size", type=int, default=QUEUE_SIZE,
+                        help=f"Waiting jobs before submissions get 429 (default: {QUEUE_SIZE})")
+    parser.add_argument("--client-limit", type=int, default=CLIENT_LIMIT,
+                        help=f"Jobs in progress per client (default: {CLIENT_LIMIT})")
+    parser.add_argument("--library", help="Story library to serve similar requests from and store results in "
+                                          "(default: $STORY_LIBRARY_PATH, off when unset)")
+    parser.add_argument("--run-dir", help="Folder for per-job stage logs; unfinished jobs resume on restart")
+    parser.add_argument("--audio-dir", default="audio", help="Folder for narration files (default: audio)")
+    args = parser.parse_args()
+
+    try:
+        asyncio.run(serve(
+            args.host,
+            args.port,
+            workers=args.workers,
+            queue_size=args.queue_size,
+            client_limit=args.client_limit,
+            library=open_library(args.library),
+            run_dir=args.run_dir,
+            audio_dir=args.audio_dir,
+        ))
+    except KeyboardInterrupt:
+        print("\n👋 Server stopped")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,174 @@
+"""
+Paragraph-Level Targeted Revision
+Instead of asking the storyteller to rewrite the whole story for every round of
+feedback, split the story into numbered paragraphs, work out which paragraphs the
+feedback is about, and regenerate only those. The rewritten paragraphs are patched
+back into the original text.
+
+Feedback is mapped to paragraphs locally (no extra model call) from:
+- explicit references: "second paragraph", "paragraph 3", "paragraphs 2 and 4"
+- positions: opening/beginning (first), middle, ending/conclusion (last)
+- quoted phrases and character names that appear in specific paragraphs
+  (this also covers the content-safety prefilter, which quotes flagged words)
+
+When nothing can be mapped, the story is too short, or the edits would touch most
+of the text, plan_revision returns None and the caller does a full rewrite.
+"""
+
+import re
+
+from model_client import estimate_tokens
+
+# Rewrite the whole story when more than this fraction of paragraphs is affected
+MAX_TARGETED_FRACTION = 0.5
+
+# Stories with fewer paragraphs are always rewritten in full
+MIN_PARAGRAPHS = 3
+
+ORDINALS = {
+    "first": 1, "second": 2, "third": 3, "fourth": 4, "fifth": 5,
+    "sixth": 6, "seventh": 7, "eighth": 8, "ninth": 9, "tenth": 10,
+}
+
+OPENING_WORDS = ("opening", "beginning", "introduction", "first paragraph", "start of the story")
+ENDING_WORDS = ("ending", "conclusion", "final paragraph", "last paragraph", "closing", "end of the story")
+
+# Whole words only, so "extending" or "reopening" don't point at the first/last paragraph
+OPENING_PATTERN = re.compile(r"\b(?:" + "|".join(OPENING_WORDS) + r")\b")
+ENDING_PATTERN = re.compile(r"\b(?:" + "|".join(ENDING_WORDS) + r")\b")
+
+PARAGRAPH_REFERENCE = re.compile(
+    r"\b(" + "|".join(ORDINALS) + r")\s+(?:and\s+(" + "|".join(ORDINALS) + r")\s+)?paragraphs?\b"
+    r"|\bparagraphs?\s+(\d+(?:\s*(?:,|and|&|-|to)\s*\d+)*)",
+    re.IGNORECASE,
+)
+QUOTED_PHRASE = re.compile(r"[\"“]([^\"”]{3,80})[\"”]")
+CAPITALIZED_WORD = re.compile(r"\b[A-Z][a-z]{2,}\b")
+MID_SENTENCE_NAME = re.compile(r"(?<=[a-z,;] )([A-Z][a-z]{2,})\b")
+# Headings may be plain ('Weaknesses:'), bold ('**Weaknesses:**', '**Weaknesses**:') or markdown ('## Weaknesses')
+SECTION_HEADING = (r"^[ \t]*(?:#{{1,6}}[ \t]*)?\*{{0,2}}[ \t]*(?:{name})[ \t]*\*{{0,2}}[ \t]*:[ \t]*\*{{0,2}}"
+                   r"|^[ \t]*#{{1,6}}[ \t]*\*{{0,2}}[ \t]*(?:{name})[ \t]*\*{{0,2}}[ \t]*$")
+SECTION_PATTERN = re.compile(r"(?:" + SECTION_HEADING.format(name="Weaknesses|Suggestions") + r")"
+                             r"(.*?)(?=" + SECTION_HEADING.format(name="[A-Z][A-Za-z ]+") + r"|\Z)",
+                             re.MULTILINE | re.DOTALL)
+NUMBERED_PARAGRAPH = re.compile(r"^\s*\[(\d+)\]\s*", re.MULTILINE)
+
+# Filled in with str.format(): story (numbered paragraphs), feedback_intro, feedback, numbers, first
+PARAGRAPH_REVISION_PROMPT = """You are an expert children's storyteller. You previously wrote this bedtime story for ages 5-10 (paragraphs are numbered):
+
+{story}
+
+{feedback_intro}
+
+{feedback}
+
+Rewrite ONLY paragraph(s) {numbers}, addressing the parts of the feedback that concern them. Keep the same characters, names, tone and events so each rewritten paragraph still flows from the paragraph before it and into the one after it. The story must stay calm, age-appropriate and perfect for bedtime.
+
+Reply with each rewritten paragraph prefixed by its number in square brackets, e.g. "[{first}] ...", and nothing else.
+
+Revised Paragraphs:"""
+
+
+def split_paragraphs(story: str) -> list:
+    """Split a story into non-empty paragraphs (separated by blank lines)."""
+    return [paragraph.strip() for paragraph in re.split(r"\n\s*\n", story.strip()) if paragraph.strip()]
+
+
+def number_paragraphs(paragraphs: list) -> str:
+    """Render paragraphs as '[1] ...' blocks, the format used in revision prompts."""
+    return "\n\n".join(f"[{index}] {paragraph}" for index, paragraph in enumerate(paragraphs, start=1))
+
+
+def actionable_feedback(evaluation: str) -> str:
+    """The Weaknesses/Suggestions part of a judge evaluation (the whole text for free-form feedback)."""
+    sections = [body.strip() for body in SECTION_PATTERN.findall(evaluation)]
+    return "\n".join(section for section in sections if section) or evaluation
+
+
+def map_feedback_to_paragraphs(feedback: str, paragraphs: list) -> set:
+    """Return the 0-based indices of the paragraphs the feedback refers to."""
+    count = len(paragraphs)
+    lowered = feedback.lower()
+    indices = set()
+
+    for match in PARAGRAPH_REFERENCE.finditer(feedback):
+        first, second, numbers = match.groups()
+        if first:
+            indices.add(ORDINALS[first.lower()] - 1)
+            if second:
+                indices.add(ORDINALS[second.lower()] - 1)
+            continue
+        for start, end in re.findall(r"(\d+)(?:\s*(?:-|to)\s*(\d+))?", numbers):
+            for number in range(int(start), int(end or start) + 1):
+                indices.add(number - 1)
+
+    if OPENING_PATTERN.search(lowered):
+        indices.add(0)
+    if ENDING_PATTERN.search(lowered):
+        indices.add(count - 1)
+    if re.search(r"\bmiddle\b", lowered) and count >= 3:
+        indices.update(range(1, count - 1))
+
+    phrases = [phrase.lower() for phrase in QUOTED_PHRASE.findall(feedback)]
+    names = set(MID_SENTENCE_NAME.findall(" ".join(paragraphs)))  # Proper nouns used in the story
+    phrases += [word.lower() for word in CAPITALIZED_WORD.findall(feedback) if word in names]
+    for phrase in phrases:
+        pattern = re.compile(r"\b" + re.escape(phrase) + r"(?:s|es)?\b")
+        hits = [index for index, paragraph in enumerate(paragraphs) if pattern.search(paragraph.lower())]
+        if hits and len(hits) < count:  # Names that appear everywhere don't narrow anything down
+            indices.update(hits)
+
+    return {index for index in indices if 0 <= index < count}
+
+
+def plan_revision(story: str, feedback: str, max_fraction: float = MAX_TARGETED_FRACTION):
+    """
+    Decide whether feedback can be applied by rewriting a few paragraphs.
+
+    Returns:
+        (paragraphs, sorted 0-based indices to rewrite), or None for a full rewrite
+    """
+    paragraphs = split_paragraphs(story)
+    if len(paragraphs) < MIN_PARAGRAPHS:
+        return None
+    indices = map_feedback_to_paragraphs(actionable_feedback(feedback), paragraphs)
+    if not indices or len(indices) / len(paragraphs) > max_fraction:
+        return None
+    return paragraphs, sorted(indices)
+
+
+def build_paragraph_revision_prompt(paragraphs: list, indices: list, feedback: str,
+                                    feedback_intro: str = "A children's literature expert provided this feedback:") -> str:
+    """Build the prompt asking the storyteller to rewrite only the selected paragraphs."""
+    numbers = ", ".join(str(index + 1) for index in indices)
+    return PARAGRAPH_REVISION_PROMPT.format(story=number_paragraphs(paragraphs), feedback_intro=feedback_intro,
+                                            feedback=feedback, numbers=numbers, first=indices[0] + 1)
+
+
+def revision_max_tokens(paragraphs: list, indices: list, full_max_tokens: int = 500) -> int:
+    """Output budget for a targeted rewrite: room to grow the selected paragraphs by half."""
+    selected = sum(estimate_tokens(paragraphs[index]) for index in indices)
+    return min(full_max_tokens, int(selected * 1.5) + 20 * len(indices))
+
+
+def parse_revised_paragraphs(reply: str, indices: list):
+    """
+    Parse '[N] text' blocks from the model's reply.
+
+    Returns:
+        dict of 0-based index -> new paragraph, or None if a requested paragraph is missing
+    """
+    parts = NUMBERED_PARAGRAPH.split(reply)
+    revised = {}
+    for number, text in zip(parts[1::2], parts[2::2]):
+        text = " ".join(text.split())
+        if text:
+            revised[int(number) - 1] = text
+    if any(index not in revised for index in indices):
+        return None
+    return {index: revised[index] for index in indices}
+
+
+def patch_paragraphs(paragraphs: list, revised: dict) -> str:
+    """Replace the revised paragraphs and join the story back together."""
+    return "\n\n".join(revised.get(index, paragraph) for index, paragraph in enumerate(paragraphs))
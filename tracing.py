@@ -0,0 +1,232 @@
+"""
+Per-Stage Tracing
+Records a span for every pipeline stage (detect, draft, judge, improve, feedback,
+safety prefilter) and every model call, so we can see where the seconds and tokens
+go per story and per category.
+
+Spans carry wall time plus whatever attributes the code sets on them: queue/wait
+time, prompt and completion tokens, cache hits, retries, iteration, category and
+the parsed score. Token counts roll up, so stage and story spans hold the totals
+of the calls beneath them. Finished spans go to sinks:
+
+- ConsoleSink: prints the familiar "STEP n: ..." banners (on by default)
+- JsonlSink: one JSON object per span
+- ChromeTraceSink: trace-event JSON for chrome://tracing or https://ui.perfetto.dev
+
+Set STORY_TRACE_JSONL / STORY_TRACE_CHROME to export without code changes.
+"""
+
+import atexit
+import contextvars
+import itertools
+import json
+import os
+import threading
+import time
+from contextlib import contextmanager
+
+# Attributes that child spans copy from their parent (trace-wide context)
+INHERITED_ATTRS = ("category", "request_id")
+
+# Numeric attributes added to the parent when a span ends, so stage and story spans
+# carry the totals of the model calls beneath them
+ROLLUP_ATTRS = ("prompt_tokens", "completion_tokens")
+
+_rollup_lock = threading.Lock()
+
+_current_span = contextvars.ContextVar("current_span", default=None)
+_span_ids = itertools.count(1)
+
+
+class Span:
+    """A timed unit of work with attributes and a parent."""
+
+    def __init__(self, tracer: "Tracer", name: str, parent: "Span" = None, **attrs):
+        self.tracer = tracer
+        self.name = name
+        self.parent = parent
+        self.span_id = next(_span_ids)
+        self.parent_id = parent.span_id if parent else None
+        self.trace_id = parent.trace_id if parent else self.span_id
+        self.attrs = {key: parent.attrs[key] for key in INHERITED_ATTRS if parent and key in parent.attrs}
+        self.attrs.update(attrs)
+        self.thread_id = threading.get_ident()
+        self.start_time = time.time()
+        self._start = time.perf_counter()
+        self.duration = None
+
+    def set(self, **attrs):
+        """Set or overwrite attributes."""
+        self.attrs.update(attrs)
+
+    def add(self, key: str, amount=1):
+        """Increment a numeric attribute (e.g. retries, wait_seconds)."""
+        self.attrs[key] = self.attrs.get(key, 0) + amount
+
+    def end(self):
+        if self.duration is None:
+            self.duration = time.perf_counter() - self._start
+            if self.parent is not None:
+                with _rollup_lock:
+                    for key in ROLLUP_ATTRS:
+                        if key in self.attrs:
+                            self.parent.attrs[key] = self.parent.attrs.get(key, 0) + self.attrs[key]
+            self.tracer._finish(self)
+
+    def to_dict(self) -> dict:
+        return {
+            "name": self.name,
+            "trace_id": self.trace_id,
+            "span_id": self.span_id,
+            "parent_id": self.parent_id,
+            "start": round(self.start_time, 6),
+            "duration_s": round(self.duration or 0.0, 6),
+            "thread_id": self.thread_id,
+            "attrs": self.attrs,
+        }
+
+
+class ConsoleSink:
+    """Prints a stage banner when a span with a "banner" attribute starts."""
+
+    def on_start(self, span: Span):
+        banner = span.attrs.get("banner")
+        if banner:
+            print("\n" + "="*70)
+            print(banner)
+            print("="*70)
+
+    def on_end(self, span: Span):
+        pass
+
+
+class JsonlSink:
+    """Appends each finished span to a JSONL file."""
+
+    def __init__(self, path: str):
+        self.path = path
+        self.lock = threading.Lock()
+
+    def on_start(self, span: Span):
+        pass
+
+    def on_end(self, span: Span):
+        line = json.dumps(span.to_dict(), ensure_ascii=False, default=str)
+        with self.lock:
+            with open(self.path, "a", encoding="utf-8") as f:
+                f.write(line + "\n")
+
+
+class ChromeTraceSink:
+    """Collects spans as Chrome trace events and writes them on flush() / exit."""
+
+    def __init__(self, path: str):
+        self.path = path
+        self.events = []
+        self.lock = threading.Lock()
+        atexit.register(self.flush)
+
+    def on_start(self, span: Span):
+        pass
+
+    def on_end(self, span: Span):
+        event = {
+            "name": span.name,
+            "cat": span.attrs.get("category", "story"),
+            "ph": "X",
+            "ts": span.start_time * 1e6,
+            "dur": (span.duration or 0.0) * 1e6,
+            "pid": span.trace_id,
+            "tid": span.thread_id,
+            "args": {key: value for key, value in span.attrs.items() if key != "banner"},
+        }
+        with self.lock:
+            self.events.append(event)
+
+    def flush(self):
+        with self.lock:
+            events = list(self.events)
+        with open(self.path, "w", encoding="utf-8") as f:
+            json.dump({"traceEvents": events, "displayTimeUnit": "ms"}, f, default=str)
+
+
+class Tracer:
+    """Creates spans and fans finished spans out to the configured sinks."""
+
+    def __init__(self, sinks: list = None, from_env: bool = False):
+        """
+        Args:
+            sinks: Initial sinks
+            from_env: Add JSONL/Chrome sinks from STORY_TRACE_JSONL / STORY_TRACE_CHROME
+                      on first use (after .env has been loaded)
+        """
+        self.sinks = list(sinks or [])
+        self._env_pending = from_env
+
+    def _configure_from_env(self):
+        self._env_pending = False
+        if os.getenv("STORY_TRACE_JSONL"):
+            self.add_sink(JsonlSink(os.environ["STORY_TRACE_JSONL"]))
+        if os.getenv("STORY_TRACE_CHROME"):
+            self.add_sink(ChromeTraceSink(os.environ["STORY_TRACE_CHROME"]))
+
+    def add_sink(self, sink):
+        self.sinks.append(sink)
+
+    def remove_sink(self, sink_type: type):
+        """Remove every sink of the given type (e.g. ConsoleSink to silence banners)."""
+        self.sinks = [sink for sink in self.sinks if not isinstance(sink, sink_type)]
+
+    def start_span(self, name: str, **attrs) -> Span:
+        """
+        Start a span without making it current; call span.end() when done.
+
+        Use this for work that spans generator yields (e.g. streaming calls).
+        """
+        if self._env_pending:
+            self._configure_from_env()
+        span = Span(self, name, _current_span.get(), **attrs)
+        for sink in self.sinks:
+            sink.on_start(span)
+        return span
+
+    @contextmanager
+    def span(self, name: str, **attrs):
+        """Context manager: time the block as a child of the current span."""
+        span = self.start_span(name, **attrs)
+        token = _current_span.set(span)
+        try:
+            yield span
+        except BaseException as e:
+            span.set(error=f"{type(e).__name__}: {e}")
+            raise
+        finally:
+            _current_span.reset(token)
+            span.end()
+
+    @contextmanager
+    def activate(self, span: Span):
+        """Make a started span current for the block, without ending it (e.g. a story whose stages hop workers)."""
+        token = _current_span.set(span)
+        try:
+            yield span
+        finally:
+            _current_span.reset(token)
+
+    def _finish(self, span: Span):
+        for sink in self.sinks:
+            sink.on_end(span)
+
+
+def current_span() -> Span:
+    """The innermost active span in this context, or None."""
+    return _current_span.get()
+
+
+def propagate(fn):
+    """Wrap fn so calls on worker threads run as children of the caller's current span."""
+    context = contextvars.copy_context()
+    return lambda *args, **kwargs: context.copy().run(fn, *args, **kwargs)
+
+
+tracer = Tracer([ConsoleSink()], from_env=True)